@@ -30,6 +30,9 @@ SERVICE_NAME = 'org.bluez'
 ADAPTER_INTERFACE = SERVICE_NAME + '.Adapter1'
 DEVICE_INTERFACE = SERVICE_NAME + '.Device1'
 
+#: D-Bus signature of a batch of advertisement records: ``(address, uuid, company, data)``
+ADVERTISEMENT_SIGNATURE = 'a(ssqay)'
+
 
 class DeviceNotFound( Exception ):
     pass
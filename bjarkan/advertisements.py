@@ -0,0 +1,176 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+"""
+Ingestion of advertisement payloads: ``ManufacturerData`` and ``ServiceData`` of BLE beacons and
+sensors.
+
+Payloads are taken from ``InterfacesAdded`` and ``PropertiesChanged`` as they arrive. The signal
+receivers use ``byte_arrays = True``, so dbus-python hands over each payload as one
+``dbus.ByteArray`` instead of boxing every byte into a ``dbus.Byte``. A payload identical to the
+previous one of the same device, company or service is dropped; the others are collected and
+delivered in batches.
+
+A payload is described by a record:
+
+    * ``address``: the device address
+    * ``company``: the company identifier for ``ManufacturerData``, ``None`` for ``ServiceData``
+    * ``uuid``: the service UUID for ``ServiceData``, ``""`` for ``ManufacturerData``
+    * ``data``: the payload, ``bytes``
+    * ``time``: when it was received
+"""
+
+import json
+import time
+
+from gi.repository import GLib
+
+from . import ADVERTISEMENT_SIGNATURE, DEVICE_INTERFACE, SERVICE_NAME
+from .device_manager import address_from_path
+from .stats import stats
+
+
+def parse_company(value):
+    """
+    Returns:
+        int: the company identifier, given in decimal or as ``0x004c``
+    """
+    return int(value, 0) if isinstance(value, str) else int(value)
+
+
+class AdvertisementFilter:
+    """
+    Args:
+        companies (list): company identifiers of the ``ManufacturerData`` to keep
+        uuids (list): service UUIDs of the ``ServiceData`` to keep
+
+    Without any company or UUID everything is kept; otherwise only the payloads matching one of
+    them.
+    """
+
+    def __init__(self, companies = (), uuids = ()):
+        self.companies = {parse_company(company) for company in companies}
+        self.uuids = {str(uuid).lower() for uuid in uuids}
+
+    def __bool__(self):
+        return bool(self.companies or self.uuids)
+
+    def matches(self, record):
+        if not self:
+            return True
+        if record['company'] is not None:
+            return record['company'] in self.companies
+        return record['uuid'] in self.uuids
+
+
+def record_json(record):
+    """
+    Returns:
+        str: ``record`` as a JSON object, the payload hex encoded
+    """
+    return json.dumps(dict(record, data = record['data'].hex()), sort_keys = True)
+
+
+class AdvertisementFeed:
+    """
+    Args:
+        bus (dbus.Bus): the bus BlueZ is on
+        on_batch (callable): called with a list of new records, at most every ``interval``
+            seconds
+        record_filter (AdvertisementFilter): which payloads to keep, all by default
+        interval (float): seconds to collect records for before delivering them
+    """
+
+    def __init__(self, bus, on_batch, record_filter = None, interval = 1.0):
+        self.bus = bus
+        self.on_batch = on_batch
+        self.filter = record_filter or AdvertisementFilter()
+        self.interval = interval
+        self.last = {}
+        self.batch = []
+        self._receivers = []
+        self._timeout = None
+
+    def start(self):
+        self._receivers = [
+            self.bus.add_signal_receiver(
+                self._properties_changed,
+                signal_name = 'PropertiesChanged',
+                dbus_interface = 'org.freedesktop.DBus.Properties',
+                bus_name = SERVICE_NAME,
+                arg0 = DEVICE_INTERFACE,
+                path_keyword = 'path',
+                byte_arrays = True
+            ),
+            self.bus.add_signal_receiver(
+                self._interfaces_added,
+                signal_name = 'InterfacesAdded',
+                dbus_interface = 'org.freedesktop.DBus.ObjectManager',
+                bus_name = SERVICE_NAME,
+                byte_arrays = True
+            ),
+            self.bus.add_signal_receiver(
+                self._interfaces_removed,
+                signal_name = 'InterfacesRemoved',
+                dbus_interface = 'org.freedesktop.DBus.ObjectManager',
+                bus_name = SERVICE_NAME
+            ),
+        ]
+
+    def stop(self):
+        for receiver in self._receivers:
+            receiver.remove()
+        self._receivers = []
+        self.flush()
+
+    def _interfaces_added(self, path, interfaces):
+        if DEVICE_INTERFACE in interfaces:
+            self.ingest(path, interfaces[DEVICE_INTERFACE])
+
+    def _interfaces_removed(self, path, interfaces):
+        if DEVICE_INTERFACE in interfaces:
+            address = address_from_path(path)
+            for key in [key for key in self.last if key[0] == address]:
+                del self.last[key]
+
+    def _properties_changed(self, interface, changed, invalidated, path = None):
+        if 'ManufacturerData' in changed or 'ServiceData' in changed:
+            self.ingest(path, changed)
+
+    def ingest(self, path, properties):
+        """
+        Collect the new payloads among the ``Device1`` ``properties`` of the device at ``path``.
+        """
+        address = address_from_path(path)
+        now = time.time()
+        payloads = [(int(company), '', data) for company, data in properties.get('ManufacturerData', {}).items()]
+        payloads += [(None, str(uuid).lower(), data) for uuid, data in properties.get('ServiceData', {}).items()]
+        for company, uuid, data in payloads:
+            record = {'address': address, 'company': company, 'uuid': uuid, 'data': bytes(data), 'time': now}
+            if not self.filter.matches(record):
+                continue
+            key = (address, company, uuid)
+            if self.last.get(key) == record['data']:
+                stats.inc('advertisements', 'duplicate')
+                continue
+            self.last[key] = record['data']
+            stats.inc('advertisements', 'new')
+            self.batch.append(record)
+
+        if self.batch and self._timeout is None:
+            self._timeout = GLib.timeout_add(int(self.interval * 1000), self._flush_timeout)
+
+    def _flush_timeout(self):
+        self._timeout = None
+        self.flush()
+        return False
+
+    def flush(self):
+        """
+        Deliver the records collected so far.
+        """
+        if self._timeout is not None:
+            GLib.source_remove(self._timeout)
+            self._timeout = None
+        batch, self.batch = self.batch, []
+        if batch:
+            self.on_batch(batch)
@@ -6,40 +6,329 @@ Agent to broker the authentication handshake between devices.
 This supports the following handshake methods:
     * pincode: a code that is displayed for the user to type into the other device
     * passkey: number that shows on both devices for the user to validate they are the same
+    * authorization: pairing or service connections initiated by the device itself
+
+Requests are answered according to an ``AgentPolicy``, straight away on headless hosts. Only
+when the policy asks for it, a UI is signalled with ``AuthorizationRequested`` and the request
+waits for it to call ``Respond``. The D-Bus policy only lets root call ``Respond``; grant the
+user running the UI access to the ``com.getwellnetwork.plc.bjarkan1.Agent1`` interface as well.
+
+The policy is configured from the environment:
+    * ``BJARKAN_AGENT_ALLOW_ADDRESSES``: comma separated device addresses to accept
+    * ``BJARKAN_AGENT_ALLOW_ICONS``: comma separated device icons to accept, e.g. ``input-keyboard``
+    * ``BJARKAN_AGENT_ALLOW_CLASSES``: comma separated major device classes to accept, e.g.
+      ``audio,peripheral``
+    * ``BJARKAN_AGENT_POLICY``: ``accept`` (everything), ``allowlist`` (the default with allow
+      rules) or ``ui`` (ask the UI for everything). Without allow rules, the requests of a
+      pairing we started are accepted, while authorizations the device initiates
+      (``RequestAuthorization`` and ``AuthorizeService``) are rejected unless ``accept`` is set
+      explicitly
+    * ``BJARKAN_AGENT_FALLBACK``: what ``allowlist`` does with other devices, ``ui`` (default) or
+      ``reject``
+    * ``BJARKAN_AGENT_PIN``: PIN code (and passkey) given to devices that ask for one, default
+      ``0000``
+    * ``BJARKAN_AGENT_UI_TIMEOUT``: seconds to wait for the UI before rejecting, default 30
 """
 
+import os
+
+import dbus
 import dbus.service
+from gi.repository import GLib
+
+from . import INTERFACE, SERVICE_NAME, DEVICE_INTERFACE
+from .logger import logger
+from .stats import stats
+
+
+#: interface of the methods and signals a UI uses to answer requests the policy defers to it
+AGENT_UI_INTERFACE = INTERFACE.rsplit('.', 1)[0] + '.Agent1'
+
+#: requests a device makes on its own rather than as part of a pairing we started
+UNSOLICITED = ('RequestAuthorization', 'AuthorizeService')
+
+#: major device classes, by the bits 8-12 of the ``Class`` property
+MAJOR_CLASSES = {
+    'computer': 1,
+    'phone': 2,
+    'network': 3,
+    'audio': 4,
+    'peripheral': 5,
+    'imaging': 6,
+    'wearable': 7,
+    'toy': 8,
+    'health': 9,
+}
+
+
+class Rejected(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.bluez.Error.Rejected'
+
+
+class Canceled(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.bluez.Error.Canceled'
+
+
+def _split(value):
+    return [item.strip() for item in (value or '').split(',') if item.strip()]
+
+
+def _passkey(value):
+    """
+    Returns:
+        int: ``value`` as a passkey
+
+    Raises:
+        ValueError: ``value`` is not a number from 0 to 999999
+    """
+    passkey = int(value)
+    if not 0 <= passkey <= 999999:
+        raise ValueError('passkey out of range: {!r}'.format(value))
+    return passkey
+
+
+class AgentPolicy:
+    """
+    Decides how the agent answers a request: ``"accept"``, ``"reject"`` or ``"ui"``.
+
+    Args:
+        addresses (list): device addresses to accept
+        icons (list): device icons to accept
+        classes (list): major device class names (see ``MAJOR_CLASSES``) to accept
+        mode (str): ``"accept"``, ``"allowlist"`` or ``"ui"``; defaults to ``"allowlist"`` when
+            there are allow rules, otherwise to ``"accept"`` for everything but the
+            ``UNSOLICITED`` requests, which are rejected
+        fallback (str): decision for devices not allowed in ``"allowlist"`` mode, ``"ui"`` or
+            ``"reject"``
+        pin (str): PIN code given to devices that ask for one
+        ui_timeout (float): seconds to wait for the UI
+    """
+
+    def __init__(self, addresses = (), icons = (), classes = (), mode = None, fallback = 'ui', pin = '0000', ui_timeout = 30):
+        self.addresses = {address.upper() for address in addresses}
+        self.icons = set(icons)
+        self.classes = set()
+        for name in classes:
+            if name not in MAJOR_CLASSES:
+                raise ValueError('unknown device class: {!r}'.format(name))
+            self.classes.add(MAJOR_CLASSES[name])
+        self.mode = mode or ('allowlist' if self.addresses or self.icons or self.classes else 'accept')
+        # unsolicited authorizations are only ever accepted wholesale when asked for explicitly
+        self.authorize = mode == 'accept'
+        if self.mode not in ('accept', 'allowlist', 'ui'):
+            raise ValueError('unknown agent policy: {!r}'.format(self.mode))
+        if fallback not in ('ui', 'reject'):
+            raise ValueError('unknown agent fallback: {!r}'.format(fallback))
+        self.fallback = fallback
+        self.pin = pin
+        self.ui_timeout = ui_timeout
+
+    @classmethod
+    def from_environment(cls):
+        return cls(
+            addresses = _split(os.environ.get('BJARKAN_AGENT_ALLOW_ADDRESSES')),
+            icons = _split(os.environ.get('BJARKAN_AGENT_ALLOW_ICONS')),
+            classes = _split(os.environ.get('BJARKAN_AGENT_ALLOW_CLASSES')),
+            mode = os.environ.get('BJARKAN_AGENT_POLICY') or None,
+            fallback = os.environ.get('BJARKAN_AGENT_FALLBACK', 'ui'),
+            pin = os.environ.get('BJARKAN_AGENT_PIN', '0000'),
+            ui_timeout = float(os.environ.get('BJARKAN_AGENT_UI_TIMEOUT', 30))
+        )
+
+    def allowed(self, properties):
+        if str(properties.get('Address', '')).upper() in self.addresses:
+            return True
+        if str(properties.get('Icon', '')) in self.icons:
+            return True
+        return (int(properties.get('Class', 0)) >> 8) & 0x1f in self.classes
+
+    def decide(self, properties, method = None):
+        """
+        Args:
+            properties (dict): ``Device1`` properties of the device asking
+            method (str): the ``org.bluez.Agent1`` request, e.g. ``"AuthorizeService"``
+
+        Returns:
+            str: ``"accept"``, ``"reject"`` or ``"ui"``
+        """
+        if self.mode == 'accept':
+            return 'accept' if self.authorize or method not in UNSOLICITED else 'reject'
+        if self.mode == 'allowlist' and self.allowed(properties):
+            return 'accept'
+        return 'ui' if self.mode == 'ui' else self.fallback
+
 
 class Agent(dbus.service.Object):
     """
     This is the code that deals with generating a PIN code if needed by the bluetooth device
     we are connecting to in order to complete the authentication handshake.
+
+    Args:
+        bus (dbus.Bus): the bus BlueZ is on
+        path (str): object path of the agent
+        policy (AgentPolicy): defaults to ``AgentPolicy.from_environment()``
+        mainloop (GLib.MainLoop): quit on ``Release`` when ``exit_on_release`` is set
     """
     AGENT_INTERFACE = 'org.bluez.Agent1'
-    exit_on_release = True
+    exit_on_release = False
+
+    def __init__(self, bus, path, policy = None, mainloop = None):
+        super().__init__(bus, path)
+        self.bus = bus
+        self.policy = policy or AgentPolicy.from_environment()
+        self.mainloop = mainloop
+        self.pending = {}
 
     def set_exit_on_release(self, exit_on_release):
         self.exit_on_release = exit_on_release
 
+    def _decide(self, device, method, detail, reply, error, accept_value = None):
+        """
+        Fetch the properties of ``device`` and answer ``method`` according to the policy: with
+        ``accept_value`` (or nothing), with ``Rejected``, or with what the UI responds.
+        """
+        def decided(properties):
+            decision = self.policy.decide(properties, method)
+            logger.info('{} from {}: {}', method, properties.get('Address', device), decision)
+            stats.inc('agent_decisions', '{}/{}'.format(method, decision))
+            if decision == 'accept' and accept_value is not None:
+                reply(accept_value)
+            elif decision == 'accept':
+                reply()
+            elif decision == 'reject':
+                error(Rejected('rejected by policy'))
+            else:
+                self._ask_ui(device, method, detail, reply, error)
+
+        def failed(e):
+            logger.warning('unable to look up {}: {}', device, e)
+            decided({})
+
+        proxy = self.bus.get_object(SERVICE_NAME, device)
+        proxy.GetAll(
+            DEVICE_INTERFACE,
+            dbus_interface = 'org.freedesktop.DBus.Properties',
+            reply_handler = decided,
+            error_handler = failed
+        )
+
+    def _ask_ui(self, device, method, detail, reply, error):
+        device = str(device)
+        self._drop(device, Canceled('superseded by a new request'))
+        timeout = GLib.timeout_add(int(self.policy.ui_timeout * 1000), self._ui_timeout, device)
+        self.pending[device] = (method, reply, error, timeout)
+        self.AuthorizationRequested(device, method, detail)
+
+    def _ui_timeout(self, device):
+        logger.info('no answer from the UI for {}, rejecting', device)
+        method, reply, error, timeout = self.pending.pop(device)
+        error(Rejected('no answer from the UI'))
+        return False
+
+    def _drop(self, device, exception):
+        pending = self.pending.pop(device, None)
+        if pending is not None:
+            method, reply, error, timeout = pending
+            GLib.source_remove(timeout)
+            error(exception)
+
     @dbus.service.method(AGENT_INTERFACE)
     def Release(self):
-        if self.exit_on_release:
-            mainloop.quit()
+        logger.info('agent released')
+        for device in list(self.pending):
+            self._drop(device, Canceled('agent released'))
+        if self.exit_on_release and self.mainloop is not None:
+            self.mainloop.quit()
+
+    @dbus.service.method(AGENT_INTERFACE, in_signature = 'o', out_signature = 's', async_callbacks = ('reply', 'error'))
+    def RequestPinCode(self, device, reply, error):
+        self._decide(device, 'RequestPinCode', '', reply, error, self.policy.pin)
 
     @dbus.service.method(AGENT_INTERFACE, in_signature = 'os')
     def DisplayPinCode(self, device, pincode):
-        print('DisplayPinCode: {}'.format(pincode))
+        logger.info('DisplayPinCode: {}', pincode)
         self.BroadcastPinCode(pincode)
 
+    @dbus.service.method(AGENT_INTERFACE, in_signature = 'o', out_signature = 'u', async_callbacks = ('reply', 'error'))
+    def RequestPasskey(self, device, reply, error):
+        self._decide(device, 'RequestPasskey', '', reply, error, dbus.UInt32(int(self.policy.pin) % 1000000))
+
     @dbus.service.method(AGENT_INTERFACE, in_signature = 'ouq')
     def DisplayPasskey(self, device, passkey, entered):
-        print('DisplayPasskey: {}'.format(passkey))
+        logger.info('DisplayPasskey: {:06d}', passkey)
         self.BroadcastPinCode(str(passkey))
 
-    @dbus.service.method(AGENT_INTERFACE, in_signature = 'ou')
-    def RequestConfirmation(self, device, passkey):
-        print('RequestConfirmation: {}'.format(passkey))
+    @dbus.service.method(AGENT_INTERFACE, in_signature = 'ou', async_callbacks = ('reply', 'error'))
+    def RequestConfirmation(self, device, passkey, reply, error):
+        passkey = '{:06d}'.format(passkey)
+        logger.info('RequestConfirmation: {}', passkey)
         self.BroadcastPasskey(passkey)
+        self._decide(device, 'RequestConfirmation', passkey, reply, error)
+
+    @dbus.service.method(AGENT_INTERFACE, in_signature = 'o', async_callbacks = ('reply', 'error'))
+    def RequestAuthorization(self, device, reply, error):
+        self._decide(device, 'RequestAuthorization', '', reply, error)
+
+    @dbus.service.method(AGENT_INTERFACE, in_signature = 'os', async_callbacks = ('reply', 'error'))
+    def AuthorizeService(self, device, uuid, reply, error):
+        self._decide(device, 'AuthorizeService', str(uuid), reply, error)
+
+    @dbus.service.method(AGENT_INTERFACE)
+    def Cancel(self):
+        logger.info('request canceled by BlueZ')
+        for device in list(self.pending):
+            self._drop(device, Canceled('canceled'))
+
+    @dbus.service.method(AGENT_UI_INTERFACE, in_signature = 'obs', out_signature = 'b')
+    def Respond(self, device, accept, value):
+        """
+        Answer a request announced with ``AuthorizationRequested``.
+
+        Args:
+            device (str): object path of the device
+            accept (bool): accept or reject the request
+            value (str): the PIN code or passkey for ``RequestPinCode`` and ``RequestPasskey``,
+                empty to use the configured one
+
+        Returns:
+            bool: ``False`` if no request of ``device`` is pending
+
+        Raises:
+            ValueError: ``value`` is not a passkey (0 to 999999) for ``RequestPasskey``; the
+                request stays pending
+        """
+        pending = self.pending.get(str(device))
+        if pending is None:
+            return False
+
+        method, reply, error, timeout = pending
+        value = str(value) or self.policy.pin
+        if accept and method == 'RequestPasskey':
+            value = _passkey(value)
+
+        del self.pending[str(device)]
+        GLib.source_remove(timeout)
+        if not accept:
+            error(Rejected('rejected by the UI'))
+        elif method == 'RequestPasskey':
+            reply(dbus.UInt32(value))
+        elif method == 'RequestPinCode':
+            reply(value)
+        else:
+            reply()
+        return True
+
+    @dbus.service.signal(AGENT_UI_INTERFACE, signature = 'oss')
+    def AuthorizationRequested(self, device, method, detail):
+        """
+        Emitted when the policy defers a request to the UI, which answers with ``Respond``.
+
+        Args:
+            device (str): object path of the device
+            method (str): the ``org.bluez.Agent1`` request, e.g. ``"RequestConfirmation"``
+            detail (str): the passkey to confirm, or the UUID of the service to authorize
+        """
+        pass
 
     @dbus.service.signal(AGENT_INTERFACE, signature = 's')
     def BroadcastPinCode(self, pincode):
@@ -48,4 +337,3 @@ class Agent(dbus.service.Object):
     @dbus.service.signal(AGENT_INTERFACE, signature = 's')
     def BroadcastPasskey(self, passkey):
         pass
-
@@ -0,0 +1,315 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+"""
+asyncio front end for bjarkan.
+
+dbus-python can only deliver replies and signals through a GLib main loop, so a single GLib loop
+runs in a background thread shared by every ``AsyncDeviceManager``. All D-Bus traffic happens on
+that thread and the results are handed back to the asyncio loop, so coroutines never block and
+any number of pair/connect/disconnect operations may be in flight at once.
+
+Examples:
+
+    ::
+
+        import asyncio
+        from bjarkan.aio import AsyncDeviceManager
+
+        async def main():
+            manager = AsyncDeviceManager()
+            results = await asyncio.gather(
+                manager.connect('00:11:22:33:44:55'),
+                manager.connect('66:77:88:99:AA:BB')
+            )
+            async for event in manager.events():
+                print(event)
+
+        asyncio.run(main())
+"""
+
+import asyncio
+import threading
+
+import dbus
+import dbus.mainloop.glib
+from gi.repository import GLib
+
+from . import DEVICE_INTERFACE, SERVICE_NAME
+from .device_manager import DeviceManager, address_from_path, to_python
+from .list_devices import gather_device_info
+from .operations import DeviceOperation
+
+
+class _GLibThread:
+    """
+    The GLib main loop thread all D-Bus calls are made from.
+    """
+
+    def __init__(self):
+        dbus.mainloop.glib.threads_init()
+        dbus.mainloop.glib.DBusGMainLoop(set_as_default = True)
+        self.mainloop = GLib.MainLoop()
+        self.thread = threading.Thread(target = self.mainloop.run, name = 'bjarkan-glib', daemon = True)
+        self.thread.start()
+
+    def submit(self, loop, func, *args):
+        """
+        Run ``func(resolve, reject, *args)`` on the GLib thread.
+
+        Returns:
+            asyncio.Future: completed once ``func`` calls ``resolve(value)`` or ``reject(exception)``
+        """
+        future = loop.create_future()
+
+        def resolve(value = None):
+            loop.call_soon_threadsafe(_complete, future, value, None)
+
+        def reject(exception):
+            loop.call_soon_threadsafe(_complete, future, None, exception)
+
+        def run():
+            try:
+                func(resolve, reject, *args)
+            except Exception as e:
+                reject(e)
+            return False
+
+        GLib.idle_add(run)
+        return future
+
+    @staticmethod
+    def guarded(reject, func):
+        """
+        Wrap a D-Bus reply handler so that an exception raised by ``func`` rejects the future
+        instead of leaving it pending forever.
+        """
+        def handler(*args):
+            try:
+                func(*args)
+            except Exception as e:
+                reject(e)
+
+        return handler
+
+    def call(self, func, *args):
+        """
+        Run ``func(*args)`` on the GLib thread without waiting for it.
+        """
+        def run():
+            func(*args)
+            return False
+
+        GLib.idle_add(run)
+
+
+def _complete(future, value, exception):
+    if future.done():
+        return
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(value)
+
+
+# queued by DeviceEvents.close() to wake up a consumer waiting for the next event
+_CLOSED = object()
+
+_glib_thread = None
+_glib_thread_lock = threading.Lock()
+
+
+def _shared_glib_thread():
+    global _glib_thread
+    with _glib_thread_lock:
+        if _glib_thread is None:
+            _glib_thread = _GLibThread()
+        return _glib_thread
+
+
+class AsyncDeviceManager:
+    """
+    Awaitable counterpart of ``DeviceManager``. Every operation returns the same
+    ``{'result': ..., 'code': ...}`` dictionaries; ``DeviceNotFound`` and ``AdapterNotFound`` are
+    raised as usual.
+
+    Operations run as ``DeviceOperation`` on the GLib thread. The device is looked up in an
+    asynchronously fetched object tree, so the GLib thread never waits on BlueZ and concurrent
+    operations do not serialize behind each other.
+
+    Args:
+        loop (asyncio.AbstractEventLoop): the loop results are delivered to, defaults to the
+            running event loop; required when created outside of a coroutine
+    """
+
+    def __init__(self, loop = None):
+        self.loop = loop or asyncio.get_running_loop()
+        self.glib = _shared_glib_thread()
+        self._device_manager = None
+
+    @property
+    def device_manager(self):
+        # only ever touched from the GLib thread
+        if self._device_manager is None:
+            self._device_manager = DeviceManager()
+        return self._device_manager
+
+    def _submit(self, func, *args):
+        return self.glib.submit(self.loop, func, *args)
+
+    def _fetch(self, then, reject):
+        # GetManagedObjects without blocking the GLib thread, ``then(objects)`` may raise
+        self.device_manager.get_managed_objects(
+            reply_handler = self.glib.guarded(reject, then),
+            error_handler = reject
+        )
+
+    def _operation(self, operation, address, steps = None):
+        def start(resolve, reject):
+            self._fetch(
+                lambda objects: DeviceOperation(self.device_manager, operation, address, resolve, agent = False, steps = steps).start(objects),
+                reject
+            )
+
+        return self._submit(start)
+
+    async def list_devices(self):
+        """
+        Returns:
+            list: the known devices, formatted like ``gather_device_info()``
+        """
+        def start(resolve, reject):
+            self._fetch(lambda objects: resolve(gather_device_info(objects)), reject)
+
+        return await self._submit(start)
+
+    async def pair(self, address, trust = True):
+        """
+        Pair with a device and, by default, mark it trusted. A pairing BlueZ stops replying to
+        is cancelled.
+
+        Returns:
+            dict: ``code`` is one of ``"Timeout"``, ``"AuthenticationError"`` or
+            ``"CreatingDeviceFailed"`` on error
+        """
+        steps = ('pair', 'trust') if trust else ('pair',)
+
+        def start(resolve, reject):
+            def registered(*args):
+                self._fetch(
+                    lambda objects: DeviceOperation(self.device_manager, 'pair', address, resolve, agent = False, steps = steps).start(objects),
+                    reject
+                )
+
+            # like DeviceManager.register_agent(), pairing is attempted even if registering failed
+            self.device_manager.register_agent(
+                reply_handler = self.glib.guarded(reject, registered),
+                error_handler = self.glib.guarded(reject, registered)
+            )
+
+        return await self._submit(start)
+
+    async def connect(self, address):
+        return await self._operation('connect', address)
+
+    async def disconnect(self, address):
+        return await self._operation('disconnect', address)
+
+    async def unpair(self, address):
+        return await self._operation('unpair', address)
+
+    def events(self):
+        """
+        Returns:
+            DeviceEvents: async iterator of device events, see ``DeviceEvents``
+        """
+        return DeviceEvents(self)
+
+
+class DeviceEvents:
+    """
+    Async iterator over BlueZ device events. Each event is a dictionary with:
+
+        * ``event``: ``"added"``, ``"removed"`` or ``"changed"``
+        * ``path``: the device object path
+        * ``address``: the device address
+        * ``properties``: the (changed) device properties, empty for ``"removed"``
+
+    Call ``close()`` (or leave an ``async with`` block) to unsubscribe; iteration then stops,
+    also for a consumer already waiting for the next event.
+    """
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.queue = asyncio.Queue()
+        self.closed = False
+        self._receivers = []
+        self._subscribed = None
+
+    def _subscribe(self, resolve, reject):
+        if self.closed:
+            return resolve()
+        bus = self.manager.device_manager.bus
+        loop = self.manager.loop
+        for member in ('InterfacesAdded', 'InterfacesRemoved', 'PropertiesChanged'):
+            self._receivers.append(bus.add_signal_receiver(
+                lambda *args, path = None, member = member: self._signal(loop, member, path, args),
+                signal_name = member,
+                bus_name = SERVICE_NAME,
+                path_keyword = 'path'
+            ))
+        resolve()
+
+    def _signal(self, loop, member, path, args):
+        event = None
+        if member == 'InterfacesAdded' and DEVICE_INTERFACE in args[1]:
+            event = ('added', args[0], args[1][DEVICE_INTERFACE])
+        elif member == 'InterfacesRemoved' and DEVICE_INTERFACE in args[1]:
+            event = ('removed', args[0], {})
+        elif member == 'PropertiesChanged' and args[0] == DEVICE_INTERFACE:
+            event = ('changed', path, args[1])
+        if event is None:
+            return
+
+        kind, device_path, properties = event
+        loop.call_soon_threadsafe(self.queue.put_nowait, {
+            'event': kind,
+            'path': str(device_path),
+            'address': address_from_path(device_path),
+            'properties': to_python(properties)
+        })
+
+    def _unsubscribe(self):
+        # on the GLib thread, after a _subscribe() that may already be queued
+        receivers, self._receivers = self._receivers, []
+        for receiver in receivers:
+            receiver.remove()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.manager.glib.call(self._unsubscribe)
+        self.manager.loop.call_soon_threadsafe(self.queue.put_nowait, _CLOSED)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.closed:
+            raise StopAsyncIteration
+        if self._subscribed is None:
+            self._subscribed = self.manager._submit(self._subscribe)
+        await self._subscribed
+        event = await self.queue.get()
+        if event is _CLOSED:
+            # leave it for any other consumer still waiting
+            self.queue.put_nowait(_CLOSED)
+            raise StopAsyncIteration
+        return event
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
@@ -1,11 +1,17 @@
 # Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
 
-from argparse import ArgumentParser
+import sys
+from argparse import ArgumentParser, ArgumentTypeError
+import dbus.bus
 from dbus.mainloop.glib import DBusGMainLoop
-from gi.repository.GObject import MainLoop
+from gi.repository import GLib
 
-from .device_manager import DeviceManager
-from .list_devices import connected_devices, paired_devices, all_devices
+from . import BUSNAME
+from .advertisements import record_json
+from .client import BjarkanClient
+from .monitor import DeviceMonitor
+from .provision import Provisioner, read_manifest
+from .trace import TraceRecorder, TraceReplayer, read_trace
 
 
 def format_device_data(devices):
@@ -41,150 +47,433 @@ def format_results(results):
     Returns:
         results (dict): structured data of the return codes and messages
     """
-    print('result: {}, code: {}'.format(results['result'], results['code']))
+    line = 'result: {}, code: {}'.format(results['result'], results['code'])
+    phases = results.get('phases')
+    if phases:
+        line += ', phases: {}'.format(' '.join('{}={:.1f}ms'.format(phase, ms) for phase, ms in phases.items()))
+    print(line)
 
 
-def pair(args):
+def format_batch_results(results):
+    """
+    Formats the per device results of a batch command.
+
+    Args:
+        results (list): ``(address, result, code)`` tuples
+    """
+    for address, result, code in results:
+        print('{} result: {}, code: {}'.format(address, result, code))
+
+
+def device_addresses(args):
+    """
+    Collect the devices given with ``-d`` and ``--from-file`` (one address per line, ``#``
+    comments allowed).
+
+    Returns:
+        list: the addresses, in the order given
+    """
+    addresses = list(args.device or ())
+    if args.from_file:
+        with open(args.from_file) as f:
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    addresses.append(line)
+    if not addresses:
+        raise SystemExit('no device given, use -d or --from-file')
+
+    return addresses
+
+
+def pair(client, args):
     """
     Pair to the specified device
 
     Args:
+        client (BjarkanClient): client used to talk to BlueZ or bjarkan-service
+        args (dict): args parsed on the command line
+
+    Returns:
+        results (dict): return message and code of the operation
+    """
+    if args.nearest:
+        results = client.pair_nearest(args.icon, args.min_rssi, args.duration, args.timeout)
+        if results['address']:
+            print('nearest device: {}'.format(results['address']))
+        return format_results(results)
+    if not args.device:
+        raise SystemExit('no device given, use -d or --nearest')
+    return format_results(client.pair(args.device, args.timeout))
+
+
+def pair_connect(client, args):
+    """
+    Pair, trust and connect the specified device in one pipelined workflow
+
+    Args:
+        client (BjarkanClient): client used to talk to BlueZ or bjarkan-service
         args (dict): args parsed on the command line
 
     Returns:
         results (dict): return message and code of the operation
     """
-    def success():
-        try:
-            device_manager.trust_device()
-            device_manager.connect_device()
-            format_results({'result': 'Success', 'code': ''})
-        finally:
-            mainloop.quit()
-
-    def error(err):
-        try:
-            if err == 'org.freedesktop.DBus.Error.NoReply' and self.dev:
-                code = 'Timeout'
-                device_manager.cancel_device()
-            if err in ('org.bluez.Error.AuthenticationCanceled', 'org.bluez.Error.AuthenticationFailed',
-                    'org.bluez.Error.AuthenticationRejected', 'org.bluez.Error.AuthenticationTimeout'):
-                code = 'AuthenticationError'
-            else:
-                code = 'CreatingDeviceFailed'
-
-            format_results({'result': 'Error', 'code': code})
-        finally:
-            mainloop.quit()
-
-    mainloop = MainLoop()
-    device_manager = DeviceManager(args.device)
-    device_manager.pair_device(success, error)
-    mainloop.run()
-
-
-def unpair(args):
+    results = client.pair_and_connect(args.device, args.uuid or ())
+    if results.get('step'):
+        results['code'] = '{} ({})'.format(results['code'], results['step'])
+    return format_results(results)
+
+
+def unpair(client, args):
     """
     Unpair from the specified device
 
     Args:
+        client (BjarkanClient): client used to talk to BlueZ or bjarkan-service
         args (dict): args parsed on the command line
 
     Returns:
         results (dict): return message and code of the operation
     """
-    device_manager = DeviceManager(args.device)
-    return format_results(device_manager.unpair_device())
+    addresses = device_addresses(args)
+    if len(addresses) == 1:
+        return format_results(client.unpair(addresses[0], args.timeout))
+    return format_batch_results(client.unpair_many(addresses))
 
 
-def connect(args):
+def connect(client, args):
     """
     Connect to the specified device after pairing has already been authenticated
 
     Args:
+        client (BjarkanClient): client used to talk to BlueZ or bjarkan-service
         args (dict): args parsed on the command line
 
     Returns:
         results (dict): return message and code of the operation
     """
-    device_manager = DeviceManager(args.device)
-    return format_results(device_manager.connect_device())
+    addresses = device_addresses(args)
+    if len(addresses) == 1:
+        return format_results(client.connect(addresses[0], args.timeout))
+    return format_batch_results(client.connect_many(addresses))
 
 
-def disconnect(args):
+def disconnect(client, args):
     """
     Disconnect from the specified device
 
     Args:
+        client (BjarkanClient): client used to talk to BlueZ or bjarkan-service
         args (dict): args parsed on the command line
 
     Returns:
         results (dict): return message and code of the operation
     """
-    device_manager = DeviceManager(args.device)
-    return format_results(device_manager.disconnect_device())
+    addresses = device_addresses(args)
+    if len(addresses) == 1:
+        return format_results(client.disconnect(addresses[0], args.timeout))
+    return format_batch_results(client.disconnect_many(addresses))
 
 
-def connected(args):
+def connected(client, args):
     """
     List the currently connected devices
 
     Args:
+        client (BjarkanClient): client used to talk to BlueZ or bjarkan-service
         args (dict): args parsed on the command line
 
     Returns:
         results (dict): return formatted data listing the currently connected devices
     """
-    return format_device_data(connected_devices())
+    return format_device_data(client.connected_devices())
 
 
-def paired(args):
+def paired(client, args):
     """
     List the currently paired devices
 
     Args:
+        client (BjarkanClient): client used to talk to BlueZ or bjarkan-service
         args (dict): args parsed on the command line
 
     Returns:
         results (dict): return formatted data listing the currently paired devices
     """
-    return format_device_data(paired_devices())
+    return format_device_data(client.paired_devices())
 
 
-def scan(args):
+def scan(client, args):
     """
     List the devices shown in the scan
 
     Args:
+        client (BjarkanClient): client used to talk to BlueZ or bjarkan-service
         args (dict): args parsed on the command line
 
     Returns:
         results (dict): return formatted data listing the devices found during the scan
     """
-    return format_device_data(all_devices())
+    return format_device_data(client.scan())
+
+
+def positive_float(text):
+    """
+    ``argparse`` type of options that must be a number above zero.
+    """
+    try:
+        value = float(text)
+    except ValueError:
+        raise ArgumentTypeError('not a number: {!r}'.format(text))
+    if not value > 0:
+        raise ArgumentTypeError('must be above zero: {!r}'.format(text))
+    return value
+
+
+def parse_value(text):
+    """
+    Interpret a property value given on the command line: ``true``/``false`` become booleans,
+    numbers integers, anything else stays a string.
+    """
+    if text.lower() in ('true', 'false'):
+        return text.lower() == 'true'
+    try:
+        return int(text)
+    except ValueError:
+        return text
+
+
+def wait(client, args):
+    """
+    Wait until a property of the specified device has the given value
+
+    Args:
+        client (BjarkanClient): client used to talk to BlueZ or bjarkan-service
+        args (dict): args parsed on the command line
+
+    Returns:
+        int: ``1`` when the value was not reached
+    """
+    results = client.wait_for_state(args.device, args.property, parse_value(args.value), args.timeout)
+    format_results(results)
+    return 1 if results['code'] else 0
+
+
+def provision(client, args):
+    """
+    Pair, trust and connect every device of a provisioning manifest
+
+    Args:
+        client (BjarkanClient): client used to talk to BlueZ or bjarkan-service
+        args (dict): args parsed on the command line
+
+    Returns:
+        int: ``1`` when any device failed, ``2`` when the manifest is invalid
+    """
+    try:
+        devices = read_manifest(args.manifest)
+    except ValueError as e:
+        print(e, file = sys.stderr)
+        return 2
+
+    provisioner = Provisioner(
+        client.device_manager,
+        devices,
+        args.state or args.manifest + '.state',
+        per_adapter = args.parallel,
+        scan = args.scan,
+        output = print
+    )
+    summary = provisioner.run()
+    print('{total} devices: {succeeded} provisioned, {failed} failed, {skipped} already done; {seconds}s, {per_minute} devices/min'.format(**summary))
+    for code, count in sorted(summary['failures'].items()):
+        print('  {}: {}'.format(code, count))
+    return 1 if summary['failed'] else 0
+
+
+def adverts(client, args):
+    """
+    Print new advertisement payloads as JSON Lines, until interrupted
+
+    Args:
+        client (BjarkanClient): client used to talk to BlueZ or bjarkan-service
+        args (dict): args parsed on the command line
+    """
+    def print_batch(records):
+        for record in records:
+            print(record_json(record))
+        sys.stdout.flush()
+
+    try:
+        client.advertisements(print_batch, args.company or (), args.uuid or (), args.duration, args.interval)
+    except KeyboardInterrupt:
+        pass
+
+
+def format_value(value):
+    """
+    Returns:
+        str: ``value`` hex encoded, followed by its text when it is printable UTF-8
+    """
+    try:
+        text = value.decode()
+    except UnicodeDecodeError:
+        text = ''
+    if text and text.isprintable():
+        return '{} "{}"'.format(value.hex(), text)
+    return value.hex()
+
+
+def read(client, args):
+    """
+    Read GATT characteristics of one or more connected devices
+
+    Args:
+        client (BjarkanClient): client used to talk to BlueZ or bjarkan-service
+        args (dict): args parsed on the command line
+    """
+    requests = [(address, uuid) for address in device_addresses(args) for uuid in args.uuid]
+    for address, uuid, result, code, value in client.read_characteristics(requests):
+        if code:
+            print('{} {} result: {}, code: {}'.format(address, uuid, result, code))
+        else:
+            print('{} {} {}'.format(address, uuid, format_value(value)))
+
+
+def export(client, args):
+    """
+    Dump the full device table, every property included
+
+    Args:
+        client (BjarkanClient): client used to talk to BlueZ or bjarkan-service
+        args (dict): args parsed on the command line
+    """
+    if args.output:
+        with open(args.output, 'wb') as output:
+            client.export(output, args.format)
+    else:
+        client.export(sys.stdout, args.format)
+
+
+def monitor(client, args):
+    """
+    Print device state transitions as they happen, until interrupted
+
+    Args:
+        client (BjarkanClient): client used to talk to BlueZ or bjarkan-service
+        args (dict): args parsed on the command line
+    """
+    device_monitor = DeviceMonitor(
+        client.device_manager,
+        addresses = args.device,
+        adapter = args.adapter,
+        rssi_threshold = None if args.rssi_threshold < 0 else args.rssi_threshold,
+        json_lines = args.json_lines
+    )
+    device_monitor.start()
+    try:
+        GLib.MainLoop().run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        device_monitor.stop()
+
+
+def record(client, args):
+    """
+    Record the BlueZ traffic of bjarkan-service to a trace file, until interrupted
+
+    Args:
+        client (BjarkanClient): client used to talk to BlueZ or bjarkan-service
+        args (dict): args parsed on the command line
+    """
+    recorder = TraceRecorder(args.output)
+    mainloop = GLib.MainLoop()
+    recorder.start()
+    if args.duration:
+        GLib.timeout_add_seconds(args.duration, mainloop.quit)
+    try:
+        mainloop.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        recorder.stop()
+    print('{signals} signals, {replies} replies, {errors} errors recorded'.format(**recorder.counts))
+
+
+def replay(client, args):
+    """
+    Serve a recorded trace as org.bluez on a private bus
+
+    Args:
+        client (BjarkanClient): client used to talk to BlueZ or bjarkan-service
+        args (dict): args parsed on the command line
+    """
+    header, records = read_trace(args.trace)
+    mainloop = GLib.MainLoop()
+
+    def done():
+        GLib.timeout_add_seconds(args.linger, mainloop.quit)
+
+    def owner_changed(owner):
+        if owner:
+            replayer.play()
+
+    bus = dbus.bus.BusConnection(args.bus)
+    replayer = TraceReplayer(bus, records, args.speed, done)
+    replayer.start()
+    if args.now:
+        replayer.play()
+    else:
+        bus.watch_name_owner(BUSNAME, owner_changed)
+    try:
+        mainloop.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        replayer.stop()
+    print('{signals} signals replayed, {replies} calls answered, {unmatched} calls not in the trace'.format(**replayer.counts))
+    return 1 if replayer.counts['unmatched'] else 0
 
 
 def main():
     DBusGMainLoop(set_as_default = True)
 
     parser = ArgumentParser(description = 'Connect to specifed BT device')
+    parser.add_argument('-s', '--service', action = 'store_true', help = 'Go through bjarkan-service instead of talking to BlueZ directly')
     subparsers = parser.add_subparsers(metavar = 'COMMAND')
     subparsers.required = True
 
     pair_parser = subparsers.add_parser('pair', help = 'Pair a device (pairing will also connect)')
-    pair_parser.add_argument('-d', '--device', required = True, help = 'Specify the device to pair')
+    pair_parser.add_argument('-d', '--device', help = 'Specify the device to pair')
+    pair_parser.add_argument('--nearest', action = 'store_true', help = 'Pair the unpaired device with the strongest signal instead')
+    pair_parser.add_argument('--icon', help = 'With --nearest, only consider devices with this icon, e.g. input-keyboard')
+    pair_parser.add_argument('--min-rssi', type = int, help = 'With --nearest, only consider devices averaging at least this RSSI')
+    pair_parser.add_argument('--duration', type = float, default = 10, help = 'With --nearest, discover for at most this many seconds (default: 10)')
+    pair_parser.add_argument('-t', '--timeout', type = float, help = 'Give up (and cancel pairing) after this many seconds')
     pair_parser.set_defaults(func = pair)
 
+    pair_connect_parser = subparsers.add_parser('pair-connect', help = 'Pair, trust and connect a device in one go')
+    pair_connect_parser.add_argument('-d', '--device', required = True, help = 'Specify the device to pair')
+    pair_connect_parser.add_argument('-u', '--uuid', action = 'append', help = 'Only connect this profile UUID (may be repeated)')
+    pair_connect_parser.set_defaults(func = pair_connect)
+
     unpair_parser = subparsers.add_parser('unpair', help = 'Unpair a device')
-    unpair_parser.add_argument('-d', '--device', required = True, help = 'Specify the device to unpair')
+    unpair_parser.add_argument('-d', '--device', action = 'append', help = 'Specify the device to unpair (may be repeated)')
+    unpair_parser.add_argument('--from-file', help = 'Also unpair the devices listed in this file, one address per line')
+    unpair_parser.add_argument('-t', '--timeout', type = float, help = 'Give up after this many seconds (single device only)')
     unpair_parser.set_defaults(func = unpair)
 
     connect_parser = subparsers.add_parser('connect', help = 'Connect a new device')
-    connect_parser.add_argument('-d', '--device', required = True, help = 'Specify the device to connect to')
+    connect_parser.add_argument('-d', '--device', action = 'append', help = 'Specify the device to connect to (may be repeated)')
+    connect_parser.add_argument('--from-file', help = 'Also connect to the devices listed in this file, one address per line')
+    connect_parser.add_argument('-t', '--timeout', type = float, help = 'Give up after this many seconds (single device only)')
     connect_parser.set_defaults(func = connect)
 
     disconnect_parser = subparsers.add_parser('disconnect', help = 'Disconnect a device')
-    disconnect_parser.add_argument('-d', '--device', required = True, help = 'Specify the device to disconnect from')
+    disconnect_parser.add_argument('-d', '--device', action = 'append', help = 'Specify the device to disconnect from (may be repeated)')
+    disconnect_parser.add_argument('--from-file', help = 'Also disconnect from the devices listed in this file, one address per line')
+    disconnect_parser.add_argument('-t', '--timeout', type = float, help = 'Give up after this many seconds (single device only)')
     disconnect_parser.set_defaults(func = disconnect)
 
     paired_parser = subparsers.add_parser('paired-devices', help = 'Show all paired devices')
@@ -196,9 +485,62 @@ def main():
     list_parser = subparsers.add_parser('scan', help = 'Show all currently known devices')
     list_parser.set_defaults(func = scan)
 
+    read_parser = subparsers.add_parser('read', help = 'Read GATT characteristics of connected devices')
+    read_parser.add_argument('-d', '--device', action = 'append', help = 'Specify the device to read from (may be repeated)')
+    read_parser.add_argument('--from-file', help = 'Also read from the devices listed in this file, one address per line')
+    read_parser.add_argument('-u', '--uuid', action = 'append', required = True, help = 'Characteristic UUID to read, e.g. 2a19 (may be repeated)')
+    read_parser.set_defaults(func = read)
+
+    wait_parser = subparsers.add_parser('wait', help = 'Wait until a device property has a value, e.g. Connected is true')
+    wait_parser.add_argument('-d', '--device', required = True, help = 'Specify the device to wait for')
+    wait_parser.add_argument('-p', '--property', default = 'Connected', help = 'Device property to watch (default: Connected)')
+    wait_parser.add_argument('-v', '--value', default = 'true', help = 'Value to wait for (default: true)')
+    wait_parser.add_argument('-t', '--timeout', type = float, default = 30, help = 'Give up after this many seconds, 0 to only check (default: 30)')
+    wait_parser.set_defaults(func = wait)
+
+    provision_parser = subparsers.add_parser('provision', help = 'Pair, trust and connect every device of a manifest')
+    provision_parser.add_argument('manifest', help = 'CSV file with the device address and optionally the adapter per line')
+    provision_parser.add_argument('--state', help = 'Progress file, devices done in an earlier run are skipped (default: MANIFEST.state)')
+    provision_parser.add_argument('-p', '--parallel', type = int, default = 1, help = 'Devices paired at once on each adapter (default: 1)')
+    provision_parser.add_argument('--scan', type = int, default = 0, help = 'Discover unknown devices for up to this many seconds first (default: 0)')
+    provision_parser.set_defaults(func = provision)
+
+    adverts_parser = subparsers.add_parser('adverts', help = 'Stream manufacturer and service data of advertising devices as JSON Lines')
+    adverts_parser.add_argument('-c', '--company', action = 'append', help = 'Only show manufacturer data of this company id, e.g. 0x004c (may be repeated)')
+    adverts_parser.add_argument('-u', '--uuid', action = 'append', help = 'Only show service data of this service UUID (may be repeated)')
+    adverts_parser.add_argument('--duration', type = int, help = 'Stop after this many seconds')
+    adverts_parser.add_argument('--interval', type = float, default = 1.0, help = 'Seconds to batch payloads for (default: 1)')
+    adverts_parser.set_defaults(func = adverts)
+
+    export_parser = subparsers.add_parser('export', help = 'Dump every known device with all of its properties')
+    export_parser.add_argument('-f', '--format', choices = ('jsonl', 'binary'), default = 'jsonl', help = 'Output format (default: jsonl)')
+    export_parser.add_argument('-o', '--output', help = 'Write to this file instead of stdout')
+    export_parser.set_defaults(func = export)
+
+    record_parser = subparsers.add_parser('record', help = 'Record the BlueZ signals and replies bjarkan-service receives (needs root)')
+    record_parser.add_argument('-o', '--output', required = True, help = 'Trace file to write, gzip compressed JSON Lines')
+    record_parser.add_argument('--duration', type = int, help = 'Stop after this many seconds')
+    record_parser.set_defaults(func = record)
+
+    replay_parser = subparsers.add_parser('replay', help = 'Serve a recorded trace as org.bluez on a private bus')
+    replay_parser.add_argument('trace', help = 'Trace file written by record')
+    replay_parser.add_argument('-b', '--bus', required = True, help = 'Address of the bus to serve on, e.g. the one printed by dbus-daemon --print-address')
+    replay_parser.add_argument('--speed', type = positive_float, default = 1.0, help = 'Replay this many times faster than recorded (default: 1)')
+    replay_parser.add_argument('--linger', type = int, default = 5, help = 'Keep answering calls for this many seconds after the last signal (default: 5)')
+    replay_parser.add_argument('--now', action = 'store_true', help = 'Start playing right away instead of once bjarkan-service is on the bus')
+    replay_parser.set_defaults(func = replay)
+
+    monitor_parser = subparsers.add_parser('monitor', help = 'Print device state transitions as they happen')
+    monitor_parser.add_argument('-d', '--device', action = 'append', help = 'Only show this device (may be repeated)')
+    monitor_parser.add_argument('-a', '--adapter', help = 'Only show devices of this adapter, e.g. hci0')
+    monitor_parser.add_argument('--rssi-threshold', type = int, default = 10, help = 'Show RSSI changes of at least this many dBm, -1 to hide them (default: 10)')
+    monitor_parser.add_argument('--json-lines', action = 'store_true', help = 'Print one JSON object per event')
+    monitor_parser.set_defaults(func = monitor)
+
     args = parser.parse_args()
 
-    result = args.func(args)
+    client = BjarkanClient(service = args.service)
+    result = args.func(client, args)
     if result:
         return result
 
@@ -0,0 +1,507 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+"""
+Library API for applications that embed bjarkan.
+
+A ``BjarkanClient`` owns one system bus connection and one set of proxies that are reused for
+every call, so repeated operations do not pay the connection and introspection setup again. It
+either talks to BlueZ directly or goes through ``bjarkan-service``.
+
+Examples:
+
+    ::
+
+        from dbus.mainloop.glib import DBusGMainLoop
+        from bjarkan.client import BjarkanClient
+
+        DBusGMainLoop(set_as_default = True)
+        client = BjarkanClient()
+        for device in client.paired_devices():
+            print(device['address'], client.connect(device['address']))
+
+Notes:
+
+    * a GLib main loop integration must be the default (``DBusGMainLoop(set_as_default = True)``)
+      before the client is created; ``pair()`` and ``scan()`` run a main loop until they finish
+"""
+
+import time
+
+import dbus
+from gi.repository import GLib
+
+from . import BUSNAME, OBJECTPATH, INTERFACE, DEVICE_INTERFACE, SERVICE_NAME, DeviceNotFound
+from .advertisements import AdvertisementFeed, AdvertisementFilter
+from .device_manager import DeviceManager, pairing_error_code, to_python
+from .nearest import NearestDevice
+from .operations import DeviceOperation, CALL_MARGIN
+from .list_devices import DeviceRecord, device_records, gather_device_info
+from .snapshot import encode_snapshot, write_chunks
+from .stats import stats, Timeline
+
+
+class BjarkanClient:
+    """
+    Args:
+        service (bool): go through ``bjarkan-service`` instead of talking to BlueZ directly
+        bus (dbus.Bus): the connection to use, defaults to a new system bus connection
+    """
+
+    def __init__(self, service = False, bus = None):
+        self.bus = bus or dbus.SystemBus()
+        self.service = service
+        self.manager = dbus.Interface(self.bus.get_object(BUSNAME, OBJECTPATH), INTERFACE) if service else None
+        self._device_manager = None
+
+    @property
+    def device_manager(self):
+        """
+        The ``DeviceManager`` used to talk to BlueZ; also available with ``service = True`` for
+        things only BlueZ provides, such as its signals.
+        """
+        if self._device_manager is None:
+            self._device_manager = DeviceManager(self.bus)
+        return self._device_manager
+
+    def _run(self, start, timeout = None):
+        """
+        Run a main loop until ``start(done)`` calls ``done(value)``, then return that value.
+        """
+        mainloop = GLib.MainLoop()
+        outcome = {}
+
+        def done(value = None):
+            outcome['value'] = value
+            mainloop.quit()
+
+        start(done)
+        if 'value' not in outcome:
+            if timeout is not None:
+                GLib.timeout_add_seconds(timeout, done)
+            mainloop.run()
+
+        return outcome['value']
+
+    def devices(self):
+        """
+        Returns:
+            list: every device BlueZ knows about, see ``gather_device_info()``
+        """
+        if self.service:
+            return to_python(self.manager.GetScannedDevices())
+        return gather_device_info(self.device_manager.get_managed_objects())
+
+    def connected_devices(self):
+        if self.service:
+            return to_python(self.manager.Connected())
+        return [device for device in self.devices() if device['connected']]
+
+    def paired_devices(self):
+        if self.service:
+            return to_python(self.manager.Paired())
+        return [device for device in self.devices() if device['paired']]
+
+    def records(self, which = 'all'):
+        """
+        Args:
+            which (str): ``"all"``, ``"paired"`` or ``"connected"``
+
+        Returns:
+            list: ``DeviceRecord`` tuples, the cheapest way to list many devices
+        """
+        if self.service:
+            return [DeviceRecord(*to_python(record)) for record in self.manager.ListDevices(which)]
+        return device_records(self.device_manager.get_managed_objects(), which)
+
+    def scan(self, duration = 10):
+        """
+        Discover devices for ``duration`` seconds.
+
+        Returns:
+            list: every device BlueZ knows about after the scan
+        """
+        if self.service:
+            self.manager.StartDiscovery()
+            self._run(lambda done: GLib.timeout_add_seconds(duration, done))
+            return self.devices()
+
+        adapter = self.device_manager.find_adapter()
+        stats.bluez_call('StartDiscovery')
+        adapter.StartDiscovery()
+        try:
+            self._run(lambda done: GLib.timeout_add_seconds(duration, done))
+        finally:
+            try:
+                adapter.StopDiscovery()
+            except dbus.exceptions.DBusException:
+                pass
+
+        return self.devices()
+
+    def pair(self, address, timeout = None):
+        """
+        Pair, trust and connect a device. Blocks until pairing completes.
+
+        Args:
+            address (str): address of the device
+            timeout (float): seconds after which pairing (or connecting) is aborted and
+                ``"Timeout"`` returned
+
+        Returns:
+            dict: ``result`` and ``code`` of the operation, and ``phases``: the milliseconds
+            spent in each of its phases
+        """
+        if timeout is not None:
+            return self._with_deadline('pair', address, timeout)
+        if self.service:
+            return self._pair_via_service(address)
+
+        timeline = Timeline('Pair')
+
+        def start(done):
+            def success():
+                timeline.mark('pair')
+                self.device_manager.trust_device(address, timeline)
+                self.device_manager.connect_device(address, timeline)
+                done({'result': 'Success', 'code': '', 'phases': timeline.as_dict()})
+
+            def error(e):
+                timeline.mark('pair')
+                name = e.get_dbus_name() if isinstance(e, dbus.exceptions.DBusException) else ''
+                code = pairing_error_code(name)
+                if code == 'Timeout':
+                    self.device_manager.cancel_device(address)
+                    timeline.mark('cancel')
+                done({'result': 'Error', 'code': code, 'phases': timeline.as_dict()})
+
+            self.device_manager.pair_device(address, success, error, timeline)
+
+        return self._run(start)
+
+    def _pair_via_service(self, address):
+        def start(done):
+            def complete(payload):
+                payload = to_python(payload)
+                # the signal is broadcast, only take the one for our device
+                if payload.get('address', '').upper() != address.upper():
+                    return
+                receiver.remove()
+                results = {'phases': {}}
+                for key, value in payload.items():
+                    if key == 'address':
+                        continue
+                    if key.startswith('phase.'):
+                        results['phases'][key[len('phase.'):]] = float(value)
+                    else:
+                        results[key] = value
+                done(results)
+
+            receiver = self.bus.add_signal_receiver(
+                complete,
+                signal_name = 'PairingComplete',
+                dbus_interface = INTERFACE,
+                bus_name = BUSNAME
+            )
+            self.manager.Pair(address)
+
+        return self._run(start)
+
+    def pair_and_connect(self, address, uuids = ()):
+        """
+        Pair, trust and connect a device in one pipelined workflow that resolves the device once.
+        Blocks until the workflow completes.
+
+        Args:
+            address (str): address of the device
+            uuids (list): connect only these profiles (``ConnectProfile``)
+
+        Returns:
+            dict: ``result``, ``code``, the failed ``step`` on error and ``phases``
+        """
+        if self.service:
+            return to_python(self.manager.PairAndConnect(address, dbus.Array(uuids, signature = 's'), timeout = 120))
+
+        timeline = Timeline('PairAndConnect')
+
+        def start(done):
+            def finished(results):
+                results['phases'] = timeline.as_dict()
+                done(results)
+
+            self.device_manager.pair_and_connect(address, finished, uuids, timeline)
+
+        return self._run(start)
+
+    def pair_nearest(self, icon = None, min_rssi = None, duration = 10, timeout = None):
+        """
+        Discover for up to ``duration`` seconds, then pair, trust and connect the unpaired
+        device with the strongest averaged signal.
+
+        Args:
+            icon (str): only consider devices with this icon, e.g. ``input-keyboard``
+            min_rssi (int): only consider devices averaging at least this RSSI
+            timeout (float): seconds after which pairing the picked device is aborted and
+                ``"Timeout"`` returned
+
+        Returns:
+            dict: ``result``, ``code`` (``"NoDeviceFound"`` when nothing qualified), the
+            ``address`` picked and, once pairing was attempted, its ``phases``
+        """
+        if self.service:
+            options = {'duration': dbus.Double(duration)}
+            if icon:
+                options['icon'] = icon
+            if min_rssi is not None:
+                options['min_rssi'] = dbus.Int16(min_rssi)
+            call_timeout = duration + 120
+            if timeout is not None:
+                options['timeout'] = dbus.Double(timeout)
+                call_timeout = duration + timeout + CALL_MARGIN
+            return to_python(self.manager.PairNearest(dbus.Dictionary(options, signature = 'sv'), timeout = call_timeout))
+
+        finder = NearestDevice(self.device_manager, icon = icon, min_rssi = min_rssi, duration = duration)
+        address = self._run(finder.start)
+        if address is None:
+            return {'result': 'Error', 'code': 'NoDeviceFound', 'address': ''}
+
+        timeline = Timeline('PairNearest')
+
+        def start(done):
+            def finished(results):
+                results['phases'] = timeline.as_dict()
+                done(results)
+
+            self.device_manager.pair_and_connect(address, finished, timeline = timeline, timeout = timeout)
+
+        results = self._run(start)
+        results['address'] = address
+        return results
+
+    def _timed(self, operation, method, address):
+        timeline = Timeline(operation)
+        results = method(address, timeline)
+        results['phases'] = timeline.as_dict()
+        return results
+
+    def _with_deadline(self, operation, address, timeout):
+        if self.service:
+            method = getattr(self.manager, operation.capitalize() + 'WithOptions')
+            options = dbus.Dictionary({'timeout': dbus.Double(timeout)}, signature = 'sv')
+            results = to_python(method(address, options, timeout = timeout + CALL_MARGIN))
+            results.pop('operation_id', None)
+            return results
+
+        timeline = Timeline(operation.capitalize())
+
+        def start(done):
+            def finished(results):
+                results['phases'] = timeline.as_dict()
+                done(results)
+
+            DeviceOperation(self.device_manager, operation, address, finished, timeout, timeline).start()
+
+        return self._run(start)
+
+    def unpair(self, address, timeout = None):
+        """
+        All of ``unpair``, ``connect`` and ``disconnect`` take an optional ``timeout`` in
+        seconds, after which the operation is aborted and ``"Timeout"`` returned.
+        """
+        if timeout is not None:
+            return self._with_deadline('unpair', address, timeout)
+        if self.service:
+            return to_python(self.manager.Unpair(address))
+        return self._timed('Unpair', self.device_manager.unpair_device, address)
+
+    def connect(self, address, timeout = None):
+        if timeout is not None:
+            return self._with_deadline('connect', address, timeout)
+        if self.service:
+            return to_python(self.manager.Connect(address))
+        return self._timed('Connect', self.device_manager.connect_device, address)
+
+    def disconnect(self, address, timeout = None):
+        if timeout is not None:
+            return self._with_deadline('disconnect', address, timeout)
+        if self.service:
+            return to_python(self.manager.Disconnect(address))
+        return self._timed('Disconnect', self.device_manager.disconnect_device, address)
+
+    def advertisements(self, on_batch, companies = (), uuids = (), duration = None, interval = 1.0):
+        """
+        Discover and deliver new ``ManufacturerData``/``ServiceData`` payloads, see
+        ``bjarkan.advertisements``. Blocks for ``duration`` seconds, or until interrupted.
+
+        Args:
+            on_batch (callable): called with each batch of records
+            companies (list): only keep manufacturer data of these company identifiers
+            uuids (list): only keep service data of these service UUIDs
+        """
+        record_filter = AdvertisementFilter(companies, uuids)
+        if self.service:
+            def received(records):
+                batch = []
+                for address, uuid, company, data in records:
+                    record = {
+                        'address': str(address),
+                        'company': None if uuid else int(company),
+                        'uuid': str(uuid),
+                        'data': bytes(data),
+                        'time': time.time()
+                    }
+                    if record_filter.matches(record):
+                        batch.append(record)
+                if batch:
+                    on_batch(batch)
+
+            receiver = self.bus.add_signal_receiver(
+                received,
+                signal_name = 'Advertisements',
+                dbus_interface = INTERFACE,
+                bus_name = BUSNAME,
+                byte_arrays = True
+            )
+            filters = {
+                'companies': dbus.Array(sorted(record_filter.companies), signature = 'q'),
+                'uuids': dbus.Array(sorted(record_filter.uuids), signature = 's'),
+            }
+            self.manager.SubscribeAdvertisements(dbus.Dictionary(filters, signature = 'sv'))
+            self.manager.StartDiscovery()
+            try:
+                self._run(lambda done: None, duration)
+            finally:
+                receiver.remove()
+                self.manager.UnsubscribeAdvertisements()
+                self.manager.StopDiscovery()
+            return
+
+        feed = AdvertisementFeed(self.bus, on_batch, record_filter, interval)
+        feed.start()
+        adapter = self.device_manager.find_adapter()
+        stats.bluez_call('StartDiscovery')
+        adapter.StartDiscovery()
+        try:
+            self._run(lambda done: None, duration)
+        finally:
+            feed.stop()
+            try:
+                adapter.StopDiscovery()
+            except dbus.exceptions.DBusException:
+                pass
+
+    def wait_for_state(self, address, name, value, timeout = 30):
+        """
+        Block until property ``name`` of a device equals ``value``, e.g. until ``Connected`` is
+        ``True``. Driven by BlueZ signals, nothing is polled.
+
+        Args:
+            address (str): address of the device
+            name (str): the ``Device1`` property
+            value: the value to wait for
+            timeout (float): give up after this many seconds, ``0`` to only check the current
+                value
+
+        Returns:
+            dict: ``result`` and ``code``: ``"Timeout"`` or ``"DeviceNotFound"`` on error
+        """
+        if self.service:
+            return to_python(self.manager.WaitForState(address, name, value, dbus.UInt32(int(timeout * 1000)), timeout = timeout + 5))
+
+        def start(done):
+            state = {'path': None, 'timeout': None}
+
+            def finished(code = ''):
+                receiver.remove()
+                if state['timeout'] is not None:
+                    GLib.source_remove(state['timeout'])
+                done({'result': 'Error' if code else 'Success', 'code': code})
+
+            def changed(interface, properties, invalidated, path = None):
+                if path == state['path'] and name in properties and to_python(properties[name]) == value:
+                    finished()
+
+            # subscribed before the state is fetched; signals are only dispatched once the main
+            # loop runs, so no change is lost in between
+            receiver = self.bus.add_signal_receiver(
+                changed,
+                signal_name = 'PropertiesChanged',
+                dbus_interface = 'org.freedesktop.DBus.Properties',
+                bus_name = SERVICE_NAME,
+                arg0 = DEVICE_INTERFACE,
+                path_keyword = 'path'
+            )
+            objects = self.device_manager.get_managed_objects()
+            try:
+                state['path'] = self.device_manager.find_device_in_objects(address, objects).object_path
+            except DeviceNotFound:
+                return finished('DeviceNotFound')
+            if to_python(objects[state['path']][DEVICE_INTERFACE].get(name)) == value:
+                return finished()
+            if not timeout:
+                return finished('Timeout')
+
+            def expired():
+                state['timeout'] = None
+                finished('Timeout')
+                return False
+
+            state['timeout'] = GLib.timeout_add(int(timeout * 1000), expired)
+
+        return self._run(start)
+
+    def _many(self, operation, addresses):
+        if self.service:
+            method = getattr(self.manager, operation.capitalize() + 'Many')
+            return [tuple(to_python(result)) for result in method(dbus.Array(addresses, signature = 's'), timeout = 300)]
+        return self._run(lambda done: self.device_manager.batch(operation, list(addresses), done))
+
+    def connect_many(self, addresses):
+        """
+        Connect several devices concurrently, resolving them against one object tree snapshot.
+
+        Returns:
+            list: ``(address, result, code)`` per device, in the order given
+        """
+        return self._many('connect', addresses)
+
+    def disconnect_many(self, addresses):
+        return self._many('disconnect', addresses)
+
+    def unpair_many(self, addresses):
+        return self._many('unpair', addresses)
+
+    def read_characteristics(self, requests):
+        """
+        Read GATT characteristics of connected devices concurrently.
+
+        Args:
+            requests (list): ``(address, uuid)`` per characteristic; short UUIDs such as
+                ``2a19`` are accepted
+
+        Returns:
+            list: ``(address, uuid, result, code, value)`` per request, ``value`` is ``bytes``
+        """
+        if self.service:
+            results = self.manager.ReadCharacteristics(dbus.Array(requests, signature = '(ss)'), byte_arrays = True, timeout = 120)
+            return [(str(a), str(u), str(r), str(c), bytes(v)) for a, u, r, c, v in results]
+        return self._run(lambda done: self.device_manager.read_characteristics(requests, done))
+
+    def export(self, fileobj, format = 'jsonl'):
+        """
+        Write the full device table to ``fileobj``; with ``service = True`` the service writes
+        straight into its file descriptor.
+
+        Args:
+            fileobj (file): a file object backed by a file descriptor
+            format (str): ``"jsonl"`` or ``"binary"``, see ``bjarkan.snapshot``
+
+        Returns:
+            int: number of devices written
+        """
+        fileobj.flush()
+        if self.service:
+            return int(self.manager.ExportSnapshot(dbus.types.UnixFd(fileobj.fileno()), format))
+
+        count, chunks = encode_snapshot(self.device_manager.get_managed_objects(), format)
+        write_chunks(fileobj.fileno(), chunks)
+        return count
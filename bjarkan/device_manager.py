@@ -1,19 +1,166 @@
 # Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
 
+import os
+
 import dbus
 
 from . import ADAPTER_INTERFACE, SERVICE_NAME, DEVICE_INTERFACE, DeviceNotFound, AdapterNotFound
 from .agent import Agent
 from .logger import logger
+from .operations import PAIR_TIMEOUT, DeviceOperation, pairing_error_code
+from .stats import stats
+
+
+def address_from_path(path):
+    """
+    Returns:
+        str: the device address encoded in a BlueZ device object path
+        (``/org/bluez/hci0/dev_00_11_22_33_44_55``), or ``None`` if ``path`` is not a device
+    """
+    name = str(path).rsplit('/', 1)[-1]
+    if not name.startswith('dev_'):
+        return None
+    return name[4:].replace('_', ':')
+
+
+def to_python(value):
+    """
+    Convert dbus-python values (``dbus.Boolean``, ``dbus.Dictionary``, ...) to plain python ones.
+    Byte arrays become ``bytes``.
+    """
+    if isinstance(value, dbus.Boolean):
+        return bool(value)
+    if isinstance(value, (dbus.ByteArray, bytes)):
+        return bytes(value)
+    if isinstance(value, dbus.Array):
+        if value.signature == 'y':
+            return bytes(value)
+        return [to_python(v) for v in value]
+    if isinstance(value, dbus.Dictionary):
+        return {to_python(k): to_python(v) for k, v in value.items()}
+    if isinstance(value, dbus.Struct):
+        return tuple(to_python(v) for v in value)
+    if isinstance(value, (dbus.Byte, int)):
+        return int(value)
+    if isinstance(value, float):
+        return float(value)
+    if isinstance(value, str):
+        return str(value)
+    return value
+
+
+BATCH_LIMIT = int(os.environ.get('BJARKAN_BATCH_LIMIT', 4))
+
+#: operations ``DeviceManager.batch`` runs
+BATCH_OPERATIONS = ('connect', 'disconnect', 'unpair')
+
+
+GATT_CHARACTERISTIC_INTERFACE = SERVICE_NAME + '.GattCharacteristic1'
+
+#: the Bluetooth base UUID short (16 and 32 bit) UUIDs are expanded with
+BASE_UUID = '-0000-1000-8000-00805f9b34fb'
+
+
+def expand_uuid(uuid):
+    """
+    Returns:
+        str: the full, lower case form of ``uuid``; short forms such as ``2a19`` are expanded
+        with the Bluetooth base UUID
+    """
+    uuid = str(uuid).lower()
+    if uuid.startswith('0x'):
+        uuid = uuid[2:]
+    if len(uuid) <= 8:
+        return uuid.rjust(8, '0') + BASE_UUID
+    return uuid
+
+
+def _mark(timeline, phase):
+    if timeline is not None:
+        timeline.mark(phase)
+
+
+class ProxyCache(dict):
+    """
+    ``(object path, interface)`` to ``dbus.Interface`` mapping, so that we only build (and
+    introspect) a proxy for a BlueZ object once.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key, factory):
+        proxy = self.get(key)
+        if proxy is None:
+            self.misses += 1
+            proxy = self[key] = factory(key)
+        else:
+            self.hits += 1
+
+        return proxy
+
+    def forget(self, path):
+        """
+        Drop the proxies of ``path`` and all of its children, e.g. when BlueZ removes a device.
+        """
+        path = str(path)
+        for cached in [key for key in self if key[0] == path or key[0].startswith(path + '/')]:
+            del self[cached]
 
 
 class DeviceManager:
-    def __init__(self):
-        self.bus = dbus.SystemBus()
+    def __init__(self, bus = None):
+        self.bus = bus or dbus.SystemBus()
         self.manager = dbus.Interface(self.bus.get_object( SERVICE_NAME, '/' ), 'org.freedesktop.DBus.ObjectManager' )
+        self.proxies = ProxyCache()
+        stats.register_cache('proxies', self.proxies)
+        self.gatt_paths = {}
+        self._gatt_receivers = None
+        self.busy = {}
+
+    def claim(self, address):
+        """
+        Note that an operation on the device ``address`` is in flight, see ``in_flight()``.
+        """
+        address = str(address).upper()
+        self.busy[address] = self.busy.get(address, 0) + 1
+
+    def release(self, address):
+        address = str(address).upper()
+        count = self.busy.pop(address, 0) - 1
+        if count > 0:
+            self.busy[address] = count
+
+    def in_flight(self, address):
+        """
+        Returns:
+            bool: whether a pair, connect, disconnect or unpair of ``address`` is in flight
+        """
+        return str(address).upper() in self.busy
+
+    def get_managed_objects(self, reply_handler = None, error_handler = None):
+        """
+        Fetch the full BlueZ object tree. With ``reply_handler`` and ``error_handler`` the call
+        is made asynchronously and the tree is passed to ``reply_handler`` instead.
 
-        self.result = ''
-        self.code = ''
+        Returns:
+            dict: object path to interfaces and their properties
+        """
+        stats.bluez_call('GetManagedObjects')
+        if reply_handler is not None:
+            return self.manager.GetManagedObjects(reply_handler = reply_handler, error_handler = error_handler)
+        return self.manager.GetManagedObjects()
+
+    def get_interface(self, path, interface):
+        """
+        Returns a (cached) proxy for ``interface`` on the BlueZ object at ``path``.
+        """
+        return self.proxies.lookup(
+            (str(path), interface),
+            lambda key: dbus.Interface(self.bus.get_object(SERVICE_NAME, key[0]), interface)
+        )
 
     def find_device(self, address, adapter_pattern = None):
         """
@@ -25,7 +172,7 @@ class DeviceManager:
         Returns:
             Object that represents the bluetooth adapter installed in the host.
         """
-        return self.find_device_in_objects(address, self.manager.GetManagedObjects())
+        return self.find_device_in_objects(address, self.get_managed_objects(), adapter_pattern)
 
     def find_adapter(self, pattern = None):
         """
@@ -37,7 +184,7 @@ class DeviceManager:
         Returns:
             Object that represents the bluetooth adapter installed in the host.
         """
-        return self.find_adapter_in_objects(self.manager.GetManagedObjects())
+        return self.find_adapter_in_objects(self.get_managed_objects(), pattern)
 
     def find_adapter_in_objects(self, objects, pattern = None):
         """
@@ -64,8 +211,7 @@ class DeviceManager:
             # or
             # If the assumed adapter ends with the pattern provided i.e: hci0
             if not pattern or pattern == adapter['Address'] or path.endswith(pattern):
-                obj = self.bus.get_object(SERVICE_NAME, path)
-                return dbus.Interface(obj, ADAPTER_INTERFACE)
+                return self.get_interface(path, ADAPTER_INTERFACE)
 
         raise AdapterNotFound('Bluetooth adapter not found: {}'.format(pattern))
 
@@ -93,10 +239,9 @@ class DeviceManager:
             if not device:
                 continue
             if device['Address'] == address and path.startswith(path_prefix):
-                obj = self.bus.get_object(SERVICE_NAME, path)
-                return dbus.Interface(obj, DEVICE_INTERFACE)
+                return self.get_interface(path, DEVICE_INTERFACE)
 
-        raise DeviceNotFound('Bluetooth device not found: {} {}'.format(self.address, adapter_pattern))
+        raise DeviceNotFound('Bluetooth device not found: {} {}'.format(address, adapter_pattern))
 
     def cancel_device(self, address):
         """
@@ -107,37 +252,74 @@ class DeviceManager:
         """
         device = self.find_device(address)
 
+        stats.bluez_call('CancelPairing')
         device.CancelPairing()
 
-    def trust_device(self, address):
+    def trust_device(self, address, timeline = None):
         """
         Trusts a device
 
         Args:
             address (str): address of the device
+            timeline (Timeline): marks the ``trust`` phase when given
         """
         device = self.find_device(address)
-        dev_path = device.object_path
-        props = dbus.Interface(self.bus.get_object('org.bluez', dev_path), 'org.freedesktop.DBus.Properties')
+        props = self.get_interface(device.object_path, 'org.freedesktop.DBus.Properties')
 
+        stats.bluez_call('Set')
         props.Set(DEVICE_INTERFACE, 'Trusted', True)
+        _mark(timeline, 'trust')
 
-    def pair_device(self, address, success, error):
+    def pair_device(self, address, success, error, timeline = None, timeout = PAIR_TIMEOUT):
         """
         Does the act of attempting to pair to the bluetooth device specified.
 
         Args:
             address (str): address of the device
+            timeout (float): seconds before the call fails with ``NoReply``
+            timeline (Timeline): marks the ``lookup`` and ``agent`` phases when given; the
+                ``pair`` phase is up to the ``success``/``error`` callbacks
 
         Returns:
             results (dict): Dictionary consisting of the result of pairing attempt
         """
         device = self.find_device(address)
+        _mark(timeline, 'lookup')
         self.results = {}
+        self.register_agent()
+        _mark(timeline, 'agent')
+
+        def released(callback):
+            def handler(*args):
+                self.release(address)
+                callback(*args)
+            return handler
+
+        stats.bluez_call('Pair')
+        self.claim(address)
+        device.Pair(reply_handler = released(success), error_handler = released(error), timeout = timeout)
+        return self.results
+
+    def register_agent(self, reply_handler = None, error_handler = None):
+        """
+        (Re-)register our pairing agent with BlueZ. With ``reply_handler`` and
+        ``error_handler`` the registration is done asynchronously.
+        """
         path = '/test/agent'
         obj = self.bus.get_object('org.bluez', '/org/bluez')
         manager = dbus.Interface( obj, 'org.bluez.AgentManager1')
 
+        if reply_handler is not None:
+            if getattr(self, 'agent', None) is None:
+                self.agent = Agent(self.bus, path)
+
+            def register(*args):
+                stats.bluez_call('RegisterAgent')
+                manager.RegisterAgent(path, 'KeyboardDisplay', reply_handler = reply_handler, error_handler = error_handler)
+
+            manager.UnregisterAgent(path, reply_handler = register, error_handler = register)
+            return
+
         try:
             manager.UnregisterAgent(path)
         except Exception:
@@ -149,80 +331,319 @@ class DeviceManager:
         except Exception:
             pass
 
+        stats.bluez_call('RegisterAgent')
         manager.RegisterAgent(path, 'KeyboardDisplay')
-        device.Pair(reply_handler = success, error_handler = error, timeout = 60000)
-        return self.results
 
-    def unpair_device(self, address):
+    def pair_and_connect(self, address, done, uuids = (), timeline = None, objects = None, adapter_pattern = None, agent = True, timeout = None):
+        """
+        Pair, trust and connect a device as one asynchronous pipeline, see ``DeviceOperation``.
+        The device is looked up once and every step reuses the same proxies; steps that are
+        already satisfied (the device is already paired, trusted or connected) are skipped.
+
+        Args:
+            address (str): address of the device
+            done (callable): called with the results dictionary once the pipeline finishes
+            uuids (list): connect these profiles with ``ConnectProfile`` instead of calling
+                ``Connect``
+            timeline (Timeline): marks the ``lookup``, ``agent``, ``pair``, ``trust`` and
+                ``connect`` phases when given
+            objects (dict): an already fetched ``GetManagedObjects`` result to look the device
+                up in, instead of fetching the tree
+            adapter_pattern (str): only look for the device on this adapter
+            agent (bool): (re-)register the pairing agent before pairing; callers pairing many
+                devices register it once themselves
+            timeout (float): deadline in seconds, ``None`` for none
+
+        Results have ``result`` and ``code``, and on error the ``step`` that failed: ``pair``,
+        ``trust`` or ``connect``. Pairing errors use the codes of ``pairing_error_code()``, the
+        others the D-Bus error name.
+
+        Returns:
+            DeviceOperation: the operation, which may be cancelled
+
+        Raises:
+            DeviceNotFound: bluetooth device was not found in the dbus bluetooth database.
+        """
+        operation = DeviceOperation(self, 'pair', address, done, timeout = timeout, timeline = timeline, uuids = uuids, agent = agent)
+        operation.start(objects, adapter_pattern)
+        return operation
+
+    def unpair_device(self, address, timeline = None):
         """
         Does the act of attempting to unpair to the bluetooth device specified.
 
         Args:
             address (str): address of the device
+            timeline (Timeline): marks the ``lookup`` and ``remove`` phases when given
 
         Returns:
             results (dict): Dictionary consisting of the result of unpairing attempt
         """
-        managed_objects = self.manager.GetManagedObjects()
+        managed_objects = self.get_managed_objects()
         adapter = self.find_adapter_in_objects(managed_objects)
         dev = self.find_device_in_objects(address, managed_objects)
         dev_path = dev.object_path
+        _mark(timeline, 'lookup')
+        code = ''
         try:
+            stats.bluez_call('RemoveDevice')
             adapter.RemoveDevice(dev_path)
-            self.result = 'Success'
+            self.proxies.forget(dev_path)
+            result = 'Success'
         except dbus.exceptions.DBusException as e:
-            self.result = 'Error'
-            self.code = e.get_dbus_name()
+            result = 'Error'
+            code = e.get_dbus_name()
+            stats.inc('bluez_errors', code)
         except:
-            self.result = 'Error'
-            self.code = 'UnpairFailure'
+            result = 'Error'
+            code = 'UnpairFailure'
         finally:
-            return {'result': self.result, 'code': self.code}
+            _mark(timeline, 'remove')
+            return {'result': result, 'code': code}
 
-    def disconnect_device(self, address):
+    def disconnect_device(self, address, timeline = None):
         """
         Does the act of attempting to discconnect to the bluetooth device specified.
 
         Args:
             address (str): address of the device
+            timeline (Timeline): marks the ``lookup`` and ``disconnect`` phases when given
 
         Returns:
             results (dict): Dictionary consisting of the result of disconnect attempt
         """
         device = self.find_device(address)
+        _mark(timeline, 'lookup')
 
+        code = ''
         try:
+            stats.bluez_call('Disconnect')
             device.Disconnect()
-            self.result = 'Success'
+            result = 'Success'
         except dbus.exceptions.DBusException as e:
-            self.result = 'Error'
-            self.code = e.get_dbus_name()
+            result = 'Error'
+            code = e.get_dbus_name()
+            stats.inc('bluez_errors', code)
         except:
-            self.result = 'Error'
-            self.code = 'DisconnectFailure'
+            result = 'Error'
+            code = 'DisconnectFailure'
         finally:
-            return {'result': self.result, 'code': self.code}
+            _mark(timeline, 'disconnect')
+            return {'result': result, 'code': code}
 
-    def connect_device(self, address):
+    def connect_device(self, address, timeline = None):
         """
         Does the act of attempting to connect to the bluetooth device specified.
 
         Args:
             address (str): address of the device
+            timeline (Timeline): marks the ``lookup`` and ``connect`` phases when given
 
         Returns:
             results (dict): Dictionary consisting of the result of connection attempt
         """
         device = self.find_device(address)
+        _mark(timeline, 'lookup')
 
+        code = ''
         try:
+            stats.bluez_call('Connect')
             device.Connect()
-            self.result = 'Success'
+            result = 'Success'
         except dbus.exceptions.DBusException as e:
-            self.result = 'Error'
-            self.code = e.get_dbus_name()
+            result = 'Error'
+            code = e.get_dbus_name()
+            stats.inc('bluez_errors', code)
         except:
-            self.result = 'Error'
-            self.code = 'ConnectionFailure'
+            result = 'Error'
+            code = 'ConnectionFailure'
         finally:
-            return {'result': self.result, 'code': self.code}
+            _mark(timeline, 'connect')
+            return {'result': result, 'code': code}
+
+    def connect_device_async(self, address, done, timeline = None):
+        """
+        Asynchronous ``connect_device()``: ``done`` is called with the results dictionary once
+        BlueZ replies.
+
+        Returns:
+            DeviceOperation: the operation, which may be cancelled
+
+        Raises:
+            DeviceNotFound: bluetooth device was not found in the dbus bluetooth database.
+        """
+        operation = DeviceOperation(self, 'connect', address, done, timeline = timeline)
+        operation.start()
+        return operation
+
+    def batch(self, operation, addresses, done, limit = None):
+        """
+        Run ``connect``, ``disconnect`` or ``unpair`` for many devices at once, each as a
+        ``DeviceOperation``. Every address is resolved against one object tree snapshot and at
+        most ``limit`` operations are in flight at any time.
+
+        Args:
+            operation (str): ``"connect"``, ``"disconnect"`` or ``"unpair"``
+            addresses (list): addresses of the devices
+            done (callable): called with a list of ``(address, result, code)`` tuples, in the
+                order of ``addresses``, once every device is handled
+            limit (int): maximum number of concurrent BlueZ calls, defaults to
+                ``BJARKAN_BATCH_LIMIT`` (4)
+
+        Raises:
+            ValueError: unknown ``operation``
+        """
+        if operation not in BATCH_OPERATIONS:
+            raise ValueError('unknown batch operation: {!r}'.format(operation))
+        limit = max(1, limit or BATCH_LIMIT)
+
+        objects = self.get_managed_objects()
+        results = [None] * len(addresses)
+        pending = list(reversed(range(len(addresses))))
+        state = {'running': 0, 'done': False}
+
+        def finished(index, outcome):
+            state['running'] -= 1
+            results[index] = (addresses[index], outcome['result'], outcome['code'])
+            advance()
+
+        def advance():
+            while pending and state['running'] < limit:
+                index = pending.pop()
+                state['running'] += 1
+                try:
+                    DeviceOperation(self, operation, addresses[index], lambda outcome, index = index: finished(index, outcome)).start(objects)
+                except Exception as e:
+                    # one device failing to start must not keep the others, or the reply, waiting
+                    state['running'] -= 1
+                    results[index] = (addresses[index], 'Error', type(e).__name__)
+            if not pending and not state['running'] and not state['done']:
+                state['done'] = True
+                done(results)
+
+        advance()
+
+    def gatt_characteristics(self, device_path, objects):
+        """
+        Map the characteristic UUIDs of a device to their object paths. The mapping is cached
+        per device once BlueZ resolved its services, until BlueZ adds or removes any of its GATT
+        objects or removes the device.
+
+        Args:
+            device_path (str): object path of the device
+            objects (dict): a ``GetManagedObjects`` result, used when the mapping is not cached
+
+        Returns:
+            dict: characteristic UUID to object path
+        """
+        device_path = str(device_path)
+        characteristics = self.gatt_paths.get(device_path)
+        if characteristics is not None:
+            return characteristics
+
+        if self._gatt_receivers is None:
+            self._gatt_receivers = [
+                self.bus.add_signal_receiver(
+                    self._gatt_changed,
+                    signal_name = member,
+                    dbus_interface = 'org.freedesktop.DBus.ObjectManager',
+                    bus_name = SERVICE_NAME
+                )
+                for member in ('InterfacesAdded', 'InterfacesRemoved')
+            ]
+        characteristics = {}
+        for path, ifaces in objects.items():
+            characteristic = ifaces.get(GATT_CHARACTERISTIC_INTERFACE)
+            if characteristic is not None and path.startswith(device_path + '/'):
+                characteristics.setdefault(str(characteristic['UUID']).lower(), str(path))
+        device = objects.get(device_path, {}).get(DEVICE_INTERFACE, {})
+        if characteristics and device.get('ServicesResolved'):
+            # a partially resolved tree is never cached
+            self.gatt_paths[device_path] = characteristics
+
+        return characteristics
+
+    def _gatt_changed(self, path, interfaces):
+        path = str(path)
+        for device_path in list(self.gatt_paths):
+            if path == device_path or path.startswith(device_path + '/'):
+                del self.gatt_paths[device_path]
+
+    def read_characteristics(self, requests, done, limit = None):
+        """
+        Read GATT characteristics of many devices at once. Characteristics are resolved from the
+        cached UUID mapping (fetching the object tree once if any device is not cached yet, or
+        a UUID is missing from a cached mapping) and at most ``limit`` ``ReadValue`` calls are
+        in flight at any time.
+
+        Args:
+            requests (list): ``(address, uuid)`` tuples; short UUIDs such as ``2a19`` are
+                accepted
+            done (callable): called with a list of ``(address, uuid, result, code, value)``
+                tuples, in the order of ``requests``, once every read is handled; ``value`` is
+                ``bytes``
+            limit (int): maximum number of concurrent reads, defaults to ``BJARKAN_BATCH_LIMIT``
+        """
+        limit = max(1, limit or BATCH_LIMIT)
+        requests = [(str(address).upper(), expand_uuid(uuid)) for address, uuid in requests]
+        results = [None] * len(requests)
+        objects = {}
+        devices = {}
+        refetched = set()
+        pending = []
+        for index, (address, uuid) in enumerate(requests):
+            if address not in devices:
+                cached = [path for path in self.gatt_paths if address_from_path(path) == address]
+                if cached:
+                    devices[address] = cached[0]
+                else:
+                    if not objects:
+                        objects = self.get_managed_objects()
+                    try:
+                        devices[address] = self.find_device_in_objects(address, objects).object_path
+                    except DeviceNotFound:
+                        devices[address] = None
+            if devices[address] is None:
+                results[index] = (address, uuid, 'Error', 'DeviceNotFound', b'')
+                continue
+            path = self.gatt_characteristics(devices[address], objects).get(uuid)
+            if path is None and devices[address] not in refetched:
+                # the cached mapping may predate the characteristic, look it up once more
+                refetched.add(devices[address])
+                self.gatt_paths.pop(str(devices[address]), None)
+                if not objects:
+                    objects = self.get_managed_objects()
+                path = self.gatt_characteristics(devices[address], objects).get(uuid)
+            if path is None:
+                results[index] = (address, uuid, 'Error', 'AttributeNotFound', b'')
+                continue
+            pending.append((index, path))
+        pending.reverse()
+        state = {'running': 0}
+
+        def finished(index, value = b'', e = None):
+            state['running'] -= 1
+            address, uuid = requests[index]
+            code = ''
+            if e is not None:
+                code = e.get_dbus_name() if isinstance(e, dbus.exceptions.DBusException) else 'ReadFailure'
+                stats.inc('bluez_errors', code)
+            results[index] = (address, uuid, 'Error' if code else 'Success', code, bytes(value))
+            advance()
+
+        def advance():
+            while pending and state['running'] < limit:
+                index, path = pending.pop()
+                state['running'] += 1
+                characteristic = self.get_interface(path, GATT_CHARACTERISTIC_INTERFACE)
+                stats.bluez_call('ReadValue')
+                characteristic.ReadValue(
+                    dbus.Dictionary({}, signature = 'sv'),
+                    byte_arrays = True,
+                    reply_handler = lambda value, index = index: finished(index, value),
+                    error_handler = lambda e, index = index: finished(index, e = e)
+                )
+            if not pending and not state['running']:
+                done(results)
+
+        advance()
@@ -0,0 +1,197 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+"""
+Reference counted discovery sessions for the service.
+
+Every D-Bus client that calls ``StartDiscovery`` holds a session until it calls
+``StopDiscovery``/``GetScannedDevices`` or drops off the bus. The adapter scans while at least one
+session is held, following a duty cycle so that connected audio and HID devices get air time:
+
+    * ``BJARKAN_DISCOVERY_SCAN``: seconds to scan for, defaults to ``10``
+    * ``BJARKAN_DISCOVERY_PAUSE``: seconds to pause between scans, defaults to ``0`` (scan
+      continuously)
+
+Discovery is also paused while pair or connect operations are running. Starting and stopping
+discovery never blocks the main loop: the adapter is looked up once, asynchronously, and the calls
+are asynchronous; ``discovering`` only changes once BlueZ confirms.
+"""
+
+import os
+from contextlib import contextmanager
+
+import dbus
+from gi.repository import GLib
+
+from . import AdapterNotFound
+from .logger import logger
+from .stats import stats
+
+
+class DiscoverySessions:
+
+    def __init__(self, bus, device_manager, scan = None, pause = None):
+        self.bus = bus
+        self.device_manager = device_manager
+        self.scan = scan if scan is not None else float(os.getenv('BJARKAN_DISCOVERY_SCAN', '10'))
+        self.pause = pause if pause is not None else float(os.getenv('BJARKAN_DISCOVERY_PAUSE', '0'))
+        self.sessions = {}
+        self.holds = 0
+        self.active = False
+        self.discovering = False
+        self.wanted = False
+        self.adapter = None
+        self._calling = False
+        self._watches = {}
+        self._timeout = None
+
+    def acquire(self, sender):
+        """
+        Open (or add to) the discovery session of ``sender``.
+
+        Args:
+            sender (str): unique bus name of the client
+        """
+        sender = str(sender)
+        if sender not in self.sessions:
+            self._watches[sender] = self.bus.watch_name_owner(sender, lambda owner: self._owner_changed(sender, owner))
+        self.sessions[sender] = self.sessions.get(sender, 0) + 1
+        self._update()
+
+    def release(self, sender):
+        """
+        Close the discovery session of ``sender``. Discovery stops once no session is left.
+
+        Args:
+            sender (str): unique bus name of the client
+        """
+        sender = str(sender)
+        if sender not in self.sessions:
+            return
+        self.sessions[sender] -= 1
+        if self.sessions[sender] <= 0:
+            self._drop(sender)
+        self._update()
+
+    def hold(self):
+        """
+        Pause discovery until ``unhold()`` is called, e.g. while a device is being paired.
+        """
+        self.holds += 1
+        self._update()
+
+    def unhold(self):
+        self.holds = max(self.holds - 1, 0)
+        self._update()
+
+    @contextmanager
+    def paused(self):
+        self.hold()
+        try:
+            yield
+        finally:
+            self.unhold()
+
+    def _owner_changed(self, sender, owner):
+        if not owner and sender in self.sessions:
+            logger.info('{} left the bus, closing its discovery session', sender)
+            self._drop(sender)
+            self._update()
+
+    def _drop(self, sender):
+        del self.sessions[sender]
+        watch = self._watches.pop(sender, None)
+        if watch is not None:
+            watch.cancel()
+
+    def _update(self):
+        stats.set_gauge('discovery_sessions', '', sum(self.sessions.values()))
+        wanted = bool(self.sessions) and not self.holds
+        if wanted and not self.active:
+            self.active = True
+            self._start()
+        elif not wanted and self.active:
+            self.active = False
+            self._cancel_timeout()
+            self._set_discovering(False)
+
+    def _cancel_timeout(self):
+        if self._timeout is not None:
+            GLib.source_remove(self._timeout)
+            self._timeout = None
+
+    def _start(self):
+        self._set_discovering(True)
+        if self.pause > 0:
+            self._timeout = GLib.timeout_add(int(self.scan * 1000), self._scan_done)
+
+    def _scan_done(self):
+        self._set_discovering(False)
+        self._timeout = GLib.timeout_add(int(self.pause * 1000), self._pause_done)
+        return False
+
+    def _pause_done(self):
+        self._timeout = None
+        self._start()
+        return False
+
+    def _set_discovering(self, on):
+        self.wanted = on
+        self._sync()
+
+    def _sync(self):
+        """
+        Issue the call that brings BlueZ to the ``wanted`` state, one call at a time.
+        """
+        if self._calling or self.wanted == self.discovering:
+            return
+        self._calling = True
+        if self.adapter is None:
+            self.device_manager.get_managed_objects(reply_handler = self._found, error_handler = self._lookup_failed)
+            return
+
+        on = self.wanted
+        method = 'StartDiscovery' if on else 'StopDiscovery'
+        stats.bluez_call(method)
+        getattr(self.adapter, method)(
+            reply_handler = lambda: self._done(on),
+            error_handler = lambda e: self._failed(method, e)
+        )
+
+    def _found(self, objects):
+        self._calling = False
+        try:
+            self.adapter = self.device_manager.find_adapter_in_objects(objects)
+        except AdapterNotFound as e:
+            logger.warning('unable to {} discovery: {}', 'start' if self.wanted else 'stop', e)
+            return
+        self._sync()
+
+    def _lookup_failed(self, e):
+        self._calling = False
+        logger.warning('unable to look the adapter up: {}', e.get_dbus_name() if isinstance(e, dbus.exceptions.DBusException) else e)
+
+    def _done(self, on):
+        self._calling = False
+        self.discovering = on
+        self._sync()
+
+    def _failed(self, method, e):
+        # the state is left as it is, the next change of sessions or holds tries again
+        self._calling = False
+        name = e.get_dbus_name() if isinstance(e, dbus.exceptions.DBusException) else ''
+        stats.inc('bluez_errors', name or 'DiscoveryFailure')
+        logger.debug('{} failed: {}', method, name or e)
+        if name == 'org.freedesktop.DBus.Error.UnknownObject':
+            # the adapter went away, look it up again next time
+            self.adapter = None
+
+    def as_dict(self):
+        return {
+            'sessions': dict(self.sessions),
+            'holds': self.holds,
+            'active': self.active,
+            'discovering': self.discovering,
+            'wanted': self.wanted,
+            'scan': self.scan,
+            'pause': self.pause
+        }
@@ -0,0 +1,123 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+"""
+Evicts stale devices from BlueZ so its object tree, and every listing built from it, stays small.
+
+BlueZ remembers every device it ever discovered. A device is evicted (``Adapter1.RemoveDevice``)
+once it is unpaired, untrusted and disconnected, no operation on it is in flight and nothing was
+heard from it for a while. Eviction is off unless enabled:
+
+    * ``BJARKAN_EVICT_TTL``: seconds since a device was last seen, defaults to ``0``, which
+      disables eviction
+    * ``BJARKAN_EVICT_INTERVAL``: seconds between sweeps, defaults to ``300``
+    * ``BJARKAN_EVICT_MAX``: most devices removed per sweep, defaults to ``50``
+
+"Seen" means BlueZ announced the device or changed one of its properties (RSSI updates during
+discovery, for instance). Devices already known when the service starts are considered seen at
+that time.
+"""
+
+import os
+import time
+
+from gi.repository import GLib
+
+from . import ADAPTER_INTERFACE, DEVICE_INTERFACE
+from .device_manager import address_from_path
+from .logger import logger
+from .stats import stats
+
+
+class DeviceEvictor:
+
+    def __init__(self, device_manager, ttl = None, interval = None, max_evictions = None):
+        self.device_manager = device_manager
+        self.ttl = ttl if ttl is not None else int(os.getenv('BJARKAN_EVICT_TTL', '0'))
+        self.interval = interval if interval is not None else int(os.getenv('BJARKAN_EVICT_INTERVAL', '300'))
+        self.max_evictions = max_evictions if max_evictions is not None else int(os.getenv('BJARKAN_EVICT_MAX', '50'))
+        self.last_seen = {}
+        self.started = time.monotonic()
+        self.sweeping = False
+        self._timeout = None
+
+    def start(self):
+        if self.ttl > 0 and self._timeout is None:
+            self._timeout = GLib.timeout_add_seconds(self.interval, self.sweep)
+
+    def stop(self):
+        if self._timeout is not None:
+            GLib.source_remove(self._timeout)
+            self._timeout = None
+
+    def seen(self, path):
+        self.last_seen[str(path)] = time.monotonic()
+
+    def forget(self, path):
+        self.last_seen.pop(str(path), None)
+
+    def stale_devices(self, objects, now = None):
+        """
+        Find the devices that may be evicted, least recently seen first.
+
+        Args:
+            objects (dict): the BlueZ object tree, as returned by ``GetManagedObjects``
+            now (float): ``time.monotonic()`` reference, defaults to the current time
+
+        Returns:
+            list: ``(device path, adapter path)`` tuples, at most ``max_evictions`` of them
+        """
+        now = now if now is not None else time.monotonic()
+        stale = []
+        for path, ifaces in objects.items():
+            device = ifaces.get(DEVICE_INTERFACE)
+            if not device:
+                continue
+            path = str(path)
+            if device.get('Paired') or device.get('Trusted') or device.get('Connected'):
+                continue
+            if self.device_manager.in_flight(device.get('Address', address_from_path(path))):
+                continue
+            last_seen = self.last_seen.get(path, self.started)
+            if now - last_seen >= self.ttl:
+                stale.append((last_seen, path, str(device.get('Adapter', path.rsplit('/', 1)[0]))))
+
+        stale.sort()
+        return [(path, adapter) for _, path, adapter in stale[:self.max_evictions]]
+
+    def sweep(self):
+        """
+        Remove up to ``max_evictions`` stale devices. The object tree is fetched and the removals
+        are issued asynchronously so a sweep never blocks the main loop on BlueZ.
+        """
+        if not self.sweeping:
+            self.sweeping = True
+            self.device_manager.get_managed_objects(reply_handler = self._swept, error_handler = self._sweep_failed)
+        return True
+
+    def _sweep_failed(self, e):
+        self.sweeping = False
+        logger.warning('eviction sweep failed: {}', e.get_dbus_name())
+
+    def _swept(self, objects):
+        self.sweeping = False
+        with stats.attributed('Evict'):
+            stats.set_gauge('known_devices', '', sum(1 for ifaces in objects.values() if DEVICE_INTERFACE in ifaces))
+            stale = self.stale_devices(objects)
+            if stale:
+                logger.info('evicting {} stale devices', len(stale))
+            for path, adapter_path in stale:
+                adapter = self.device_manager.get_interface(adapter_path, ADAPTER_INTERFACE)
+                stats.bluez_call('RemoveDevice')
+                adapter.RemoveDevice(
+                    path,
+                    reply_handler = lambda path = path: self._evicted(path),
+                    error_handler = lambda e, path = path: self._failed(path, e)
+                )
+
+    def _evicted(self, path):
+        stats.inc('evicted_devices')
+        self.forget(path)
+
+    def _failed(self, path, e):
+        stats.inc('bluez_errors', e.get_dbus_name())
+        logger.debug('unable to evict {}: {}', path, e.get_dbus_name())
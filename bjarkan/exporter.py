@@ -0,0 +1,310 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+"""
+Exports the counters kept in ``bjarkan.stats`` in the Prometheus text format (version 0.0.4),
+or as OpenMetrics text to scrapers asking for it.
+
+The exporter is off unless configured through the environment (e.g. ``/etc/default/bjarkan``):
+
+    * ``BJARKAN_METRICS_TEXTFILE``: directory of the node_exporter textfile collector, the
+      metrics are written to ``bjarkan.prom`` in there
+    * ``BJARKAN_METRICS_INTERVAL``: seconds between textfile updates, defaults to ``15``
+    * ``BJARKAN_METRICS_LISTEN``: serve the metrics over HTTP on ``unix:/path/to/socket`` or a
+      loopback ``host:port`` such as ``127.0.0.1:9477``
+
+    .. code-block:: bash
+
+        echo 'BJARKAN_METRICS_TEXTFILE="/var/lib/node_exporter/textfile_collector"' | sudo tee -a /etc/default/bjarkan
+
+Rendering only happens when the file is written or a scrape comes in, updating the metrics
+themselves stays a dictionary update.
+"""
+
+import os
+import socket
+
+from gi.repository import GLib
+
+from .logger import logger
+from .stats import stats, rss_bytes
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+DEFAULT_INTERVAL = 15
+#: seconds a scraper gets to read the response before it is dropped
+SEND_TIMEOUT = 5
+PREFIX = 'bjarkan_'
+
+#: metric name -> (type, label name, help text)
+METRICS = {
+    'method_calls': ('counter', 'method', 'D-Bus method calls handled'),
+    'method_errors': ('counter', 'method', 'D-Bus method calls that raised an error'),
+    'bluez_calls': ('counter', 'call', 'BlueZ round trips, labelled operation/method'),
+    'bluez_errors': ('counter', 'error', 'BlueZ calls that failed, by D-Bus error name'),
+    'pairing_outcomes': ('counter', 'outcome', 'Completed pairing attempts by result code'),
+    'bluez_signals': ('counter', 'signal', 'Signals received from BlueZ'),
+    'inflight': ('gauge', 'operation', 'Operations currently in progress'),
+    'connected_devices': ('gauge', None, 'Devices currently connected'),
+    'method_latency_seconds': ('histogram', 'method', 'D-Bus method latency'),
+}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(name, label, extra = None):
+    pairs = []
+    label_name = METRICS.get(name, (None, 'label'))[1] or 'label'
+    if label:
+        pairs.append('{}="{}"'.format(label_name, _escape(label)))
+    if extra:
+        pairs.append(extra)
+
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _by_name(metrics):
+    grouped = {}
+    for (name, label), value in sorted(metrics.items()):
+        grouped.setdefault(name, []).append((label, value))
+
+    return grouped
+
+
+def _header(lines, name, kind, openmetrics):
+    help_text = METRICS.get(name, (None, None, name.replace('_', ' ')))[2]
+    if kind == 'counter' and not openmetrics:
+        # the text format has no metric families: the type is declared for the sample name
+        name += '_total'
+    lines.append('# HELP {}{} {}'.format(PREFIX, name, _escape(help_text)))
+    lines.append('# TYPE {}{} {}'.format(PREFIX, name, kind))
+
+
+def render(source = stats, openmetrics = False):
+    """
+    Render the current metrics.
+
+    Args:
+        source (Stats): the registry to render, defaults to the process wide one
+        openmetrics (bool): render OpenMetrics text instead of the Prometheus text format
+
+    Returns:
+        str: the text exposition; OpenMetrics is terminated by ``# EOF``
+    """
+    lines = []
+
+    def header(name, kind):
+        _header(lines, name, kind, openmetrics)
+
+    for name, samples in _by_name(source.counters).items():
+        header(name, 'counter')
+        for label, value in samples:
+            lines.append('{}{}_total{} {}'.format(PREFIX, name, _labels(name, label), value))
+
+    for name, samples in _by_name(source.gauges).items():
+        header(name, 'gauge')
+        for label, value in samples:
+            lines.append('{}{}{} {}'.format(PREFIX, name, _labels(name, label), value))
+
+    for name, samples in _by_name(source.histograms).items():
+        header(name, 'histogram')
+        for label, histogram in samples:
+            for bound, count in histogram.cumulative():
+                le = 'le="{}"'.format(bound)
+                lines.append('{}{}_bucket{} {}'.format(PREFIX, name, _labels(name, label, le), count))
+            lines.append('{}{}_count{} {}'.format(PREFIX, name, _labels(name, label), histogram.count))
+            lines.append('{}{}_sum{} {}'.format(PREFIX, name, _labels(name, label), histogram.sum))
+
+    for name, samples in _by_name(source.rates).items():
+        header(name, 'counter')
+        for label, rate in samples:
+            lines.append('{}{}_total{} {}'.format(PREFIX, name, _labels(name, label), rate.total))
+
+    for name, samples in _by_name(source.duty_cycles).items():
+        header(name + '_duty_cycle', 'gauge')
+        for label, duty_cycle in samples:
+            lines.append('{}{}_duty_cycle{{adapter="{}"}} {}'.format(PREFIX, name, _escape(label), duty_cycle.ratio()))
+        header(name + '_active_seconds', 'counter')
+        for label, duty_cycle in samples:
+            lines.append('{}{}_active_seconds_total{{adapter="{}"}} {}'.format(PREFIX, name, _escape(label), duty_cycle.total_on()))
+
+    rss = rss_bytes() if source is stats else None
+    if rss is not None:
+        header('resident_memory_bytes', 'gauge')
+        lines.append('{}resident_memory_bytes {}'.format(PREFIX, rss))
+
+    if openmetrics:
+        lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+class TextfileExporter:
+    """
+    Periodically writes the metrics to ``<directory>/bjarkan.prom`` for the node_exporter textfile
+    collector. The file is replaced atomically so node_exporter never reads a partial write.
+    """
+
+    def __init__(self, directory, interval = DEFAULT_INTERVAL):
+        self.path = os.path.join(directory, 'bjarkan.prom')
+        self.interval = interval
+        self.source = None
+
+    def start(self):
+        self.write()
+        self.source = GLib.timeout_add_seconds(self.interval, self.write)
+
+    def stop(self):
+        if self.source is not None:
+            GLib.source_remove(self.source)
+            self.source = None
+
+    def write(self):
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as out:
+                out.write(render())
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning('unable to write metrics to {}: {}', self.path, e)
+
+        return True
+
+
+class SocketExporter:
+    """
+    Answers every connection on a Unix or loopback TCP socket with a minimal HTTP response
+    carrying the metrics, so both ``curl --unix-socket`` and a Prometheus scrape work.
+    """
+
+    def __init__(self, address):
+        if address.startswith('unix:'):
+            self.path = address[len('unix:'):]
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.bind(self.path)
+        else:
+            self.path = None
+            host, _, port = address.rpartition(':')
+            host = host or '127.0.0.1'
+            if host not in ('127.0.0.1', 'localhost', '::1', '[::1]'):
+                raise ValueError('metrics may only be served on a loopback address: {!r}'.format(address))
+            family = socket.AF_INET6 if ':' in host.strip('[]') else socket.AF_INET
+            self.sock = socket.socket(family, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind((host.strip('[]'), int(port)))
+        self.sock.setblocking(False)
+        self.source = None
+
+    def start(self):
+        self.sock.listen(8)
+        self.source = GLib.io_add_watch(self.sock.fileno(), GLib.IO_IN, self._accept)
+
+    def stop(self):
+        if self.source is not None:
+            GLib.source_remove(self.source)
+            self.source = None
+        self.sock.close()
+        if self.path and os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _accept(self, fd, condition):
+        try:
+            client, _ = self.sock.accept()
+        except OSError:
+            return True
+        client.setblocking(False)
+        GLib.io_add_watch(client.fileno(), GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self._respond, client)
+        return True
+
+    def _respond(self, fd, condition, client):
+        try:
+            # every path serves the metrics, only the Accept header matters
+            request = client.recv(4096)
+        except OSError:
+            client.close()
+            return False
+
+        openmetrics = b'application/openmetrics-text' in request
+        body = render(openmetrics = openmetrics).encode()
+        header = 'HTTP/1.0 200 OK\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n'.format(
+            OPENMETRICS_CONTENT_TYPE if openmetrics else CONTENT_TYPE,
+            len(body)
+        )
+        response = {'data': memoryview(header.encode() + body)}
+        response['watch'] = GLib.io_add_watch(client.fileno(), GLib.IO_OUT | GLib.IO_HUP | GLib.IO_ERR, self._send, client, response)
+        response['timeout'] = GLib.timeout_add_seconds(SEND_TIMEOUT, self._drop, client, response)
+        return False
+
+    def _send(self, fd, condition, client, response):
+        """
+        Write as much of the response as the socket takes without blocking the main loop.
+        """
+        try:
+            if not condition & GLib.IO_OUT:
+                raise ConnectionError()
+            sent = client.send(response['data'])
+            response['data'] = response['data'][sent:]
+        except BlockingIOError:
+            return True
+        except OSError:
+            response['data'] = b''
+
+        if response['data']:
+            return True
+
+        GLib.source_remove(response['timeout'])
+        client.close()
+        return False
+
+    def _drop(self, client, response):
+        logger.debug('metrics scraper too slow, dropping it')
+        GLib.source_remove(response['watch'])
+        client.close()
+        return False
+
+
+def _interval():
+    """
+    Returns:
+        int: ``BJARKAN_METRICS_INTERVAL``, or the default when it is not a positive integer
+    """
+    value = os.getenv('BJARKAN_METRICS_INTERVAL')
+    if value is None:
+        return DEFAULT_INTERVAL
+    try:
+        interval = int(value)
+        if interval <= 0:
+            raise ValueError()
+    except ValueError:
+        logger.warning('invalid BJARKAN_METRICS_INTERVAL {!r}, using {}s', value, DEFAULT_INTERVAL)
+        return DEFAULT_INTERVAL
+
+    return interval
+
+
+def start_from_environment():
+    """
+    Start the exporters configured in the environment.
+
+    Returns:
+        list: the exporters that were started, empty when metrics are not configured
+    """
+    exporters = []
+    directory = os.getenv('BJARKAN_METRICS_TEXTFILE')
+    if directory:
+        exporters.append(TextfileExporter(directory, _interval()))
+    address = os.getenv('BJARKAN_METRICS_LISTEN')
+    if address:
+        try:
+            exporters.append(SocketExporter(address))
+        except (OSError, ValueError) as e:
+            logger.error('unable to serve metrics on {!r}: {}', address, e)
+
+    for exporter in exporters:
+        exporter.start()
+        logger.info('started metrics exporter {}', type(exporter).__name__)
+
+    return exporters
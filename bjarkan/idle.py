@@ -0,0 +1,74 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+"""
+Exit of a bus activated ``bjarkan-service`` once it has been idle for a while.
+
+The service is idle when no method was called for ``BJARKAN_IDLE_TIMEOUT`` seconds and nothing
+is in progress: no operation, discovery session, wait, subscription or profiling capture. The
+service then releases its bus name, so that the next call to ``com.getwellnetwork.plc.bjarkan1``
+starts a new instance through D-Bus activation instead of reaching one that is shutting down,
+serves the calls that were already on their way and exits once none arrived for ``DRAIN``
+seconds.
+"""
+
+import os
+import time
+
+from gi.repository import GLib
+
+from .logger import logger
+from .stats import stats
+
+
+#: seconds without calls (and nothing in progress) after releasing the bus name before exiting
+DRAIN = 1.0
+
+class IdleExit:
+    """
+    Args:
+        mainloop (GLib.MainLoop): quit when idle
+        busy (list): callables returning whether something is in progress
+        release (callable): releases the bus name before draining
+        timeout (float): seconds without calls before exiting, ``0`` to never exit; defaults to
+            ``BJARKAN_IDLE_TIMEOUT`` (``0``)
+    """
+
+    def __init__(self, mainloop, busy, release = None, timeout = None):
+        self.mainloop = mainloop
+        self.busy = busy
+        self.release = release
+        self.timeout = timeout if timeout is not None else float(os.getenv('BJARKAN_IDLE_TIMEOUT', '0'))
+        self._timeout = None
+
+    def start(self):
+        if self.timeout > 0 and self._timeout is None:
+            self._timeout = GLib.timeout_add_seconds(max(1, int(self.timeout / 4)), self.check)
+
+    def stop(self):
+        if self._timeout is not None:
+            GLib.source_remove(self._timeout)
+            self._timeout = None
+
+    def idle(self, timeout = None):
+        if time.monotonic() - stats.last_call < (self.timeout if timeout is None else timeout):
+            return False
+        return not any(busy() for busy in self.busy)
+
+    def check(self):
+        if not self.idle():
+            return True
+
+        logger.info('idle for {}s, releasing the bus name', self.timeout)
+        if self.release is not None:
+            self.release()
+        self._timeout = GLib.timeout_add(int(DRAIN * 1000), self.drain)
+        return False
+
+    def drain(self):
+        if not self.idle(DRAIN):
+            return True
+
+        logger.info('drained, exiting')
+        self._timeout = None
+        self.mainloop.quit()
+        return False
@@ -1,10 +1,23 @@
 # Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
 
+from collections import namedtuple
+
 import dbus
 from gi.repository import GObject
 
 from . import ADAPTER_INTERFACE, DEVICE_INTERFACE, SERVICE_NAME
 from .device_manager import DeviceManager
+from .stats import stats
+
+
+DeviceRecord = namedtuple('DeviceRecord', 'address alias icon rssi paired connected trusted')
+DeviceRecord.__doc__ = """
+Compact, fixed layout description of a device. Matches the ``(sssnbbb)`` D-Bus struct returned
+by ``ManagerService.ListDevices``.
+"""
+
+#: D-Bus signature of a ``DeviceRecord``
+DEVICE_RECORD_SIGNATURE = '(sssnbbb)'
 
 
 def quit(mainloop):
@@ -21,6 +34,7 @@ def scan_devices( duration = 10 ):
     """
     adapter = DeviceManager().find_adapter()
 
+    stats.bluez_call('StartDiscovery')
     adapter.StartDiscovery()
 
     mainloop = GObject.MainLoop()
@@ -28,11 +42,15 @@ def scan_devices( duration = 10 ):
     mainloop.run()
 
 
-def gather_device_info():
+def gather_device_info(objects = None):
     """
     This function is responsible for digging through the dbus bluetooth database and retrieving all the known
     devices and the information about those devices. The database is seeded from scan_devices.
 
+    Args:
+        objects (dict): an already fetched ``GetManagedObjects`` result; the tree is fetched from
+            BlueZ when omitted
+
     Returns:
         List of device objects. Each object is one device and consisting of the properties of that device.
 
@@ -52,10 +70,12 @@ def gather_device_info():
             ]
     """
     devices = []
-    bus = dbus.SystemBus()
-    manager = dbus.Interface(bus.get_object(SERVICE_NAME, '/'), 'org.freedesktop.DBus.ObjectManager')
-    objects = manager.GetManagedObjects()
-    all_devices = (str(path) for path, interfaces in objects.items() if DEVICE_INTERFACE in interfaces)
+    if objects is None:
+        bus = dbus.SystemBus()
+        manager = dbus.Interface(bus.get_object(SERVICE_NAME, '/'), 'org.freedesktop.DBus.ObjectManager')
+        stats.bluez_call('GetManagedObjects')
+        objects = manager.GetManagedObjects()
+    all_devices = [str(path) for path, interfaces in objects.items() if DEVICE_INTERFACE in interfaces]
     for path, ifaces in objects.items():
         if ADAPTER_INTERFACE not in ifaces:
             continue
@@ -78,6 +98,46 @@ def gather_device_info():
     return devices
 
 
+def device_records(objects, which = 'all'):
+    """
+    Build ``DeviceRecord`` tuples straight from the BlueZ object tree, without the intermediate
+    dictionary per device that ``gather_device_info`` builds.
+
+    Args:
+        objects (dict): a ``GetManagedObjects`` result
+        which (str): ``"all"``, ``"paired"`` or ``"connected"``
+
+    Returns:
+        list: ``DeviceRecord`` for each matching device
+
+    Raises:
+        ValueError: unknown ``which``
+    """
+    if which not in ('all', 'paired', 'connected'):
+        raise ValueError('unknown device filter: {!r}'.format(which))
+
+    records = []
+    for ifaces in objects.values():
+        properties = ifaces.get(DEVICE_INTERFACE)
+        if properties is None:
+            continue
+        paired = bool(properties.get('Paired', False))
+        connected = bool(properties.get('Connected', False))
+        if (which == 'paired' and not paired) or (which == 'connected' and not connected):
+            continue
+        records.append(DeviceRecord(
+            str(properties['Address']),
+            str(properties.get('Alias', '')),
+            str(properties.get('Icon', 'None')),
+            int(properties.get('RSSI', -999)),
+            paired,
+            connected,
+            bool(properties.get('Trusted', False))
+        ))
+
+    return records
+
+
 def connected_devices():
     """
     Fetches the dbus bluetooth database and returns a list of devices that have a connected value of '1'
@@ -53,13 +53,56 @@ way to do that is to use the ``systemctl cat`` command:
     .. code-block:: bash
 
         systemctl cat gwn-support-bridge.service
+
+Asynchronous Logging
+====================
+
+By default records are written to the journal synchronously by the thread that logs them. Set
+``GWN_LOGGER_QUEUE`` to a queue size (at least 1) to instead hand records to a bounded queue that
+a background thread formats and sends to the journal, so a slow journald never stalls the main
+loop:
+
+    .. code-block:: bash
+
+        GWN_LOGGER_QUEUE=1000 GWN_LOGGER_QUEUE_POLICY=drop-oldest /usr/bin/gwn-foo
+
+``GWN_LOGGER_QUEUE_POLICY`` decides what happens when the queue is full:
+
+    * ``drop-newest`` (default): the record being logged is discarded
+    * ``drop-oldest``: the oldest queued record is discarded to make room
+    * ``block``: the logging thread waits for room, nothing is ever dropped
+
+Dropped records are counted, see ``StyleAdapter.getQueueStats()``.
+
+Rate Limiting and Sampling
+==========================
+
+High frequency events (RSSI updates and the like) can be throttled per call site, so debug
+logging is safe to turn on in production:
+
+    * ``GWN_LOGGER_RATE``: at most this many records per second per key, ``0`` (default) is unlimited
+    * ``GWN_LOGGER_SAMPLE``: only keep this fraction of records, e.g. ``0.1``; ``1`` (default) keeps all
+    * ``GWN_LOGGER_LIMIT_LEVEL``: the most severe level that is throttled, defaults to ``debug``
+
+The key is the call site, optionally narrowed with the ``rate_key`` keyword::
+
+    logger.debug( 'RSSI of {} is now {}', address, rssi, rate_key = address )
+
+When a record gets through after others were suppressed, the number suppressed is appended to
+its message. The same settings may be changed at runtime with ``SetLogLevel( "debug,rate=5" )``
+on the Support interface.
 """
 
+import atexit
 import logging
 import logging.handlers
 import os
 import os.path
+import queue
+import random
 import sys
+import threading
+import time
 from systemd.journal import JournalHandler
 
 
@@ -77,6 +120,133 @@ class Message():
 
 
 
+class BoundedQueueHandler( logging.handlers.QueueHandler ):
+    """
+    A ``QueueHandler`` for a bounded queue that applies a drop policy instead of raising when the
+    queue is full, and counts what it had to drop.
+
+    Unlike the standard library handler, records are not formatted here; that is left to the
+    handlers run by the listener thread.
+    """
+
+    POLICIES = ( 'drop-newest', 'drop-oldest', 'block' )
+
+    def __init__( self, maxsize, policy = 'drop-newest' ):
+        if maxsize <= 0:
+            # queue.Queue( 0 ) would be unbounded
+            raise ValueError( 'queue size must be positive: {!r}'.format( maxsize ) )
+        if policy not in self.POLICIES:
+            raise ValueError( 'unknown queue policy: {!r}'.format( policy ) )
+        super().__init__( queue.Queue( maxsize ) )
+        self.policy = policy
+        self.enqueued = 0
+        self.dropped = 0
+
+
+    def prepare( self, record ):
+        return record
+
+
+    def enqueue( self, record ):
+        if self.policy == 'block':
+            self.queue.put( record )
+            self.enqueued += 1
+            return
+
+        try:
+            self.queue.put_nowait( record )
+            self.enqueued += 1
+            return
+        except queue.Full:
+            if self.policy == 'drop-newest':
+                self.dropped += 1
+                return
+
+        try:
+            self.queue.get_nowait()
+            self.dropped += 1
+        except queue.Empty:
+            pass
+
+        try:
+            self.queue.put_nowait( record )
+            self.enqueued += 1
+        except queue.Full:
+            self.dropped += 1
+
+
+
+class RateLimiter():
+    """
+    Per key token bucket (``rate`` records per second, bursts of up to ``rate`` but at least one
+    record) combined with random sampling. Counts what it suppresses.
+    """
+
+    MAX_KEYS = 4096
+
+    def __init__( self, rate = 0, sample = 1.0, level = logging.DEBUG ):
+        if rate < 0:
+            raise ValueError( 'rate must not be negative: {!r}'.format( rate ) )
+        if not 0 < sample <= 1:
+            raise ValueError( 'sample must be within (0, 1]: {!r}'.format( sample ) )
+        self.rate = rate
+        # below one record per second the bucket must still be able to hold a whole token
+        self.capacity = max( float( rate ), 1.0 )
+        self.sample = sample
+        self.level = level
+        self.suppressed = 0
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+
+    def admit( self, key ):
+        """
+        Returns:
+            int: ``None`` if the record should be suppressed, otherwise the number of records of
+            ``key`` suppressed since the last one that got through
+        """
+        with self._lock:
+            bucket = self._buckets.get( key )
+            now = time.monotonic()
+            if bucket is None:
+                if len( self._buckets ) >= self.MAX_KEYS:
+                    self._buckets.clear()
+                # [ tokens, last refill, suppressed since last admitted ]
+                bucket = self._buckets[key] = [ self.capacity, now, 0 ]
+
+            allowed = self.sample >= 1 or random.random() < self.sample
+            if allowed and self.rate:
+                bucket[0] = min( self.capacity, bucket[0] + ( now - bucket[1] ) * self.rate )
+                bucket[1] = now
+                if bucket[0] >= 1:
+                    bucket[0] -= 1
+                else:
+                    allowed = False
+
+            if not allowed:
+                bucket[2] += 1
+                self.suppressed += 1
+                return None
+
+            suppressed, bucket[2] = bucket[2], 0
+            return suppressed
+
+
+
+# code objects that are part of the logging machinery rather than a call site
+_internal_files = { logging.addLevelName.__code__.co_filename, RateLimiter.admit.__code__.co_filename }
+
+
+def _call_site():
+    frame = sys._getframe( 2 )
+    while frame is not None and frame.f_code.co_filename in _internal_files:
+        frame = frame.f_back
+    if frame is None:
+        return None
+    return ( frame.f_code.co_filename, frame.f_lineno )
+
+
+
 class StyleAdapter( logging.LoggerAdapter ):
     """
     A wrapper around a ``logging.Logger`` object that adds ``str.format()`` capabilities so you can
@@ -93,18 +263,71 @@ class StyleAdapter( logging.LoggerAdapter ):
     def __init__( self, logger, extra = None ):
         super().__init__( logger, extra or {} )
         self._duplicated_to_stderr = False
+        self._queue_handler = None
+        self._listener = None
+        self._limiter = None
 
 
     def log( self, level, msg, *args, **kwargs ):
         """
-        Implements the ``str.format()`` logic. You probably shouldn't be calling this method
-        directly.
+        Implements the ``str.format()`` logic and rate limiting. You probably shouldn't be
+        calling this method directly.
         """
+        rate_key = kwargs.pop( 'rate_key', None )
         if self.isEnabledFor( level ):
+            limiter = self._limiter
+            if limiter is not None and level <= limiter.level:
+                suppressed = limiter.admit( ( _call_site(), rate_key ) )
+                if suppressed is None:
+                    return
+                if suppressed:
+                    msg = '{} ({:d} similar records suppressed)'.format( msg, suppressed )
             msg, kwargs = self.process( msg, kwargs )
             self.logger._log( level, Message( msg, args ), (), **kwargs )
 
 
+    def setRateLimit( self, rate = 0, sample = 1.0, level = 'debug' ):
+        """
+        Throttle records at ``level`` and below per call site. Calling this with the defaults
+        turns throttling off.
+
+        Args:
+            rate (float): maximum records per second per key, ``0`` for unlimited
+            sample (float): fraction of records to keep, within ``(0, 1]``
+            level (str): the most severe level that is throttled
+
+        Raises:
+            ValueError: if any of the values is out of range
+        """
+        if isinstance( level, str ):
+            level = logging.getLevelName( level.upper() )
+            if not isinstance( level, int ):
+                raise ValueError( 'unknown log level for rate limiting' )
+
+        if not rate and sample >= 1:
+            self._limiter = None
+        else:
+            self._limiter = RateLimiter( rate, sample, level )
+
+
+    def getRateLimitStats( self ):
+        """
+        Returns:
+            dict: the current rate limit settings and the number of records suppressed so far
+        """
+        limiter = self._limiter
+        if limiter is None:
+            return { 'enabled': False }
+
+        return {
+            'enabled': True,
+            'rate': limiter.rate,
+            'sample': limiter.sample,
+            'level': logging.getLevelName( limiter.level ).lower(),
+            'suppressed': limiter.suppressed,
+        }
+
+
     def setFormat( self, fmt, style = '{' ):
         """
         A convenience wrapper so you don't have to instantiate a ``logging.Formatter`` object to
@@ -114,10 +337,19 @@ class StyleAdapter( logging.LoggerAdapter ):
         method.
         """
         formatter = logging.Formatter( fmt, style = style )
-        for handler in self.logger.handlers:
+        for handler in self._sinks():
             handler.setFormatter( formatter )
 
 
+    def _sinks( self ):
+        """
+        The handlers that actually write records out, wherever they are currently attached.
+        """
+        if self._listener is not None:
+            return self._listener.handlers
+        return self.logger.handlers
+
+
     def getLevel( self ):
         """
         A convenience wrapper around ``getEffectiveLevel()`` because the integer values for the
@@ -170,10 +402,75 @@ class StyleAdapter( logging.LoggerAdapter ):
         journal. After called the first time, subsequent calls to this method will do nothing.
         """
         if not self._duplicated_to_stderr:
-            self.logger.addHandler( logging.StreamHandler() )
+            if self._listener is not None:
+                self._listener.handlers += ( logging.StreamHandler(), )
+            else:
+                self.logger.addHandler( logging.StreamHandler() )
             self._duplicated_to_stderr = True
 
 
+    def enableQueue( self, maxsize = 1000, policy = 'drop-newest' ):
+        """
+        Move the current handlers behind a bounded queue served by a background thread. After
+        called the first time, subsequent calls to this method will do nothing.
+
+        Args:
+            maxsize (int): maximum number of records waiting to be written
+            policy (str): what to do when the queue is full, one of
+                ``BoundedQueueHandler.POLICIES``
+
+        Raises:
+            ValueError: if ``maxsize`` is not positive or ``policy`` is not a known policy
+        """
+        if self._listener is not None:
+            return
+
+        handler = BoundedQueueHandler( maxsize, policy )
+        sinks = tuple( self.logger.handlers )
+        self._listener = logging.handlers.QueueListener( handler.queue, *sinks, respect_handler_level = True )
+        self._queue_handler = handler
+        for sink in sinks:
+            self.logger.removeHandler( sink )
+        self.logger.addHandler( handler )
+        self._listener.start()
+        atexit.register( self.disableQueue )
+
+
+    def disableQueue( self ):
+        """
+        Flush the queue, stop the background thread and write synchronously again.
+        """
+        if self._listener is None:
+            return
+
+        self._listener.stop()
+        self.logger.removeHandler( self._queue_handler )
+        for sink in self._listener.handlers:
+            self.logger.addHandler( sink )
+        self._listener = None
+        self._queue_handler = None
+
+
+    def getQueueStats( self ):
+        """
+        Returns:
+            dict: whether queueing is enabled and, if so, the queue policy, size and the number
+            of records enqueued and dropped so far
+        """
+        handler = self._queue_handler
+        if handler is None:
+            return { 'enabled': False }
+
+        return {
+            'enabled': True,
+            'policy': handler.policy,
+            'maxsize': handler.queue.maxsize,
+            'size': handler.queue.qsize(),
+            'enqueued': handler.enqueued,
+            'dropped': handler.dropped,
+        }
+
+
 
 _logger = logging.getLogger( __name__ )
 _handler = JournalHandler( SYSLOG_IDENTIFIER = os.path.basename( sys.argv[0] ) )
@@ -192,4 +489,23 @@ else:
     logger.setLevel( logging.INFO )
     logger.warning( 'unrecognized GWN_LOGGER value {!r}, defaulting to INFO', _log_level )
 
-
+_queue_size = os.getenv( 'GWN_LOGGER_QUEUE' )
+
+if _queue_size:
+    try:
+        logger.enableQueue( int( _queue_size ), os.getenv( 'GWN_LOGGER_QUEUE_POLICY', 'drop-newest' ).lower() )
+    except ValueError as e:
+        logger.warning( 'ignoring GWN_LOGGER_QUEUE={!r} ({}), logging synchronously', _queue_size, e )
+
+_rate = os.getenv( 'GWN_LOGGER_RATE' )
+_sample = os.getenv( 'GWN_LOGGER_SAMPLE' )
+
+if _rate or _sample:
+    try:
+        logger.setRateLimit(
+            float( _rate or 0 ),
+            float( _sample or 1 ),
+            os.getenv( 'GWN_LOGGER_LIMIT_LEVEL', 'debug' )
+        )
+    except ValueError as e:
+        logger.warning( 'ignoring GWN_LOGGER_RATE/GWN_LOGGER_SAMPLE ({})', e )
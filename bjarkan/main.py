@@ -1,11 +1,13 @@
 
+import os
+
+import dbus
 from dbus.mainloop.glib import DBusGMainLoop
 from gi.repository.GObject import MainLoop
 
 
+from . import BUSNAME
 from .logger import logger
-from .service import ManagerService
-from .support_service import SupportService
 
 
 
@@ -13,12 +15,29 @@ def main():
     """The main entry point for the systemd service."""
     DBusGMainLoop( set_as_default = True )
 
+    # imported here, so that the main loop is set up before any module touches the bus
+    from .idle import IdleExit
+    from .service import ManagerService
+    from .support_service import SupportService
+
     service = ManagerService()
     support_service = SupportService()
+    exporters = []
+    if os.getenv( 'BJARKAN_METRICS_TEXTFILE' ) or os.getenv( 'BJARKAN_METRICS_LISTEN' ):
+        from . import exporter
+        exporters = exporter.start_from_environment()
+
+    mainloop = MainLoop()
+    idle_exit = IdleExit(
+        mainloop,
+        [ service.busy, lambda: support_service.profiler.running ],
+        release = lambda: dbus.SystemBus().release_name( BUSNAME )
+    )
+    idle_exit.start()
 
     try:
         logger.debug( 'entering main loop' )
-        MainLoop().run()
+        mainloop.run()
     except KeyboardInterrupt:
         pass
 
@@ -0,0 +1,156 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+"""
+Live stream of device state transitions, built purely on BlueZ signals.
+
+Nothing is polled: the process sleeps in the main loop until BlueZ announces a change, and the
+match rules ask the bus daemon to only forward ``Device1`` property changes (and, when a single
+device is watched on a known adapter, only that device's).
+"""
+
+import json
+import sys
+import time
+
+from . import DEVICE_INTERFACE, SERVICE_NAME
+from .device_manager import address_from_path
+
+
+class DeviceMonitor:
+    """
+    Args:
+        device_manager (DeviceManager): used for the bus and the initial device state
+        addresses (list): only report these device addresses
+        adapter (str): only report devices of this adapter (``hci0`` or its address)
+        rssi_threshold (int): report RSSI changes of at least this many dBm, ``None`` to not report
+            RSSI changes at all
+        json_lines (bool): write one JSON object per line instead of plain text
+        output (file): where events are written, defaults to ``stdout``
+    """
+
+    def __init__(self, device_manager, addresses = None, adapter = None, rssi_threshold = 10,
+            json_lines = False, output = None):
+        self.device_manager = device_manager
+        self.addresses = {address.upper() for address in addresses or ()}
+        self.adapter = adapter
+        self.rssi_threshold = rssi_threshold
+        self.json_lines = json_lines
+        self.output = output or sys.stdout
+        self.devices = {}
+        self.adapter_prefix = ''
+        self._receivers = []
+
+    def start(self):
+        objects = self.device_manager.get_managed_objects()
+        if self.adapter:
+            adapter = self.device_manager.find_adapter_in_objects(objects, self.adapter)
+            self.adapter_prefix = str(adapter.object_path) + '/'
+
+        for path, ifaces in objects.items():
+            if DEVICE_INTERFACE in ifaces and self._wanted(path):
+                self.devices[str(path)] = self._summary(ifaces[DEVICE_INTERFACE])
+
+        bus = self.device_manager.bus
+        properties_filter = {'arg0': DEVICE_INTERFACE}
+        if self.adapter_prefix and len(self.addresses) == 1:
+            address = next(iter(self.addresses))
+            properties_filter['path'] = self.adapter_prefix + 'dev_' + address.replace(':', '_')
+
+        self._receivers = [
+            bus.add_signal_receiver(
+                self._properties_changed,
+                signal_name = 'PropertiesChanged',
+                dbus_interface = 'org.freedesktop.DBus.Properties',
+                bus_name = SERVICE_NAME,
+                path_keyword = 'path',
+                **properties_filter
+            ),
+            bus.add_signal_receiver(
+                self._interfaces_added,
+                signal_name = 'InterfacesAdded',
+                dbus_interface = 'org.freedesktop.DBus.ObjectManager',
+                bus_name = SERVICE_NAME
+            ),
+            bus.add_signal_receiver(
+                self._interfaces_removed,
+                signal_name = 'InterfacesRemoved',
+                dbus_interface = 'org.freedesktop.DBus.ObjectManager',
+                bus_name = SERVICE_NAME
+            ),
+        ]
+
+    def stop(self):
+        for receiver in self._receivers:
+            receiver.remove()
+        self._receivers = []
+
+    def _wanted(self, path):
+        path = str(path)
+        if self.adapter_prefix and not path.startswith(self.adapter_prefix):
+            return False
+        if self.addresses and address_from_path(path) not in self.addresses:
+            return False
+        return True
+
+    def _summary(self, properties):
+        return {
+            'alias': str(properties.get('Alias', '')),
+            'rssi': int(properties['RSSI']) if 'RSSI' in properties else None
+        }
+
+    def _interfaces_added(self, path, interfaces):
+        if DEVICE_INTERFACE not in interfaces or not self._wanted(path):
+            return
+        device = self.devices[str(path)] = self._summary(interfaces[DEVICE_INTERFACE])
+        self.emit('appeared', path, rssi = device['rssi'])
+
+    def _interfaces_removed(self, path, interfaces):
+        if DEVICE_INTERFACE not in interfaces or not self._wanted(path):
+            return
+        self.emit('disappeared', path)
+        self.devices.pop(str(path), None)
+
+    def _properties_changed(self, interface, changed, invalidated, path = None):
+        if not self._wanted(path):
+            return
+        device = self.devices.setdefault(str(path), {'alias': '', 'rssi': None})
+        if 'Alias' in changed:
+            device['alias'] = str(changed['Alias'])
+        if 'Paired' in changed:
+            self.emit('paired' if changed['Paired'] else 'unpaired', path)
+        if 'Connected' in changed:
+            self.emit('connected' if changed['Connected'] else 'disconnected', path)
+        if 'RSSI' in changed and self.rssi_threshold is not None:
+            rssi = int(changed['RSSI'])
+            if device['rssi'] is None or abs(rssi - device['rssi']) >= self.rssi_threshold:
+                device['rssi'] = rssi
+                self.emit('rssi', path, rssi = rssi)
+
+    def emit(self, event, path, rssi = None):
+        path = str(path)
+        device = self.devices.get(path, {})
+        record = {
+            'time': time.time(),
+            'event': event,
+            'address': address_from_path(path),
+            'adapter': path.rsplit('/', 1)[0].rsplit('/', 1)[-1],
+            'alias': device.get('alias', ''),
+        }
+        if rssi is not None:
+            record['rssi'] = rssi
+
+        if self.json_lines:
+            line = json.dumps(record)
+        else:
+            stamp = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record['time']))
+            line = '{}.{:03d} {:<11} {} {} {}{}'.format(
+                stamp,
+                int(record['time'] % 1 * 1000),
+                event,
+                record['address'],
+                record['adapter'],
+                record['alias'],
+                ' {}'.format(rssi) if rssi is not None else ''
+            )
+        self.output.write(line + '\n')
+        self.output.flush()
@@ -0,0 +1,204 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+"""
+Selection of the nearest unpaired device, by signal strength.
+
+A single RSSI reading is noisy, so candidates are ranked by the average of the readings received
+during a short discovery. Discovery stops early once one candidate clearly leads: it has enough
+samples and its average beats the runner-up's by a margin.
+"""
+
+import time
+
+import dbus
+from gi.repository import GLib
+
+from . import DEVICE_INTERFACE, SERVICE_NAME
+from .device_manager import address_from_path
+from .logger import logger
+from .stats import stats
+
+
+class NearestDevice:
+    """
+    Args:
+        device_manager (DeviceManager): used for the bus and the known devices
+        icon (str): only consider devices with this icon, e.g. ``input-keyboard``
+        min_rssi (int): only consider devices averaging at least this RSSI
+        duration (float): seconds to discover at most
+        min_samples (int): readings a candidate needs before it can win early
+        lead (float): dBm the leader's average must beat the runner-up's by to win early
+        min_duration (float): seconds to discover at least, so that farther devices get a
+            chance to be heard
+        start_discovery (callable): starts discovery, defaults to ``StartDiscovery`` on the
+            default adapter
+        stop_discovery (callable): stops it again
+        snapshot (callable): ``snapshot(reply, error)`` fetches the BlueZ object tree
+            asynchronously, defaults to ``GetManagedObjects``
+    """
+
+    def __init__(self, device_manager, icon = None, min_rssi = None, duration = 10, min_samples = 3, lead = 10,
+            min_duration = 2, start_discovery = None, stop_discovery = None, snapshot = None):
+        self.device_manager = device_manager
+        self.icon = icon
+        self.min_rssi = min_rssi
+        self.duration = duration
+        self.min_samples = min_samples
+        self.lead = lead
+        self.min_duration = min_duration
+        self.start_discovery = start_discovery
+        self.stop_discovery = stop_discovery
+        self.snapshot = snapshot
+        self.known = {}
+        self.samples = {}
+        self._receivers = []
+        self._timeout = None
+        self._done = None
+        self._error = None
+        self._discovering = False
+
+    def start(self, done, error = None):
+        """
+        Start sampling; ``done(address)`` is called with the winner, or ``None`` when no
+        candidate qualified. The known devices are fetched without blocking; if that or starting
+        discovery fails, ``error(exception)`` is called instead (``done(None)`` without
+        ``error``).
+        """
+        self._done = done
+        self._error = error
+        self.started = time.monotonic()
+
+        bus = self.device_manager.bus
+        self._receivers = [
+            bus.add_signal_receiver(
+                self._properties_changed,
+                signal_name = 'PropertiesChanged',
+                dbus_interface = 'org.freedesktop.DBus.Properties',
+                bus_name = SERVICE_NAME,
+                arg0 = DEVICE_INTERFACE,
+                path_keyword = 'path'
+            ),
+            bus.add_signal_receiver(
+                self._interfaces_added,
+                signal_name = 'InterfacesAdded',
+                dbus_interface = 'org.freedesktop.DBus.ObjectManager',
+                bus_name = SERVICE_NAME
+            ),
+        ]
+        if self.snapshot is None:
+            self.device_manager.get_managed_objects(reply_handler = self._seeded, error_handler = self._finish)
+        else:
+            self.snapshot(self._seeded, self._finish)
+
+    def _seeded(self, objects):
+        if self._done is None:
+            return
+        for path, ifaces in objects.items():
+            # properties already seen in a signal are newer than the snapshot
+            if DEVICE_INTERFACE in ifaces:
+                self.known.setdefault(str(path), ifaces[DEVICE_INTERFACE])
+
+        try:
+            if self.start_discovery is None:
+                adapter = self.device_manager.find_adapter_in_objects(objects)
+                stats.bluez_call('StartDiscovery')
+                adapter.StartDiscovery(reply_handler = lambda: None, error_handler = self._start_failed)
+                self.stop_discovery = lambda: adapter.StopDiscovery(reply_handler = lambda: None, error_handler = lambda e: None)
+            else:
+                self.start_discovery()
+        except Exception as e:
+            return self._finish(e)
+        self._discovering = True
+        self._timeout = GLib.timeout_add(int(self.duration * 1000), self._expired)
+
+    def _start_failed(self, e):
+        # nothing to stop
+        self._discovering = False
+        self._finish(e)
+
+    def _candidate(self, path):
+        properties = self.known.get(path)
+        if properties is None or properties.get('Paired'):
+            return False
+        return not self.icon or str(properties.get('Icon', '')) == self.icon
+
+    def _sample(self, path, rssi):
+        if not self._candidate(path):
+            return
+        self.samples.setdefault(path, []).append(int(rssi))
+        if self._leader(early = True) is not None:
+            stats.inc('nearest_early_stops')
+            self._finish()
+
+    def _interfaces_added(self, path, interfaces):
+        if DEVICE_INTERFACE not in interfaces:
+            return
+        path = str(path)
+        self.known[path] = interfaces[DEVICE_INTERFACE]
+        if 'RSSI' in interfaces[DEVICE_INTERFACE]:
+            self._sample(path, interfaces[DEVICE_INTERFACE]['RSSI'])
+
+    def _properties_changed(self, interface, changed, invalidated, path = None):
+        path = str(path)
+        if path in self.known:
+            self.known[path] = dict(self.known[path], **changed)
+        if 'RSSI' in changed:
+            self._sample(path, changed['RSSI'])
+
+    def ranking(self):
+        """
+        Returns:
+            list: ``(average RSSI, samples, address)`` of every qualifying candidate, nearest first
+        """
+        ranked = []
+        for path, readings in self.samples.items():
+            average = sum(readings) / len(readings)
+            if self.min_rssi is None or average >= self.min_rssi:
+                ranked.append((average, len(readings), address_from_path(path)))
+        ranked.sort(reverse = True)
+        return ranked
+
+    def _leader(self, early = False):
+        ranked = self.ranking()
+        if not ranked:
+            return None
+        if not early:
+            return ranked[0][2]
+
+        average, samples, address = ranked[0]
+        if time.monotonic() - self.started < self.min_duration or samples < self.min_samples:
+            return None
+        if len(ranked) > 1 and average - ranked[1][0] < self.lead:
+            return None
+        return address
+
+    def _expired(self):
+        self._timeout = None
+        self._finish()
+        return False
+
+    def _finish(self, e = None):
+        if self._done is None:
+            return
+        done, error = self._done, self._error
+        self._done = self._error = None
+        if self._timeout is not None:
+            GLib.source_remove(self._timeout)
+            self._timeout = None
+        for receiver in self._receivers:
+            receiver.remove()
+        self._receivers = []
+        if self._discovering:
+            self._discovering = False
+            try:
+                self.stop_discovery()
+            except dbus.exceptions.DBusException:
+                pass
+
+        if e is None:
+            done(self._leader())
+        elif error is not None:
+            error(e)
+        else:
+            logger.warning('unable to look for the nearest device: {}', e)
+            done(None)
@@ -0,0 +1,275 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+"""
+Asynchronous device operations, optionally with a deadline, that can be cancelled while in
+flight.
+
+This is the one pipeline every asynchronous pair, connect, disconnect and unpair goes through
+(``DeviceManager.pair_and_connect``, ``connect_device_async`` and ``batch`` included). Steps
+that are already satisfied, such as pairing a device that is already paired or connecting one
+that is already connected, are skipped.
+
+When the deadline expires (or ``cancel()`` is called) the operation does not wait for BlueZ's
+internal timeouts: it actively aborts the BlueZ side (``CancelPairing`` while pairing,
+``Disconnect`` while connecting) and completes right away with code ``"Timeout"`` (or
+``"Canceled"``). A late reply from BlueZ is ignored.
+"""
+
+import dbus
+from gi.repository import GLib
+
+from . import ADAPTER_INTERFACE, DEVICE_INTERFACE
+from .logger import logger
+from .stats import stats
+
+
+#: seconds BlueZ gets to complete a ``Pair`` call (dbus-python call timeouts are in seconds)
+PAIR_TIMEOUT = 60
+
+AUTHENTICATION_ERRORS = (
+    'org.bluez.Error.AuthenticationCanceled',
+    'org.bluez.Error.AuthenticationFailed',
+    'org.bluez.Error.AuthenticationRejected',
+    'org.bluez.Error.AuthenticationTimeout'
+)
+
+# operation: its steps, in order
+STEPS = {
+    'pair': ('pair', 'trust', 'connect'),
+    'connect': ('connect',),
+    'disconnect': ('disconnect',),
+    'unpair': ('remove',),
+}
+
+# step: BlueZ method, whether it is called on the adapter, fallback error code, abort method
+STEP_CALLS = {
+    'pair': ('Pair', False, 'CreatingDeviceFailed', 'CancelPairing'),
+    'trust': ('Set', False, 'TrustFailure', None),
+    'connect': ('Connect', False, 'ConnectionFailure', 'Disconnect'),
+    'disconnect': ('Disconnect', False, 'DisconnectFailure', None),
+    'remove': ('RemoveDevice', True, 'UnpairFailure', None),
+}
+
+# margin for the D-Bus call timeout, so that our deadline always fires first
+CALL_MARGIN = 5
+
+
+def pairing_error_code(error_name):
+    """
+    Map the D-Bus error of a failed ``Pair`` call to the code reported to our clients.
+
+    Args:
+        error_name (str): D-Bus error name, e.g. ``"org.bluez.Error.AuthenticationFailed"``
+
+    Returns:
+        str: ``"Timeout"``, ``"AuthenticationError"`` or ``"CreatingDeviceFailed"``
+    """
+    if error_name == 'org.freedesktop.DBus.Error.NoReply':
+        return 'Timeout'
+    if error_name in AUTHENTICATION_ERRORS:
+        return 'AuthenticationError'
+    return 'CreatingDeviceFailed'
+
+
+class DeviceOperation:
+    """
+    Args:
+        device_manager (DeviceManager): used to talk to BlueZ
+        operation (str): ``"pair"`` (pair, trust and connect), ``"connect"``, ``"disconnect"``
+            or ``"unpair"``
+        address (str): address of the device
+        done (callable): called with the results dictionary once the operation completes,
+            fails, expires or is cancelled: ``result``, ``code`` and on error the ``step`` that
+            failed (``pair``, ``trust``, ``connect``, ``disconnect`` or ``remove``). Pairing
+            errors use the codes of ``pairing_error_code()``, the others the D-Bus error name.
+        timeout (float): deadline in seconds, ``None`` for none
+        timeline (Timeline): marks the ``lookup``, ``agent`` and step phases when given
+        uuids (list): connect these profiles with ``ConnectProfile`` instead of calling
+            ``Connect``
+        agent (bool): (re-)register the pairing agent before pairing; callers pairing many
+            devices register it once themselves
+        steps (list): only run these steps of ``operation``, e.g. ``("pair", "trust")`` to pair
+            without connecting
+
+    Raises:
+        ValueError: unknown ``operation``
+    """
+
+    def __init__(self, device_manager, operation, address, done, timeout = None, timeline = None, uuids = (), agent = True, steps = None):
+        if operation not in STEPS:
+            raise ValueError('unknown operation: {!r}'.format(operation))
+        self.device_manager = device_manager
+        self.operation = operation
+        self.address = address
+        self.done = done
+        self.timeout = timeout
+        self.timeline = timeline
+        self.uuids = list(uuids)
+        self.agent = agent
+        self.steps = [step for step in STEPS[operation] if steps is None or step in steps]
+        self.step = None
+        self.finished = False
+        self.device = None
+        self.adapter = None
+        self._uuids = []
+        self._claimed = False
+        self._deadline = None
+
+    def _mark(self, phase):
+        if self.timeline is not None:
+            self.timeline.mark(phase)
+
+    def start(self, objects = None, adapter_pattern = None):
+        """
+        Look the device up and issue the first step.
+
+        Args:
+            objects (dict): an already fetched ``GetManagedObjects`` result to look the device
+                up in, instead of fetching the tree
+            adapter_pattern (str): only look for the device on this adapter
+
+        Raises:
+            DeviceNotFound: bluetooth device was not found in the dbus bluetooth database.
+
+        Any exception issuing the first step is raised as well, with the operation finished
+        (and ``done`` not called).
+        """
+        if objects is None:
+            objects = self.device_manager.get_managed_objects()
+        self.device = self.device_manager.find_device_in_objects(self.address, objects, adapter_pattern)
+        properties = objects[self.device.object_path][DEVICE_INTERFACE]
+        if self.operation == 'unpair':
+            self.adapter = self.device_manager.get_interface(self.device.object_path.rsplit('/', 1)[0], ADAPTER_INTERFACE)
+        self._mark('lookup')
+
+        if self.operation == 'pair':
+            if properties.get('Paired') and 'pair' in self.steps:
+                self.steps.remove('pair')
+            if properties.get('Trusted') and 'trust' in self.steps:
+                self.steps.remove('trust')
+        if properties.get('Connected') and 'connect' in self.steps and not self.uuids:
+            # profiles asked for by UUID may not be the ones that are connected
+            self.steps.remove('connect')
+        if 'pair' in self.steps and self.agent:
+            self.device_manager.register_agent()
+            self._mark('agent')
+
+        if not self.steps:
+            return self._finish('')
+        self.device_manager.claim(self.address)
+        self._claimed = True
+        if self.timeout is not None:
+            self._deadline = GLib.timeout_add(int(self.timeout * 1000), self._expired)
+        try:
+            self._run(self.steps[0])
+        except Exception:
+            self._release()
+            raise
+
+    def _run(self, step, uuids = None):
+        self.step = step
+        method, on_adapter, fallback, _ = STEP_CALLS[step]
+        call_timeout = PAIR_TIMEOUT if step == 'pair' else None
+        if self.timeout is not None:
+            call_timeout = self.timeout + CALL_MARGIN
+
+        kwargs = {'reply_handler': self._step_done, 'error_handler': self._step_failed}
+        if call_timeout is not None:
+            kwargs['timeout'] = call_timeout
+
+        if step == 'trust':
+            props = self.device_manager.get_interface(self.device.object_path, 'org.freedesktop.DBus.Properties')
+            stats.bluez_call('Set')
+            props.Set(DEVICE_INTERFACE, 'Trusted', True, **kwargs)
+        elif step == 'connect' and self.uuids:
+            # one profile after the other, _step_done moves on to the next
+            uuids = self.uuids if uuids is None else uuids
+            self._uuids = uuids[1:]
+            stats.bluez_call('ConnectProfile')
+            self.device.ConnectProfile(uuids[0], **kwargs)
+        elif on_adapter:
+            stats.bluez_call(method)
+            getattr(self.adapter, method)(self.device.object_path, **kwargs)
+        else:
+            stats.bluez_call(method)
+            getattr(self.device, method)(**kwargs)
+
+    def _step_done(self):
+        if self.finished:
+            return
+        if self.step == 'connect' and self.uuids and self._uuids:
+            return self._next('connect', self._uuids)
+
+        self._mark(self.step)
+        if self.step == 'remove':
+            self.device_manager.proxies.forget(self.device.object_path)
+
+        index = self.steps.index(self.step) + 1
+        if index == len(self.steps):
+            return self._finish('')
+        self._next(self.steps[index])
+
+    def _next(self, step, uuids = None):
+        # issue a further step from a reply handler, where nobody could catch an exception
+        try:
+            self._run(step, uuids)
+        except Exception as e:
+            logger.warning('unable to {} {}: {}', step, self.address, e)
+            self._finish(type(e).__name__, step)
+
+    def _step_failed(self, e):
+        if self.finished:
+            return
+        self._mark(self.step)
+        method, _, fallback, abort = STEP_CALLS[self.step]
+        name = e.get_dbus_name() if isinstance(e, dbus.exceptions.DBusException) else ''
+        stats.inc('bluez_errors', name or fallback)
+        code = pairing_error_code(name) if self.step == 'pair' else name or fallback
+        if code == 'Timeout':
+            # BlueZ gave up replying, make sure it gives up pairing too
+            self._abort(abort)
+        self._finish(code, self.step)
+
+    def _expired(self):
+        self._deadline = None
+        stats.inc('deadlines_expired', self.operation)
+        self.cancel('Timeout')
+        return False
+
+    def _abort(self, method):
+        if method and self.device is not None:
+            stats.bluez_call(method)
+            getattr(self.device, method)(reply_handler = lambda: None, error_handler = lambda e: None)
+
+    def cancel(self, code = 'Canceled'):
+        """
+        Abort the operation: the BlueZ call in flight is cancelled where BlueZ allows it and the
+        operation completes with ``code``.
+
+        Returns:
+            bool: whether the operation was still in flight
+        """
+        if self.finished:
+            return False
+
+        if self.step is not None:
+            self._abort(STEP_CALLS[self.step][3])
+        self._mark('cancel')
+        self._finish(code, self.step)
+        return True
+
+    def _release(self):
+        self.finished = True
+        if self._deadline is not None:
+            GLib.source_remove(self._deadline)
+            self._deadline = None
+        if self._claimed:
+            self._claimed = False
+            self.device_manager.release(self.address)
+
+    def _finish(self, code, step = None):
+        self._release()
+        results = {'result': 'Error' if code else 'Success', 'code': code}
+        if code and step:
+            results['step'] = step
+        self.done(results)
@@ -0,0 +1,134 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+"""
+On-demand profiling of the running service, driven from the Support interface.
+
+Two kinds of capture are supported:
+
+    * ``cpu``: ``cProfile`` of the main loop thread, written as a pstats file (``*.pstats``)
+    * ``memory``: ``tracemalloc`` allocation tracking, written as a snapshot (``*.tracemalloc``)
+
+Captures are written to ``BJARKAN_PROFILE_DIR`` (defaults to ``/var/tmp/bjarkan``). Nothing is
+imported or hooked until a capture is started, so there is no cost while profiling is off.
+
+    .. code-block:: bash
+
+        busctl call com.getwellnetwork.plc.bjarkan1 /com/getwellnetwork/plc/bjarkan1/Support \\
+            com.getwellnetwork.plc.Support1 StartProfiling su cpu 30
+        python3 -m pstats /var/tmp/bjarkan/bjarkan-cpu-20171115T192827.pstats
+"""
+
+import os
+import time
+
+from gi.repository import GLib
+
+from .logger import logger
+
+
+KINDS = ('cpu', 'memory')
+MAX_DURATION = 600
+
+
+class Profiler:
+    """
+    Runs at most one capture at a time and stops it by itself after ``duration`` seconds.
+    """
+
+    def __init__(self, directory = None):
+        self.directory = directory or os.getenv('BJARKAN_PROFILE_DIR', '/var/tmp/bjarkan')
+        self.kind = None
+        self.path = None
+        self._profile = None
+        self._timeout = None
+
+    @property
+    def running(self):
+        return self.kind is not None
+
+    def start(self, kind, duration):
+        """
+        Start a capture.
+
+        Args:
+            kind (str): ``"cpu"`` or ``"memory"``
+            duration (int): seconds after which the capture is stopped and written
+
+        Returns:
+            str: path the capture will be written to
+
+        Raises:
+            ValueError: unknown ``kind`` or a ``duration`` out of range
+            RuntimeError: a capture is already running
+        """
+        if kind not in KINDS:
+            raise ValueError('unknown profiling kind: {!r}'.format(kind))
+        if not 0 < duration <= MAX_DURATION:
+            raise ValueError('duration must be between 1 and {} seconds'.format(MAX_DURATION))
+        if self.running:
+            raise RuntimeError('{} profiling is already running'.format(self.kind))
+
+        os.makedirs(self.directory, exist_ok = True)
+        suffix = 'pstats' if kind == 'cpu' else 'tracemalloc'
+        self.path = os.path.join(
+            self.directory,
+            'bjarkan-{}-{}.{}'.format(kind, time.strftime('%Y%m%dT%H%M%S'), suffix)
+        )
+
+        if kind == 'cpu':
+            import cProfile
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            import tracemalloc
+            tracemalloc.start(25)
+
+        self.kind = kind
+        self._timeout = GLib.timeout_add_seconds(duration, self._expired)
+        logger.info('started {} profiling for {}s, writing to {}', kind, duration, self.path)
+        return self.path
+
+    def stop(self):
+        """
+        Stop the running capture and write it out.
+
+        Returns:
+            str: path of the written capture
+
+        Raises:
+            RuntimeError: no capture is running
+        """
+        if not self.running:
+            raise RuntimeError('profiling is not running')
+
+        if self._timeout is not None:
+            GLib.source_remove(self._timeout)
+            self._timeout = None
+
+        try:
+            if self.kind == 'cpu':
+                self._profile.disable()
+                self._profile.dump_stats(self.path)
+            else:
+                import tracemalloc
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+                snapshot.dump(self.path)
+        finally:
+            logger.info('stopped {} profiling, wrote {}', self.kind, self.path)
+            self.kind = None
+            self._profile = None
+
+        return self.path
+
+    def _expired(self):
+        self._timeout = None
+        try:
+            self.stop()
+        except OSError as e:
+            logger.error('unable to write profile: {}', e)
+
+        return False
+
+    def as_dict(self):
+        return {'running': self.kind, 'path': self.path, 'directory': self.directory}
@@ -0,0 +1,295 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+"""
+Bulk pairing from a provisioning manifest.
+
+The manifest is a CSV file with one device per row: its address and, optionally, the adapter
+(``hci0`` or its address) it is to be paired with. A header row naming the ``address`` and
+``adapter`` columns is optional; blank lines and lines starting with ``#`` are ignored. Devices
+without an adapter go to the least busy adapter that knows them.
+
+Devices are paired, trusted and connected with ``DeviceManager.pair_and_connect``, a few at a
+time on every adapter. The agent is registered and the object tree fetched once for the whole
+run. Every outcome is appended to a state file as it happens (one JSON object per line), so a
+rerun after a failure or interruption skips the devices already done.
+"""
+
+import csv
+import json
+import time
+
+import dbus
+from gi.repository import GLib
+
+from . import ADAPTER_INTERFACE, DEVICE_INTERFACE, SERVICE_NAME, DeviceNotFound
+from .logger import logger
+from .stats import stats
+
+
+def read_manifest(path):
+    """
+    Returns:
+        list: ``(address, adapter)`` tuples, ``adapter`` is ``None`` when not given
+
+    Raises:
+        ValueError: a row has no address, or the header no ``address`` column; the message
+            names the line
+    """
+    devices = []
+    with open(path, newline = '') as f:
+        reader = csv.reader(f)
+        rows = [(reader.line_num, row) for row in reader if any(cell.strip() for cell in row) and not row[0].startswith('#')]
+
+    columns = {'address': 0, 'adapter': 1}
+    if rows and {'address', 'adapter'} & {cell.strip().lower() for cell in rows[0][1]}:
+        line, header = rows.pop(0)
+        header = [cell.strip().lower() for cell in header]
+        if 'address' not in header:
+            raise ValueError('{}:{}: no address column in the header'.format(path, line))
+        columns = {name: header.index(name) for name in ('address', 'adapter') if name in header}
+
+    for line, row in rows:
+        address = row[columns['address']].strip().upper() if len(row) > columns['address'] else ''
+        if not address:
+            raise ValueError('{}:{}: no device address'.format(path, line))
+        adapter = None
+        if 'adapter' in columns and len(row) > columns['adapter']:
+            adapter = row[columns['adapter']].strip() or None
+        devices.append((address, adapter))
+
+    return devices
+
+
+def read_state(path):
+    """
+    Returns:
+        set: addresses that were successfully provisioned according to the state file
+    """
+    done = set()
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a line cut short by an interruption
+                    continue
+                if record.get('result') == 'Success':
+                    done.add(record['address'])
+    except FileNotFoundError:
+        pass
+
+    return done
+
+
+class Provisioner:
+    """
+    Args:
+        device_manager (DeviceManager): used to talk to BlueZ
+        devices (list): ``(address, adapter)`` tuples, see ``read_manifest()``
+        state_path (str): the state file, appended to as devices complete
+        per_adapter (int): devices paired concurrently on each adapter
+        scan (int): seconds to discover devices the adapters do not know yet, ``0`` to not
+            discover
+        output (callable): called with a line of progress for each device
+    """
+
+    def __init__(self, device_manager, devices, state_path, per_adapter = 1, scan = 0, output = None):
+        self.device_manager = device_manager
+        self.devices = devices
+        self.state_path = state_path
+        self.per_adapter = max(1, per_adapter)
+        self.scan = scan
+        self.output = output or (lambda line: None)
+        self.results = []
+        self.skipped = 0
+        self.running = 0
+        self.mainloop = None
+        self.state = None
+
+    def run(self):
+        """
+        Provision every device not done yet; blocks until all of them are handled.
+
+        Returns:
+            dict: the summary, see ``summary()``
+        """
+        self.started = time.monotonic()
+        done = read_state(self.state_path)
+        todo = [(address, adapter) for address, adapter in self.devices if address not in done]
+        self.skipped = len(self.devices) - len(todo)
+        if not todo:
+            return self.summary()
+
+        self.mainloop = GLib.MainLoop()
+        objects = self.device_manager.get_managed_objects()
+        if self.scan and any(not self._adapter_paths(objects, address, adapter) for address, adapter in todo):
+            objects = self._discover(objects, todo)
+
+        self.device_manager.register_agent()
+        self.objects = objects
+        self.running = 0
+        self.state = open(self.state_path, 'a+')
+        if self.state.tell():
+            # terminate a line cut short by an interruption
+            self.state.seek(self.state.tell() - 1)
+            if self.state.read(1) != '\n':
+                self.state.write('\n')
+        try:
+            queues = {}
+            for address, adapter in todo:
+                paths = self._adapter_paths(objects, address, adapter)
+                if not paths:
+                    self._record(address, adapter, {'result': 'Error', 'code': 'DeviceNotFound'}, 0)
+                    continue
+                # spread devices known to several adapters over the least busy one
+                path = min(paths, key = lambda path: len(queues.get(path, ())))
+                queues.setdefault(path, []).append((address, adapter))
+
+            for path, queue in queues.items():
+                queue.reverse()
+                for _ in range(min(self.per_adapter, len(queue))):
+                    self.running += 1
+                    GLib.idle_add(self._next, path, queue)
+            if self.running:
+                self.mainloop.run()
+        finally:
+            self.state.close()
+
+        return self.summary()
+
+    def _adapter_paths(self, objects, address, adapter):
+        """
+        Returns:
+            list: object paths of the adapters the device is known to (and could be paired
+            with), only the one of ``adapter`` when given; empty when it is not known
+        """
+        if adapter:
+            try:
+                device = self.device_manager.find_device_in_objects(address, objects, adapter)
+            except DeviceNotFound:
+                return []
+            return [str(device.object_path).rsplit('/', 1)[0]]
+
+        return [
+            str(path).rsplit('/', 1)[0]
+            for path, ifaces in objects.items()
+            if str(ifaces.get(DEVICE_INTERFACE, {}).get('Address', '')).upper() == address
+        ]
+
+    def _discover(self, objects, todo):
+        """
+        Discover on every adapter until all devices are known or ``scan`` seconds have passed.
+        """
+        missing = {address for address, adapter in todo if not self._adapter_paths(objects, address, adapter)}
+        logger.info('discovering {} unknown devices for up to {}s', len(missing), self.scan)
+        adapters = [
+            self.device_manager.get_interface(path, ADAPTER_INTERFACE)
+            for path, ifaces in objects.items() if ADAPTER_INTERFACE in ifaces
+        ]
+
+        def added(path, interfaces):
+            address = str(interfaces.get(DEVICE_INTERFACE, {}).get('Address', '')).upper()
+            missing.discard(address)
+            if not missing:
+                self.mainloop.quit()
+
+        receiver = self.device_manager.bus.add_signal_receiver(
+            added,
+            signal_name = 'InterfacesAdded',
+            dbus_interface = 'org.freedesktop.DBus.ObjectManager',
+            bus_name = SERVICE_NAME
+        )
+        for adapter in adapters:
+            stats.bluez_call('StartDiscovery')
+            adapter.StartDiscovery()
+        timeout = {}
+
+        def expired():
+            del timeout['source']
+            self.mainloop.quit()
+            return False
+
+        timeout['source'] = GLib.timeout_add_seconds(self.scan, expired)
+        try:
+            if missing:
+                self.mainloop.run()
+        finally:
+            if 'source' in timeout:
+                GLib.source_remove(timeout['source'])
+            receiver.remove()
+            for adapter in adapters:
+                try:
+                    adapter.StopDiscovery()
+                except dbus.exceptions.DBusException:
+                    pass
+
+        return self.device_manager.get_managed_objects()
+
+    def _next(self, path, queue):
+        """
+        Start the next device of ``queue`` in a slot of ``running``, or free the slot. Always
+        scheduled from the main loop, so a run of immediate failures does not recurse.
+        """
+        if not queue:
+            self.running -= 1
+            if not self.running:
+                self.mainloop.quit()
+            return False
+
+        address, adapter = queue.pop()
+        started = time.monotonic()
+
+        def done(results):
+            self._record(address, adapter, results, time.monotonic() - started)
+            GLib.idle_add(self._next, path, queue)
+
+        try:
+            self.device_manager.pair_and_connect(address, done, objects = self.objects, adapter_pattern = path, agent = False)
+        except Exception as e:
+            done({'result': 'Error', 'code': type(e).__name__})
+        return False
+
+    def _record(self, address, adapter, results, seconds):
+        record = {
+            'time': time.time(),
+            'address': address,
+            'adapter': adapter,
+            'result': results['result'],
+            'code': results['code'],
+            'step': results.get('step', ''),
+            'seconds': round(seconds, 3),
+        }
+        self.results.append(record)
+        stats.inc('provisioned', results['code'] or results['result'])
+        self.state.write(json.dumps(record) + '\n')
+        self.state.flush()
+        self.output('{} {} {}{}'.format(
+            address,
+            record['result'],
+            record['code'],
+            ' ({})'.format(record['step']) if record['step'] else ''
+        ))
+
+    def summary(self):
+        """
+        Returns:
+            dict: ``total`` devices in the manifest, ``skipped`` (done by an earlier run),
+            ``succeeded``, ``failed``, ``failures`` by code, ``seconds`` of the run and
+            ``per_minute``: devices handled per minute
+        """
+        seconds = time.monotonic() - self.started
+        failures = {}
+        for record in self.results:
+            if record['result'] != 'Success':
+                failures[record['code']] = failures.get(record['code'], 0) + 1
+
+        return {
+            'total': len(self.devices),
+            'skipped': self.skipped,
+            'succeeded': len(self.results) - sum(failures.values()),
+            'failed': sum(failures.values()),
+            'failures': failures,
+            'seconds': round(seconds, 1),
+            'per_minute': round(len(self.results) / seconds * 60, 1) if seconds else 0.0,
+        }
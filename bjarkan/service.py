@@ -24,23 +24,147 @@ Examples:
         )
 """
 
+import os
+import uuid
+
 import dbus.service
+from gi.repository import GLib
 
-from . import BUSNAME, OBJECTPATH, INTERFACE
-from .device_manager import DeviceManager
+from . import BUSNAME, OBJECTPATH, INTERFACE, SERVICE_NAME, ADAPTER_INTERFACE, DEVICE_INTERFACE, ADVERTISEMENT_SIGNATURE
+from .device_manager import DeviceManager, address_from_path, pairing_error_code
+from .discovery import DiscoverySessions
 from .logger import logger
-from .list_devices import connected_devices, paired_devices, all_devices, gather_device_info
+from .operations import DeviceOperation
+from .list_devices import gather_device_info, device_records, DEVICE_RECORD_SIGNATURE
+from .singleflight import SingleFlight
+from .waiters import StateWaiters
+from .stats import stats, Timeline
 
 
 class ManagerService(dbus.service.Object):
 
     def __init__(self):
-        bus_name = dbus.service.BusName(BUSNAME, bus = dbus.SystemBus())
+        bus = dbus.SystemBus()
+        bus_name = dbus.service.BusName(BUSNAME, bus = bus)
         super().__init__(bus_name = bus_name, object_path = OBJECTPATH)
         self.device_manager = DeviceManager()
+        self.discovery = DiscoverySessions(bus, self.device_manager)
+        # optional features are only loaded when used, to keep (activation) startup short
+        self.evictor = None
+        if int(os.getenv('BJARKAN_EVICT_TTL', '0')) > 0:
+            from .eviction import DeviceEvictor
+            self.evictor = DeviceEvictor(self.device_manager)
+        self.connected = set()
+        self.inflight = SingleFlight()
+        self.operations = {}
+        self.waiters = StateWaiters()
+        self.advertisement_feed = None
+        self.advertisement_subscribers = {}
+        bus.add_signal_receiver(
+            self._bluez_signal,
+            bus_name = SERVICE_NAME,
+            member_keyword = 'member',
+            path_keyword = 'path'
+        )
+        self._seed_state()
+        if self.evictor is not None:
+            self.evictor.start()
+
+    def _seed_state(self):
+        """
+        Take the initial connected devices and discovery state from BlueZ, from here on they are
+        kept up to date from signals. The object tree is fetched asynchronously, so that the
+        first request (the one that activated the service) is answered right away; a listing
+        arriving meanwhile shares the fetch.
+        """
+        def seeded(objects):
+            for path, ifaces in objects.items():
+                if ifaces.get(DEVICE_INTERFACE, {}).get('Connected'):
+                    self.connected.add(str(path))
+                if ADAPTER_INTERFACE in ifaces:
+                    stats.duty('discovery', str(path), bool(ifaces[ADAPTER_INTERFACE].get('Discovering')))
+            stats.set_gauge('connected_devices', '', len(self.connected))
+
+        def failed(e):
+            logger.warning('unable to fetch initial BlueZ state: {}', e.get_dbus_name() if isinstance(e, dbus.exceptions.DBusException) else e)
+
+        self._snapshot(seeded, failed)
+        self.device_manager.register_agent(
+            reply_handler = lambda: logger.debug('pairing agent registered'),
+            error_handler = lambda e: logger.warning('unable to register the pairing agent: {}', e)
+        )
+
+    def busy(self):
+        """
+        Returns:
+            bool: whether any operation, discovery session, wait or subscription is active, i.e.
+            whether the service must not exit when idle
+        """
+        agent = getattr(self.device_manager, 'agent', None)
+        return bool(
+            any(value for (name, label), value in stats.gauges.items() if name == 'inflight') or
+            self.discovery.sessions or
+            len(self.inflight) or
+            self.operations or
+            len(self.waiters) or
+            self.advertisement_subscribers or
+            (agent is not None and agent.pending)
+        )
+
+    def _bluez_signal(self, *args, member = None, path = None):
+        stats.mark('bluez_signals', member)
+        if member == 'PropertiesChanged':
+            interface, changed = args[0], args[1]
+            if interface == DEVICE_INTERFACE:
+                if self.evictor is not None:
+                    self.evictor.seen(path)
+                if self.waiters.waiters:
+                    self.waiters.changed(address_from_path(path), changed)
+            if interface == DEVICE_INTERFACE and 'Connected' in changed:
+                if changed['Connected']:
+                    self.connected.add(path)
+                else:
+                    self.connected.discard(path)
+                stats.set_gauge('connected_devices', '', len(self.connected))
+            elif interface == ADAPTER_INTERFACE and 'Discovering' in changed:
+                stats.duty('discovery', path, bool(changed['Discovering']))
+        elif member == 'InterfacesAdded':
+            if DEVICE_INTERFACE in args[1] and self.evictor is not None:
+                self.evictor.seen(args[0])
+        elif member == 'InterfacesRemoved':
+            self.device_manager.proxies.forget(args[0])
+            if self.evictor is not None:
+                self.evictor.forget(args[0])
+            if str(args[0]) in self.connected:
+                self.connected.discard(str(args[0]))
+                stats.set_gauge('connected_devices', '', len(self.connected))
+
+    def _snapshot(self, reply, error):
+        """
+        Fetch the BlueZ object tree asynchronously; concurrent listings share one fetch.
+        """
+        self.inflight.join(
+            ('GetManagedObjects',),
+            reply,
+            error,
+            lambda resolve, reject: self.device_manager.get_managed_objects(resolve, reject)
+        )
+
+    def _format_results(self, results, timeline = None):
+        formatted = {'result': results['result'], 'code': results['code']}
+        if timeline is not None:
+            stats.record_timeline(timeline)
+            formatted['phases'] = dbus.Dictionary(timeline.as_dict(), signature = 'sd')
 
-    def _format_results(self, results):
-        return {'result': results['result'], 'code': results['code']}
+        return formatted
+
+    def _pairing_payload(self, device, result, code, timeline):
+        stats.record_timeline(timeline)
+        payload = {'address': device, 'result': result, 'code': code}
+        for phase, ms in timeline.as_dict().items():
+            payload['phase.' + phase] = str(ms)
+
+        return payload
 
     def _format_device_data(self, devices):
         data = []
@@ -56,25 +180,55 @@ class ManagerService(dbus.service.Object):
 
         return data
 
-    def _success(self):
+    def _success(self, device, timeline):
         logger.info('successfully paired')
-        self.device_manager.trust_device(self.pairing_device)
-        self.device_manager.connect_device(self.pairing_device)
-        payload = {'result': 'Success', 'code': ''}
-        self.PairingComplete(payload)
-
-    def _error(self):
+        timeline.mark('pair')
+        stats.gauge('inflight', 'pair', -1)
+        self.discovery.unhold()
+
+        def done(results):
+            code = results['code']
+            stats.inc('pairing_outcomes', code or 'Success')
+            payload = self._pairing_payload(device, results['result'], code, timeline)
+            if 'step' in results:
+                payload['step'] = results['step']
+            self.PairingComplete(payload)
+
+        def failed(e):
+            name = e.get_dbus_name() if isinstance(e, dbus.exceptions.DBusException) else type(e).__name__
+            logger.warning('unable to trust {}: {}', device, name)
+            done({'result': 'Error', 'code': 'TrustFailure', 'step': 'trust'})
+
+        def trust(objects):
+            # trust and connect asynchronously, we are inside the reply handler of Pair
+            operation = DeviceOperation(self.device_manager, 'pair', device, done, timeline = timeline, agent = False, steps = ('trust', 'connect'))
+            try:
+                with stats.attributed('Pair'):
+                    operation.start(objects)
+            except Exception as e:
+                failed(e)
+
+        self._snapshot(trust, failed)
+
+    def _error(self, device, timeline, err):
         logger.info('failed to pair device')
-        if err == 'org.freedesktop.DBus.Error.NoReply' and self.dev:
-            code = 'Timeout'
-            device_manager.cancel_device(self.pairing_device)
-        if err in ('org.bluez.Error.AuthenticationCanceled', 'org.bluez.Error.AuthenticationFailed',
-                'org.bluez.Error.AuthenticationRejected', 'org.bluez.Error.AuthenticationTimeout'):
-            code = 'AuthenticationError'
-        else:
-            code = 'CreatingDeviceFailed'
-
-        payload = {'result': 'Error', 'code': code}
+        timeline.mark('pair')
+        stats.gauge('inflight', 'pair', -1)
+        self.discovery.unhold()
+        name = err.get_dbus_name() if isinstance(err, dbus.exceptions.DBusException) else str(err)
+        stats.inc('bluez_errors', name)
+        code = pairing_error_code(name)
+        if code == 'Timeout':
+            try:
+                with stats.attributed('Pair'):
+                    self.device_manager.cancel_device(device)
+            except Exception as e:
+                # the signal is due whether or not BlueZ could be told to give up
+                logger.warning('unable to cancel pairing {}: {}', device, e)
+            timeline.mark('cancel')
+
+        stats.inc('pairing_outcomes', code)
+        payload = self._pairing_payload(device, 'Error', code, timeline)
         self.PairingComplete(payload)
 
 
@@ -87,8 +241,219 @@ class ManagerService(dbus.service.Object):
             device (str): device's bluetooth address
         """
         logger.info('Attempting to pair to {}', device)
-        self.pairing_device = device
-        self.device_manager.pair_device(device, self._success, self._error)
+        with stats.operation('Pair'):
+            timeline = Timeline('Pair')
+            self.discovery.hold()
+            try:
+                self.device_manager.pair_device(
+                    device,
+                    lambda: self._success(device, timeline),
+                    lambda err: self._error(device, timeline, err),
+                    timeline
+                )
+            except Exception:
+                self.discovery.unhold()
+                raise
+            stats.gauge('inflight', 'pair', 1)
+
+    @dbus.service.method(INTERFACE, in_signature = 'sas', out_signature = 'a{sv}', async_callbacks = ('reply', 'error'))
+    def PairAndConnect(self, device, uuids, reply, error):
+        """
+        Pair, trust and connect the specified device in one pipelined workflow. The device is
+        resolved once and each step runs asynchronously over the same proxies.
+
+        Args:
+            device (str): device's bluetooth address
+            uuids (list): profile UUIDs to connect with ``ConnectProfile``; all auto-connectable
+                profiles are connected when empty
+
+        Returns:
+            results (dict): ``result``, ``code``, the ``step`` that failed (``pair``, ``trust``
+            or ``connect``) on error and the milliseconds spent in each phase (``phases``)
+        """
+        logger.info('Attempting to pair and connect to {}', device)
+        with stats.operation('PairAndConnect', reply, error) as (reply, error):
+            timeline = Timeline('PairAndConnect')
+
+            def done(results):
+                stats.gauge('inflight', 'pair', -1)
+                self.discovery.unhold()
+                stats.inc('pairing_outcomes', results['code'] if results.get('step') == 'pair' else 'Success')
+                formatted = self._format_results(results, timeline)
+                if 'step' in results:
+                    formatted['step'] = results['step']
+                reply(formatted)
+
+            self.discovery.hold()
+            try:
+                self.device_manager.pair_and_connect(device, done, [str(uuid) for uuid in uuids], timeline)
+            except Exception:
+                self.discovery.unhold()
+                raise
+            stats.gauge('inflight', 'pair', 1)
+
+    def _operation(self, operation, device, options, reply, error):
+        """
+        Run a ``DeviceOperation`` with the deadline and id given in ``options``.
+        """
+        options = {str(key): value for key, value in options.items()}
+        operation_id = str(options.get('operation_id') or uuid.uuid4().hex)
+        timeout = float(options['timeout']) if options.get('timeout') else None
+        if operation_id in self.operations:
+            raise ValueError('operation already in flight: {}'.format(operation_id))
+
+        logger.info('Attempting to {} {} (operation {}, timeout {})', operation, device, operation_id, timeout)
+        timeline = Timeline(operation.capitalize())
+
+        def done(results):
+            self.operations.pop(operation_id, None)
+            stats.gauge('inflight', operation, -1)
+            self.discovery.unhold()
+            formatted = self._format_results(results, timeline)
+            formatted['operation_id'] = operation_id
+            if 'step' in results:
+                formatted['step'] = results['step']
+            reply(formatted)
+
+        pending = DeviceOperation(self.device_manager, operation, str(device), done, timeout, timeline)
+        self.operations[operation_id] = pending
+        self.discovery.hold()
+        stats.gauge('inflight', operation, 1)
+        try:
+            pending.start()
+        except Exception:
+            self.operations.pop(operation_id, None)
+            stats.gauge('inflight', operation, -1)
+            self.discovery.unhold()
+            raise
+
+    @dbus.service.method(INTERFACE, in_signature = 'sa{sv}', out_signature = 'a{sv}', async_callbacks = ('reply', 'error'))
+    def PairWithOptions(self, device, options, reply, error):
+        """
+        Pair, trust and connect the specified device, with a deadline.
+
+        Args:
+            device (str): device's bluetooth address
+            options (dict): ``timeout`` (seconds, ``d``) after which the pairing is cancelled
+                (or the connection attempt aborted) and ``"Timeout"`` is returned, and
+                ``operation_id`` (``s``) to ``Cancel`` the operation with; an id is generated
+                when omitted
+
+        Returns:
+            results (dict): ``result``, ``code``, ``operation_id`` and the milliseconds spent in
+            each phase (``phases``)
+        """
+        with stats.operation('PairWithOptions', reply, error) as (reply, error):
+            self._operation('pair', device, options, reply, error)
+
+    @dbus.service.method(INTERFACE, in_signature = 'sa{sv}', out_signature = 'a{sv}', async_callbacks = ('reply', 'error'))
+    def ConnectWithOptions(self, device, options, reply, error):
+        """
+        Connect to the specified device, with a deadline; see ``PairWithOptions`` for
+        ``options``. An expired connection attempt is aborted with ``Disconnect``.
+        """
+        with stats.operation('ConnectWithOptions', reply, error) as (reply, error):
+            self._operation('connect', device, options, reply, error)
+
+    @dbus.service.method(INTERFACE, in_signature = 'sa{sv}', out_signature = 'a{sv}', async_callbacks = ('reply', 'error'))
+    def DisconnectWithOptions(self, device, options, reply, error):
+        """
+        Disconnect from the specified device, with a deadline; see ``PairWithOptions`` for
+        ``options``.
+        """
+        with stats.operation('DisconnectWithOptions', reply, error) as (reply, error):
+            self._operation('disconnect', device, options, reply, error)
+
+    @dbus.service.method(INTERFACE, in_signature = 'sa{sv}', out_signature = 'a{sv}', async_callbacks = ('reply', 'error'))
+    def UnpairWithOptions(self, device, options, reply, error):
+        """
+        Unpair from the specified device, with a deadline; see ``PairWithOptions`` for
+        ``options``.
+        """
+        with stats.operation('UnpairWithOptions', reply, error) as (reply, error):
+            self._operation('unpair', device, options, reply, error)
+
+    @dbus.service.method(INTERFACE, in_signature = 's', out_signature = 'b')
+    def Cancel(self, operation_id):
+        """
+        Cancel an operation started by one of the ``...WithOptions`` methods. It completes with
+        code ``"Canceled"``.
+
+        Args:
+            operation_id (str): the ``operation_id`` of the operation
+
+        Returns:
+            cancelled (bool): ``False`` if no such operation is in flight
+        """
+        logger.info('Cancelling operation {}', operation_id)
+        with stats.operation('Cancel'):
+            pending = self.operations.get(str(operation_id))
+            return bool(pending and pending.cancel())
+
+    @dbus.service.method(INTERFACE, in_signature = 'a{sv}', out_signature = 'a{sv}', sender_keyword = 'sender', async_callbacks = ('reply', 'error'))
+    def PairNearest(self, options, sender = None, reply = None, error = None):
+        """
+        Run a short discovery, pick the unpaired device with the strongest averaged signal and
+        pair, trust and connect it like ``PairAndConnect``.
+
+        Args:
+            options (dict): ``icon`` (``s``) only considers devices with this icon,
+                ``min_rssi`` (``n``) only devices averaging at least this RSSI, ``duration``
+                (``d``) the longest discovery in seconds (default 10), ``timeout`` (``d``)
+                seconds after which pairing the picked device is aborted with ``"Timeout"``
+
+        Returns:
+            results (dict): ``result``, ``code`` (``"NoDeviceFound"`` when nothing qualified),
+            the ``address`` picked, the failed ``step`` on error and ``phases``
+        """
+        from .nearest import NearestDevice
+
+        options = {str(key): value for key, value in options.items()}
+        logger.info('Attempting to pair the nearest device ({})', options)
+        with stats.operation('PairNearest', reply, error) as (reply, error):
+            finder = NearestDevice(
+                self.device_manager,
+                icon = str(options['icon']) if options.get('icon') else None,
+                min_rssi = int(options['min_rssi']) if 'min_rssi' in options else None,
+                duration = float(options.get('duration', 10)),
+                start_discovery = lambda: self.discovery.acquire(sender),
+                stop_discovery = lambda: self.discovery.release(sender),
+                snapshot = self._snapshot
+            )
+            timeout = float(options['timeout']) if 'timeout' in options else None
+
+            def found(address):
+                if address is None:
+                    return reply({'result': 'Error', 'code': 'NoDeviceFound', 'address': ''})
+
+                logger.info('Nearest device is {}', address)
+                timeline = Timeline('PairNearest')
+
+                def done(results):
+                    stats.gauge('inflight', 'pair', -1)
+                    self.discovery.unhold()
+                    formatted = self._format_results(results, timeline)
+                    formatted['address'] = address
+                    if 'step' in results:
+                        formatted['step'] = results['step']
+                    reply(formatted)
+
+                def failed(e):
+                    stats.gauge('inflight', 'pair', -1)
+                    self.discovery.unhold()
+                    error(e)
+
+                def pair(objects):
+                    try:
+                        self.device_manager.pair_and_connect(address, done, timeline = timeline, objects = objects, timeout = timeout)
+                    except Exception as e:
+                        failed(e)
+
+                self.discovery.hold()
+                stats.gauge('inflight', 'pair', 1)
+                self._snapshot(pair, failed)
+
+            finder.start(found, error)
 
     @dbus.service.method(INTERFACE, in_signature = 's', out_signature = 'a{sv}')
     def Unpair(self, device):
@@ -99,24 +464,47 @@ class ManagerService(dbus.service.Object):
             device (str): device's bluetooth address
 
         Returns:
-            results (dict): return message and code of the operation
+            results (dict): return message, code and the milliseconds spent in each phase
+            (``phases``) of the operation
         """
         logger.info('Attempting to unpair to {}', device)
-        return self._format_results(self.device_manager.unpair_device(device))
+        with stats.operation('Unpair'):
+            timeline = Timeline('Unpair')
+            return self._format_results(self.device_manager.unpair_device(device, timeline), timeline)
 
-    @dbus.service.method(INTERFACE, in_signature = 's', out_signature = 'a{sv}')
-    def Connect(self, device):
+    @dbus.service.method(INTERFACE, in_signature = 's', out_signature = 'a{sv}', async_callbacks = ('reply', 'error'))
+    def Connect(self, device, reply, error):
         """
-        Connect to the specified device after pairing has already been authenticated
+        Connect to the specified device after pairing has already been authenticated. Callers
+        asking for the same device while a connection attempt is in flight share its result.
 
         Args:
             device (str): device's bluetooth address
 
         Returns:
-            results (dict): return message and code of the operation
+            results (dict): return message, code and the milliseconds spent in each phase
+            (``phases``) of the operation
         """
         logger.info('Attempting to connect to {}', device)
-        return self._format_results(self.device_manager.connect_device(device))
+        with stats.operation('Connect', reply, error) as (reply, error):
+            timeline = Timeline('Connect')
+
+            def start(resolve, reject):
+                def done(results):
+                    stats.gauge('inflight', 'connect', -1)
+                    self.discovery.unhold()
+                    resolve(self._format_results(results, timeline))
+
+                self.discovery.hold()
+                stats.gauge('inflight', 'connect', 1)
+                try:
+                    self.device_manager.connect_device_async(str(device), done, timeline)
+                except Exception:
+                    stats.gauge('inflight', 'connect', -1)
+                    self.discovery.unhold()
+                    raise
+
+            self.inflight.join(('Connect', str(device)), reply, error, start)
 
     @dbus.service.method(INTERFACE, in_signature = 's', out_signature = 'a{sv}')
     def Disconnect(self, device):
@@ -127,58 +515,360 @@ class ManagerService(dbus.service.Object):
             device (str): device's bluetooth address
 
         Returns:
-            results (dict): return message and code of the operation
+            results (dict): return message, code and the milliseconds spent in each phase
+            (``phases``) of the operation
         """
         logger.info('Attempting to disconnect from {}', device)
-        return self._format_results(self.device_manager.disconnect_device(device))
+        with stats.operation('Disconnect'):
+            timeline = Timeline('Disconnect')
+            return self._format_results(self.device_manager.disconnect_device(device, timeline), timeline)
+
+    def _batch(self, operation, devices, reply):
+        logger.info('Attempting to {} {} devices', operation, len(devices))
+        timeline = Timeline(operation.capitalize() + 'Many')
+
+        def done(results):
+            stats.gauge('inflight', operation, -len(devices))
+            self.discovery.unhold()
+            timeline.mark(operation)
+            stats.record_timeline(timeline)
+            for address, result, code in results:
+                stats.inc('batch_outcomes', code or result)
+            reply(dbus.Array(results, signature = '(sss)'))
+
+        # like the single device operations, keep discovery paused for the whole batch
+        self.discovery.hold()
+        stats.gauge('inflight', operation, len(devices))
+        try:
+            self.device_manager.batch(operation, [str(device) for device in devices], done)
+        except Exception:
+            stats.gauge('inflight', operation, -len(devices))
+            self.discovery.unhold()
+            raise
+
+    @dbus.service.method(INTERFACE, in_signature = 'as', out_signature = 'a(sss)', async_callbacks = ('reply', 'error'))
+    def ConnectMany(self, devices, reply, error):
+        """
+        Connect several devices in one call. All addresses are resolved against one snapshot of
+        the BlueZ object tree and the connections run concurrently, up to ``BJARKAN_BATCH_LIMIT``.
+
+        Args:
+            devices (list): the devices' bluetooth addresses
+
+        Returns:
+            results (list): ``(address, result, code)`` per device, in the order given
+        """
+        with stats.operation('ConnectMany', reply, error) as (reply, error):
+            self._batch('connect', devices, reply)
+
+    @dbus.service.method(INTERFACE, in_signature = 'as', out_signature = 'a(sss)', async_callbacks = ('reply', 'error'))
+    def DisconnectMany(self, devices, reply, error):
+        """
+        Disconnect several devices in one call, see ``ConnectMany``.
+
+        Args:
+            devices (list): the devices' bluetooth addresses
+
+        Returns:
+            results (list): ``(address, result, code)`` per device, in the order given
+        """
+        with stats.operation('DisconnectMany', reply, error) as (reply, error):
+            self._batch('disconnect', devices, reply)
 
-    @dbus.service.method(INTERFACE, out_signature = 'aa{sv}')
-    def Connected(self):
+    @dbus.service.method(INTERFACE, in_signature = 'as', out_signature = 'a(sss)', async_callbacks = ('reply', 'error'))
+    def UnpairMany(self, devices, reply, error):
+        """
+        Unpair several devices in one call, see ``ConnectMany``.
+
+        Args:
+            devices (list): the devices' bluetooth addresses
+
+        Returns:
+            results (list): ``(address, result, code)`` per device, in the order given
+        """
+        with stats.operation('UnpairMany', reply, error) as (reply, error):
+            self._batch('unpair', devices, reply)
+
+    @dbus.service.method(INTERFACE, out_signature = 'aa{sv}', async_callbacks = ('reply', 'error'))
+    def Connected(self, reply, error):
         """
         List the currently connected devices
 
         Returns:
             results (dict): return formatted data listing the currently connected devices
         """
-        return self._format_device_data(connected_devices())
-
-    @dbus.service.method(INTERFACE, out_signature = 'aa{sv}')
-    def Paired(self):
+        with stats.operation('Connected', reply, error) as (reply, error):
+            self._snapshot(
+                lambda objects: reply(self._format_device_data(d for d in gather_device_info(objects) if d['connected'])),
+                error
+            )
+
+    @dbus.service.method(INTERFACE, out_signature = 'aa{sv}', async_callbacks = ('reply', 'error'))
+    def Paired(self, reply, error):
         """
         List the currently paired devices
 
         Returns:
             results (dict): return formatted data listing the currently paired devices
         """
-        return self._format_device_data(paired_devices())
+        with stats.operation('Paired', reply, error) as (reply, error):
+            self._snapshot(
+                lambda objects: reply(self._format_device_data(d for d in gather_device_info(objects) if d['paired'])),
+                error
+            )
+
+    @dbus.service.method(INTERFACE, in_signature = 's', out_signature = 'a' + DEVICE_RECORD_SIGNATURE, async_callbacks = ('reply', 'error'))
+    def ListDevices(self, which, reply, error):
+        """
+        List devices as fixed layout structs, which are much cheaper to marshal than the
+        dictionaries returned by ``Connected``, ``Paired`` and ``GetScannedDevices``.
+
+        Args:
+            which (str): ``"all"``, ``"paired"`` or ``"connected"``
 
-    @dbus.service.method(INTERFACE)
-    def StartDiscovery(self):
+        Returns:
+            results (list): ``(address, alias, icon, rssi, paired, connected, trusted)`` per device
         """
-        Start discovery or scanning mode on the bluetooth device
+        with stats.operation('ListDevices', reply, error) as (reply, error):
+            def listed(objects):
+                try:
+                    records = device_records(objects, str(which))
+                except ValueError as e:
+                    return error(e)
+                reply(records)
+
+            self._snapshot(listed, error)
+
+    @dbus.service.method(INTERFACE, in_signature = 'a(ss)', out_signature = 'a(ssssay)', async_callbacks = ('reply', 'error'))
+    def ReadCharacteristics(self, requests, reply, error):
         """
-        logger.info('Starting discovering of devices')
-        adapter = DeviceManager().find_adapter()
-        adapter.StartDiscovery()
+        Read GATT characteristics, e.g. the battery level (``2a19``), of one or many connected
+        devices concurrently, up to ``BJARKAN_BATCH_LIMIT`` reads at a time. The UUID to object
+        path mapping of each device is cached until BlueZ removes its GATT objects.
 
-    @dbus.service.method(INTERFACE, out_signature = 'aa{sv}')
-    def GetScannedDevices(self):
+        Args:
+            requests (list): ``(address, uuid)`` per characteristic
+
+        Returns:
+            results (list): ``(address, uuid, result, code, value)`` per request, in the order
+            given; ``code`` is ``"DeviceNotFound"``, ``"AttributeNotFound"`` or the D-Bus error
+            of the read on error
+        """
+        logger.info('Reading {} characteristics', len(requests))
+        with stats.operation('ReadCharacteristics', reply, error) as (reply, error):
+            def done(results):
+                reply(dbus.Array(
+                    [(address, uuid, result, code, dbus.ByteArray(value)) for address, uuid, result, code, value in results],
+                    signature = '(ssssay)'
+                ))
+
+            self.device_manager.read_characteristics([(str(address), str(uuid)) for address, uuid in requests], done)
+
+    @dbus.service.method(INTERFACE, in_signature = 'ssvu', out_signature = 'a{sv}', async_callbacks = ('reply', 'error'))
+    def WaitForState(self, device, name, value, timeout_ms, reply, error):
+        """
+        Wait until a ``Device1`` property of the specified device has the given value, e.g.
+        ``Connected`` is ``True``. Replies as soon as BlueZ announces the change; nothing is
+        polled while waiting.
+
+        Args:
+            device (str): device's bluetooth address
+            name (str): the property, e.g. ``"Connected"``, ``"Paired"`` or ``"RSSI"``
+            value: the value to wait for
+            timeout_ms (int): give up after this many milliseconds, ``0`` to only check the
+                current value
+
+        Returns:
+            results (dict): ``result`` and ``code``: ``"Timeout"``, ``"DeviceNotFound"`` or the
+            D-Bus error of fetching the current state on error
+        """
+        logger.info('Waiting for {} of {} to become {}', name, device, value)
+        with stats.operation('WaitForState', reply, error) as (reply, error):
+            def done(code):
+                reply({'result': 'Error' if code else 'Success', 'code': code})
+
+            # registered before the current state is fetched, so no change can slip through
+            waiter = self.waiters.add(str(device), str(name), value, done, int(timeout_ms))
+
+            def fetched(objects):
+                for ifaces in objects.values():
+                    properties = ifaces.get(DEVICE_INTERFACE)
+                    if properties is not None and str(properties.get('Address', '')).upper() == waiter['address']:
+                        if not self.waiters.check(waiter, properties) and not timeout_ms:
+                            self.waiters.cancel(waiter, 'Timeout')
+                        return
+                self.waiters.cancel(waiter, 'DeviceNotFound')
+
+            def failed(e):
+                name = e.get_dbus_name() if isinstance(e, dbus.exceptions.DBusException) else 'Failure'
+                self.waiters.cancel(waiter, name)
+
+            self._snapshot(fetched, failed)
+
+    @dbus.service.method(INTERFACE, in_signature = 'hs', out_signature = 'u', async_callbacks = ('reply', 'error'))
+    def ExportSnapshot(self, fd, format, reply, error):
+        """
+        Stream the full device table, every ``Device1`` property included, into ``fd``. The data
+        never travels over the bus, so dumping thousands of devices costs one call.
+
+        Args:
+            fd (int): file descriptor the snapshot is written to, closed once done
+            format (str): ``"jsonl"`` or ``"binary"``, see ``bjarkan.snapshot``
+
+        Returns:
+            count (int): number of devices written
+        """
+        import threading
+        from .snapshot import FORMATS, encode_snapshot, write_chunks
+
+        logger.info('Exporting a {} snapshot', format)
+        with stats.operation('ExportSnapshot', reply, error) as (reply, error):
+            fd = fd.take()
+            if str(format) not in FORMATS:
+                os.close(fd)
+                raise ValueError('unknown snapshot format: {!r}'.format(str(format)))
+
+            def write(objects):
+                # encoding and a slow reader must not stall the main loop, the reply is sent
+                # back from it
+                try:
+                    count, chunks = encode_snapshot(objects, str(format))
+                    write_chunks(fd, chunks)
+                except Exception as e:
+                    GLib.idle_add(error, e)
+                else:
+                    GLib.idle_add(reply, dbus.UInt32(count))
+                finally:
+                    os.close(fd)
+
+            def fetched(objects):
+                threading.Thread(target = write, args = (objects,), name = 'bjarkan-export', daemon = True).start()
+
+            def failed(e):
+                os.close(fd)
+                error(e)
+
+            self._snapshot(fetched, failed)
+
+    @dbus.service.method(INTERFACE, sender_keyword = 'sender')
+    def StartDiscovery(self, sender = None):
+        """
+        Start discovery or scanning mode on the bluetooth device. Discovery keeps running (subject
+        to the configured duty cycle) until every client that started it has called
+        ``StopDiscovery`` or ``GetScannedDevices``, or has left the bus.
+        """
+        logger.info('Starting discovering of devices for {}', sender)
+        with stats.operation('StartDiscovery'):
+            self.discovery.acquire(sender)
+
+    @dbus.service.method(INTERFACE, sender_keyword = 'sender')
+    def StopDiscovery(self, sender = None):
+        """
+        Release the discovery session of the caller. Scanning stops once no client needs it.
+        """
+        logger.info('Stopping discovering of devices for {}', sender)
+        with stats.operation('StopDiscovery'):
+            self.discovery.release(sender)
+
+    @dbus.service.method(INTERFACE, out_signature = 'aa{sv}', sender_keyword = 'sender', async_callbacks = ('reply', 'error'))
+    def GetScannedDevices(self, sender = None, reply = None, error = None):
         """
         List the devices shown in the scan. Must explicitly call ``StartDiscovery`` to see
-        new devices in the listing.
+        new devices in the listing. This releases the caller's discovery session.
 
         Returns:
             results (dict): return formatted data listing the devices found during the scan
         """
         logger.info('Retrieving a list of known devices')
-        adapter = DeviceManager().find_adapter()
-        devices = gather_device_info()
-        try:
-            adapter.StopDiscovery()
-        except Exception:
-            pass
+        with stats.operation('GetScannedDevices', reply, error) as (reply, error):
+            def listed(objects):
+                self.discovery.release(sender)
+                reply(self._format_device_data(gather_device_info(objects)))
+
+            self._snapshot(listed, error)
+
+    def _update_advertisement_feed(self):
+        subscribers = self.advertisement_subscribers.values()
+        if not subscribers:
+            if self.advertisement_feed is not None:
+                self.advertisement_feed.stop()
+                self.advertisement_feed = None
+            return
+
+        from .advertisements import AdvertisementFeed, AdvertisementFilter
+
+        record_filter = AdvertisementFilter()
+        if all(subscriber_filter for subscriber_filter, watch in subscribers):
+            for subscriber_filter, watch in subscribers:
+                record_filter.companies |= subscriber_filter.companies
+                record_filter.uuids |= subscriber_filter.uuids
+        if self.advertisement_feed is None:
+            self.advertisement_feed = AdvertisementFeed(self.connection, self._advertisement_batch, record_filter)
+            self.advertisement_feed.start()
+        self.advertisement_feed.filter = record_filter
+
+    def _advertisement_batch(self, records):
+        self.Advertisements(dbus.Array(
+            [(record['address'], record['uuid'], record['company'] or 0, dbus.ByteArray(record['data'])) for record in records],
+            signature = ADVERTISEMENT_SIGNATURE[1:]
+        ))
+
+    def _advertisement_owner_changed(self, sender, owner):
+        if not owner:
+            logger.info('{} left the bus, ending its advertisement subscription', sender)
+            self._drop_advertisement_subscriber(sender)
+
+    def _drop_advertisement_subscriber(self, sender):
+        subscriber = self.advertisement_subscribers.pop(sender, None)
+        if subscriber is not None:
+            subscriber[1].cancel()
+            self._update_advertisement_feed()
+
+    @dbus.service.method(INTERFACE, in_signature = 'a{sv}', sender_keyword = 'sender')
+    def SubscribeAdvertisements(self, filters, sender = None):
+        """
+        Start (or change the filters of) the caller's subscription to the ``Advertisements``
+        signal. The subscription ends with ``UnsubscribeAdvertisements`` or when the caller
+        leaves the bus. Advertisements are only received while discovery is running.
 
-        return self._format_device_data(devices)
+        Args:
+            filters (dict): ``companies`` (``aq``) company identifiers of the
+                ``ManufacturerData`` and ``uuids`` (``as``) service UUIDs of the ``ServiceData``
+                the caller wants; everything when both are omitted. The signal carries the
+                union of the wishes of all subscribers, so subscribers filter again themselves.
+        """
+        from .advertisements import AdvertisementFilter
+
+        sender = str(sender)
+        logger.info('Subscribing {} to advertisements', sender)
+        with stats.operation('SubscribeAdvertisements'):
+            record_filter = AdvertisementFilter(filters.get('companies', ()), filters.get('uuids', ()))
+            if sender in self.advertisement_subscribers:
+                watch = self.advertisement_subscribers[sender][1]
+            else:
+                watch = self.connection.watch_name_owner(sender, lambda owner: self._advertisement_owner_changed(sender, owner))
+            self.advertisement_subscribers[sender] = (record_filter, watch)
+            self._update_advertisement_feed()
+
+    @dbus.service.method(INTERFACE, sender_keyword = 'sender')
+    def UnsubscribeAdvertisements(self, sender = None):
+        """
+        End the caller's subscription to the ``Advertisements`` signal.
+        """
+        logger.info('Unsubscribing {} from advertisements', sender)
+        with stats.operation('UnsubscribeAdvertisements'):
+            self._drop_advertisement_subscriber(str(sender))
+
+    @dbus.service.signal(INTERFACE, signature = ADVERTISEMENT_SIGNATURE)
+    def Advertisements(self, records):
+        """
+        Batch of new advertisement payloads, see ``SubscribeAdvertisements``.
+
+        Args:
+            records (list): ``(address, uuid, company, data)`` per payload; ``uuid`` is empty
+                for ``ManufacturerData``, ``company`` is ``0`` for ``ServiceData``
+        """
+        pass
 
     @dbus.service.signal(INTERFACE, signature = 'a{ss}')
     def PairingComplete(self, payload):
@@ -186,6 +876,10 @@ class ManagerService(dbus.service.Object):
         Signal emitted after pairing is completed.
 
         Args:
-            payload (dict): dictionary with the response of the pairing
+            payload (dict): dictionary with the response of the pairing; besides ``address``
+                (as passed to ``Pair``), ``result`` and ``code`` it carries the milliseconds
+                spent in each phase as ``phase.lookup``, ``phase.agent``, ``phase.pair``,
+                ``phase.trust``, ``phase.connect`` (or ``phase.cancel``) and ``phase.total``. When trusting or connecting the paired
+                device fails, ``step`` names the step (``trust`` or ``connect``).
         """
         logger.info('PairingComplete: emitting {}', payload)
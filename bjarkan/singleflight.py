@@ -0,0 +1,57 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+"""
+Coalescing of identical in-flight requests.
+
+When a request arrives while an identical one (same method, same device) is still waiting for
+BlueZ, it does not issue a second call: it attaches to the one in flight and receives the same
+result. Besides saving a round trip this avoids ``org.bluez.Error.InProgress`` failures for
+duplicate ``Connect`` calls.
+"""
+
+from .stats import stats
+
+
+class SingleFlight:
+    """
+    In-flight calls by key, each with the ``(reply, error)`` callbacks of every waiting caller.
+    """
+
+    def __init__(self):
+        self.calls = {}
+
+    def join(self, key, reply, error, start):
+        """
+        Wait for the result of the call identified by ``key``, starting it with
+        ``start(resolve, reject)`` unless it is already in flight.
+
+        Args:
+            key (tuple): identifies the call, e.g. ``('Connect', address)``
+            reply (callable): called with the value passed to ``resolve``
+            error (callable): called with the exception passed to ``reject`` (or raised by
+                ``start``)
+            start (callable): issues the call; must eventually call ``resolve`` or ``reject``
+        """
+        waiters = self.calls.get(key)
+        if waiters is not None:
+            stats.inc('coalesced_requests', key[0])
+            waiters.append((reply, error))
+            return
+
+        self.calls[key] = [(reply, error)]
+
+        def resolve(value = None):
+            for reply, _ in self.calls.pop(key, ()):
+                reply(value)
+
+        def reject(exception):
+            for _, error in self.calls.pop(key, ()):
+                error(exception)
+
+        try:
+            start(resolve, reject)
+        except Exception as e:
+            reject(e)
+
+    def __len__(self):
+        return len(self.calls)
@@ -0,0 +1,136 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+"""
+Full device table dumps, with every ``Device1`` property.
+
+Two formats are supported:
+
+    * ``jsonl``: one JSON object per device; byte values (``ManufacturerData``,
+      ``ServiceData``, ...) are hex encoded
+    * ``binary``: a compact stream starting with the magic ``b'BJKS\\x01'``, followed by one
+      record per device, each prefixed by its length as an unsigned 16 bit integer. All integers
+      are little endian. A record is laid out as:
+
+        ============  ==========================================================================
+        6 bytes       address
+        int16         RSSI (``-999`` when unknown)
+        uint8         flags: ``1`` paired, ``2`` connected, ``4`` trusted, ``8`` blocked
+        uint32        class of device
+        uint16        appearance
+        string        alias (uint8 length + UTF-8)
+        string        icon (uint8 length + UTF-8)
+        uint8 count   UUIDs, 16 bytes each
+        uint8 count   manufacturer data: uint16 company id, uint16 length, payload
+        uint8 count   service data: 16 byte UUID, uint16 length, payload
+        ============  ==========================================================================
+"""
+
+import json
+import os
+import struct
+import uuid
+
+from . import DEVICE_INTERFACE
+from .device_manager import to_python
+
+
+FORMATS = ('jsonl', 'binary')
+MAGIC = b'BJKS\x01'
+
+
+def device_properties(objects):
+    """
+    Returns:
+        list: plain python ``Device1`` properties of every device in the tree, plus its ``Path``
+    """
+    devices = []
+    for path, ifaces in objects.items():
+        if DEVICE_INTERFACE in ifaces:
+            properties = to_python(ifaces[DEVICE_INTERFACE])
+            properties['Path'] = str(path)
+            devices.append(properties)
+
+    return devices
+
+
+def _json_default(value):
+    if isinstance(value, bytes):
+        return value.hex()
+    raise TypeError('cannot encode {!r}'.format(value))
+
+
+def _json_record(properties):
+    # JSON object keys must be strings, manufacturer data is keyed by company id
+    if 'ManufacturerData' in properties:
+        properties = dict(properties, ManufacturerData = {str(key): value for key, value in properties['ManufacturerData'].items()})
+    return json.dumps(properties, default = _json_default, sort_keys = True).encode() + b'\n'
+
+
+def _string(value):
+    data = str(value).encode()[:255]
+    return struct.pack('<B', len(data)) + data
+
+
+def _binary_record(properties):
+    flags = (
+        (1 if properties.get('Paired') else 0) |
+        (2 if properties.get('Connected') else 0) |
+        (4 if properties.get('Trusted') else 0) |
+        (8 if properties.get('Blocked') else 0)
+    )
+    parts = [
+        bytes.fromhex(properties['Address'].replace(':', '')),
+        struct.pack('<hBIH', properties.get('RSSI', -999), flags, properties.get('Class', 0), properties.get('Appearance', 0)),
+        _string(properties.get('Alias', '')),
+        _string(properties.get('Icon', '')),
+    ]
+
+    uuids = properties.get('UUIDs', [])[:255]
+    parts.append(struct.pack('<B', len(uuids)))
+    parts.extend(uuid.UUID(value).bytes for value in uuids)
+
+    manufacturer_data = list(properties.get('ManufacturerData', {}).items())[:255]
+    parts.append(struct.pack('<B', len(manufacturer_data)))
+    for company, payload in manufacturer_data:
+        parts.append(struct.pack('<HH', company, len(payload)) + payload)
+
+    service_data = list(properties.get('ServiceData', {}).items())[:255]
+    parts.append(struct.pack('<B', len(service_data)))
+    for service, payload in service_data:
+        parts.append(uuid.UUID(service).bytes + struct.pack('<H', len(payload)) + payload)
+
+    record = b''.join(parts)
+    return struct.pack('<H', len(record)) + record
+
+
+def encode_snapshot(objects, format = 'jsonl'):
+    """
+    Encode every device of a ``GetManagedObjects`` result.
+
+    Args:
+        objects (dict): the BlueZ object tree
+        format (str): one of ``FORMATS``
+
+    Returns:
+        tuple: number of devices and the list of encoded chunks
+
+    Raises:
+        ValueError: unknown ``format``
+    """
+    if format not in FORMATS:
+        raise ValueError('unknown snapshot format: {!r}'.format(format))
+
+    devices = device_properties(objects)
+    if format == 'jsonl':
+        return len(devices), [_json_record(properties) for properties in devices]
+    return len(devices), [MAGIC] + [_binary_record(properties) for properties in devices]
+
+
+def write_chunks(fd, chunks):
+    """
+    Write every chunk to the file descriptor ``fd``, coping with short writes.
+    """
+    for chunk in chunks:
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(fd, view):]
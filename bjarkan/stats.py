@@ -0,0 +1,377 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+"""
+Runtime performance counters for the bjarkan service.
+
+Everything in here is updated from the GLib main loop thread, so no locking is done. The
+module level ``stats`` object is shared by the whole process, much like ``logger``.
+
+Examples:
+
+    ::
+
+        from .stats import stats
+
+        with stats.operation('Connect'):
+            stats.bluez_call('GetManagedObjects')
+            ...
+"""
+
+import os
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+
+
+#: upper bounds (in seconds) of the latency histogram buckets, the last bucket is ``+Inf``
+#: seconds ``Rate`` reports its recent rate over
+RATE_WINDOW = 60
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    """
+    Fixed bucket histogram. Observing a value is a bisect over a constant number of buckets.
+    """
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """
+        Returns:
+            list: ``(upper_bound, count)`` pairs with cumulative counts, ending with ``'+Inf'``
+        """
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            result.append((bound, total))
+
+        return result
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'buckets': {str(bound): count for bound, count in self.cumulative()}
+        }
+
+
+class Rate:
+    """
+    Counts events and reports both the lifetime average rate and the rate over the last
+    ``RATE_WINDOW`` seconds. Reading the rate does not change it, so every reader sees the same.
+    """
+    __slots__ = ('total', 'started', 'window')
+
+    def __init__(self):
+        self.total = 0
+        self.started = time.monotonic()
+        # [second, count] per second that saw events, oldest first
+        self.window = deque()
+
+    def mark(self, count = 1):
+        self.total += count
+        now = time.monotonic()
+        second = int(now)
+        if self.window and self.window[-1][0] == second:
+            self.window[-1][1] += count
+        else:
+            self.window.append([second, count])
+        while self.window[0][0] <= now - RATE_WINDOW:
+            self.window.popleft()
+
+    def as_dict(self):
+        now = time.monotonic()
+        recent = sum(count for second, count in list(self.window) if second > now - RATE_WINDOW)
+        return {
+            'total': self.total,
+            'per_second': round(self.total / max(now - self.started, 1e-6), 3),
+            'per_second_recent': round(recent / max(min(now - self.started, RATE_WINDOW), 1e-6), 3)
+        }
+
+
+class DutyCycle:
+    """
+    Tracks how long something (e.g. discovery) has been switched on since we started watching.
+    """
+    __slots__ = ('started', 'since', 'seconds_on')
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.since = None
+        self.seconds_on = 0.0
+
+    def set(self, on):
+        now = time.monotonic()
+        if on and self.since is None:
+            self.since = now
+        elif not on and self.since is not None:
+            self.seconds_on += now - self.since
+            self.since = None
+
+    def total_on(self):
+        if self.since is None:
+            return self.seconds_on
+        return self.seconds_on + time.monotonic() - self.since
+
+    def ratio(self):
+        return self.total_on() / max(time.monotonic() - self.started, 1e-6)
+
+    def as_dict(self):
+        return {'seconds_on': round(self.total_on(), 3), 'ratio': round(self.ratio(), 4)}
+
+
+class Timeline:
+    """
+    Monotonic timestamps for the phases of one operation, e.g. the lookup, agent registration,
+    pairing handshake, trust and connect steps of a pairing attempt.
+
+    Examples:
+
+        ::
+
+            timeline = Timeline('Pair')
+            device = find_device(address)
+            timeline.mark('lookup')
+    """
+    __slots__ = ('operation', 'started', 'last', 'phases')
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.started = self.last = time.monotonic()
+        self.phases = []
+
+    def mark(self, phase):
+        """
+        Close ``phase``, which is taken to have lasted since the previous mark.
+        """
+        now = time.monotonic()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def total(self):
+        return self.last - self.started
+
+    def as_dict(self):
+        """
+        Returns:
+            dict: milliseconds spent in each phase, plus ``total``
+        """
+        phases = {phase: round(seconds * 1000, 3) for phase, seconds in self.phases}
+        phases['total'] = round(self.total() * 1000, 3)
+        return phases
+
+
+class Stats:
+    """
+    Registry of the counters, gauges and histograms kept by the service.
+
+    Metrics are keyed by a name and an optional label value, e.g. ``('method_calls', 'Connect')``.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.rates = {}
+        self.caches = {}
+        self.duty_cycles = {}
+        self.current_operation = None
+        self.last_call = self.started
+
+    def inc(self, name, label = '', count = 1):
+        key = (name, label)
+        self.counters[key] = self.counters.get(key, 0) + count
+
+    def gauge(self, name, label = '', delta = 1):
+        key = (name, label)
+        self.gauges[key] = self.gauges.get(key, 0) + delta
+
+    def set_gauge(self, name, label = '', value = 0):
+        self.gauges[(name, label)] = value
+
+    def observe(self, name, label, value):
+        key = (name, label)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def mark(self, name, label = '', count = 1):
+        key = (name, label)
+        rate = self.rates.get(key)
+        if rate is None:
+            rate = self.rates[key] = Rate()
+        rate.mark(count)
+
+    def duty(self, name, label, on):
+        key = (name, label)
+        duty_cycle = self.duty_cycles.get(key)
+        if duty_cycle is None:
+            duty_cycle = self.duty_cycles[key] = DutyCycle()
+        duty_cycle.set(on)
+
+    def record_timeline(self, timeline):
+        """
+        Fold the phases of a finished operation into ``phase_latency_seconds`` histograms keyed
+        ``"<operation>/<phase>"``.
+        """
+        for phase, seconds in timeline.phases:
+            self.observe('phase_latency_seconds', '{}/{}'.format(timeline.operation, phase), seconds)
+        self.observe('phase_latency_seconds', '{}/total'.format(timeline.operation), timeline.total())
+
+    def register_cache(self, name, cache):
+        """
+        Include a cache in the snapshot. The cache must support ``len()`` and have ``hits`` and
+        ``misses`` attributes.
+        """
+        self.caches[name] = cache
+
+    def bluez_call(self, call):
+        """
+        Record a round trip to BlueZ, attributed to the operation currently being handled.
+
+        Args:
+            call (str): name of the BlueZ method being called, e.g. ``"GetManagedObjects"``
+        """
+        self.inc('bluez_calls', '{}/{}'.format(self.current_operation or 'internal', call))
+
+    @contextmanager
+    def operation(self, name, reply = None, error = None):
+        """
+        Count and time a D-Bus method call. BlueZ round trips recorded while the context is
+        active are attributed to ``name``.
+
+        Methods with asynchronous callbacks pass their ``reply`` and ``error`` callbacks: the
+        context then yields wrapped ``(reply, error)`` callbacks and the call is timed, and
+        counted as an error, once one of them is called instead of when the method returns.
+        """
+        previous = self.current_operation
+        self.current_operation = name
+        self.inc('method_calls', name)
+        start = time.monotonic()
+        pending = [True]
+
+        def finish(failed):
+            if not pending:
+                return
+            pending.clear()
+            if failed:
+                self.inc('method_errors', name)
+            self.last_call = time.monotonic()
+            self.observe('method_latency_seconds', name, self.last_call - start)
+
+        def replied(*args):
+            finish(False)
+            return reply(*args)
+
+        def failed(exception):
+            finish(True)
+            return error(exception)
+
+        try:
+            yield (replied, failed) if reply is not None else None
+        except Exception:
+            finish(True)
+            raise
+        else:
+            if reply is None:
+                finish(False)
+        finally:
+            self.current_operation = previous
+
+    @contextmanager
+    def attributed(self, name):
+        """
+        Attribute BlueZ round trips to ``name`` without counting a method call, e.g. inside the
+        reply handler of an asynchronous call.
+        """
+        previous = self.current_operation
+        self.current_operation = name
+        try:
+            yield
+        finally:
+            self.current_operation = previous
+
+    @contextmanager
+    def inflight(self, name):
+        """
+        Track an operation in the ``inflight`` gauge for the duration of the context.
+        """
+        self.gauge('inflight', name, 1)
+        try:
+            yield
+        finally:
+            self.gauge('inflight', name, -1)
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: json serializable view of every metric
+        """
+        state = {
+            'uptime': round(time.monotonic() - self.started, 3),
+            'rss_bytes': rss_bytes(),
+            'counters': _group(self.counters),
+            'gauges': _group(self.gauges),
+            'latency': _group({key: value.as_dict() for key, value in self.histograms.items()}),
+            'rates': _group({key: value.as_dict() for key, value in self.rates.items()}),
+            'duty_cycles': _group({key: value.as_dict() for key, value in self.duty_cycles.items()}),
+            'caches': {}
+        }
+        for name, cache in self.caches.items():
+            lookups = cache.hits + cache.misses
+            state['caches'][name] = {
+                'size': len(cache),
+                'hits': cache.hits,
+                'misses': cache.misses,
+                'hit_ratio': round(cache.hits / lookups, 3) if lookups else None
+            }
+
+        return state
+
+
+def _group(metrics):
+    """
+    Nest labelled metrics by name. A metric without labels is a plain value; one that has both
+    (e.g. ``bluez_errors`` of exceptions without a D-Bus name) keeps the unlabelled value under
+    the ``""`` label.
+    """
+    labelled = {name for name, label in metrics if label}
+    grouped = {}
+    for (name, label), value in metrics.items():
+        if name in labelled:
+            grouped.setdefault(name, {})[label] = value
+        else:
+            grouped[name] = value
+
+    return grouped
+
+
+def rss_bytes():
+    """
+    Returns:
+        int: resident set size of this process in bytes, or ``None`` if it cannot be determined
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+stats = Stats()
@@ -15,9 +15,10 @@ import dbus
 import dbus.service
 import json
 
-from gwn.helpers.logger import logger
-
 from . import BUSNAME, SUPPORT_OBJECTPATH, SUPPORT_INTERFACE
+from .logger import logger
+from .profiler import Profiler
+from .stats import stats
 
 
 
@@ -26,6 +27,7 @@ class SupportService( dbus.service.Object ):
     def __init__( self ):
         bus_name = dbus.service.BusName( BUSNAME, bus = dbus.SystemBus() )
         super().__init__( bus_name = bus_name, object_path = SUPPORT_OBJECTPATH )
+        self.profiler = Profiler()
 
 
     @dbus.service.method( SUPPORT_INTERFACE, out_signature = 's' )
@@ -33,10 +35,19 @@ class SupportService( dbus.service.Object ):
         """
         Return the current runtime state of the service.
 
+        This includes call counts and latency histograms per D-Bus method, BlueZ round trips per
+        operation (``bluez_calls``, keyed ``"<operation>/<bluez method>"``), in-flight operations,
+        BlueZ signal rates, cache sizes and hit ratios, the process RSS and, when queued logging
+        is enabled, the number of log records dropped or suppressed by rate limiting.
+
         Returns:
             str: json encoded, free-form-ish dictionary of runtime state information
         """
-        return json.dumps( {} )
+        state = stats.snapshot()
+        state['profiling'] = self.profiler.as_dict()
+        state['logging'] = logger.getQueueStats()
+        state['logging']['rate_limit'] = logger.getRateLimitStats()
+        return json.dumps( state )
 
 
     @dbus.service.method( SUPPORT_INTERFACE, out_signature = 's' )
@@ -53,22 +64,69 @@ class SupportService( dbus.service.Object ):
     @dbus.service.method( SUPPORT_INTERFACE, in_signature = 's' )
     def SetLogLevel( self, level ):
         """
-        Set the effective log level.
+        Set the effective log level, and optionally the rate limiting of high frequency records.
 
         Args:
-            level (str): the desired log level, e.g. ``"debug"``, ``"warning"``
+            level (str): the desired log level, e.g. ``"debug"``, ``"warning"``, optionally
+                followed by comma separated rate limit settings: ``rate`` (records per second
+                per call site), ``sample`` (fraction of records kept) and ``limit`` (the most
+                severe level throttled), e.g. ``"debug,rate=5,sample=0.5"``. Passing only a level
+                leaves the rate limiting as it is, ``rate=0`` turns it off.
 
         Raises:
-            ValueError: if ``level`` is not a valid log level name
+            ValueError: if ``level`` is not a valid log level name or a setting is not valid
 
         Notes:
 
             * This method changes the log level for the duration of this runtime. The log level will
               return to the default if this process is restarted.
         """
-        level = str( level )
-        if level.lower() in { 'critical', 'error', 'warning', 'info', 'debug', 'notset' }:
-            logger.setLevel( level )
-        else:
+        level, *settings = str( level ).split( ',' )
+        level = level.strip()
+        if level.lower() not in { 'critical', 'error', 'warning', 'info', 'debug', 'notset' }:
             raise ValueError( 'unknown log level: {!r}'.format( level ) )
 
+        if settings:
+            limits = { 'rate': '0', 'sample': '1', 'limit': 'debug' }
+            for setting in settings:
+                key, _, value = setting.partition( '=' )
+                key = key.strip().lower()
+                if key not in limits or not value:
+                    raise ValueError( 'unknown log setting: {!r}'.format( setting ) )
+                limits[key] = value.strip()
+            logger.setRateLimit( float( limits['rate'] ), float( limits['sample'] ), limits['limit'] )
+
+        logger.setLevel( level )
+
+
+    @dbus.service.method( SUPPORT_INTERFACE, in_signature = 'su', out_signature = 's' )
+    def StartProfiling( self, kind, duration ):
+        """
+        Profile the live process for a bounded amount of time.
+
+        Args:
+            kind (str): ``"cpu"`` for ``cProfile`` or ``"memory"`` for ``tracemalloc``
+            duration (int): seconds after which profiling stops and the capture is written
+
+        Returns:
+            str: path the pstats file or tracemalloc snapshot will be written to
+
+        Raises:
+            ValueError: if ``kind`` or ``duration`` is not valid
+            RuntimeError: if profiling is already running
+        """
+        return self.profiler.start( str( kind ), int( duration ) )
+
+
+    @dbus.service.method( SUPPORT_INTERFACE, out_signature = 's' )
+    def StopProfiling( self ):
+        """
+        Stop profiling early and write the capture.
+
+        Returns:
+            str: path of the written pstats file or tracemalloc snapshot
+
+        Raises:
+            RuntimeError: if profiling is not running
+        """
+        return self.profiler.stop()
@@ -0,0 +1,424 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+"""
+Recording and replay of the BlueZ D-Bus traffic of ``bjarkan-service``.
+
+``TraceRecorder`` monitors the system bus (``org.freedesktop.DBus.Monitoring``, so it has to run
+as root) and captures every signal BlueZ sends and every reply BlueZ gives to a method call of
+``bjarkan-service``, together with the call it answers and when it happened. The trace is
+written as gzip compressed JSON Lines: a header, then one record per line. Monitoring follows
+BlueZ and ``bjarkan-service`` across restarts (an idle exit and reactivation, for instance).
+
+``TraceReplayer`` stands in for ``org.bluez`` on another bus, e.g. a private ``dbus-daemon``: it
+emits the recorded signals at their recorded times, or faster, and answers method calls with the
+recorded reply to the same call that was current at that point of the trace. ``bjarkan-service``
+uses that bus when started with ``DBUS_SYSTEM_BUS_ADDRESS`` pointing to it.
+
+Records look like:
+
+    * ``{"t": 0.52, "signal": "PropertiesChanged", "path": ..., "interface": ..., "signature": "sa{sv}as", "args": [...]}``
+    * ``{"t": 0.61, "call": "Connect", "path": ..., "interface": ..., "in": [...], "latency": 1.2, "signature": "", "args": []}``
+    * ``{"t": 3.05, "call": "Pair", ..., "latency": 0.01, "error": "org.bluez.Error.AlreadyExists", "message": "Already Exists"}``
+
+``t`` is the number of seconds since the start of the recording, of the call for replies. Values
+are stored with their D-Bus type, see ``encode_value()``.
+"""
+
+import bisect
+import gzip
+import json
+import time
+
+import dbus
+import dbus.bus
+import dbus.lowlevel
+import dbus.service
+from gi.repository import GLib
+
+from . import BUSNAME, SERVICE_NAME
+from .logger import logger
+from .stats import stats
+
+
+#: version of the trace format, in the header line
+TRACE_VERSION = 1
+
+_SCALARS = (
+    (dbus.Boolean, 'b'),
+    (dbus.Byte, 'y'),
+    (dbus.Int16, 'n'),
+    (dbus.UInt16, 'q'),
+    (dbus.Int32, 'i'),
+    (dbus.UInt32, 'u'),
+    (dbus.Int64, 'x'),
+    (dbus.UInt64, 't'),
+    (dbus.Double, 'd'),
+    (dbus.ObjectPath, 'o'),
+    (dbus.Signature, 'g'),
+    (dbus.String, 's'),
+)
+_TYPES = {code: cls for cls, code in _SCALARS}
+
+
+def encode_value(value):
+    """
+    Returns:
+        list: ``value`` as JSON, tagged with its D-Bus type: ``[code, value]`` for basic types,
+        ``["ay", hex]``, ``["a", signature, items]``, ``["{", signature, [[key, value], ...]]``
+        or ``["(", items]``
+    """
+    if isinstance(value, dbus.ByteArray):
+        return ['ay', bytes(value).hex()]
+    for cls, code in _SCALARS:
+        if isinstance(value, cls):
+            if isinstance(value, float):
+                return [code, float(value)]
+            return [code, int(value) if isinstance(value, int) else str(value)]
+    if isinstance(value, dict):
+        return ['{', value.signature, [[encode_value(k), encode_value(v)] for k, v in value.items()]]
+    if isinstance(value, tuple):
+        return ['(', [encode_value(item) for item in value]]
+    if isinstance(value, list):
+        return ['a', value.signature, [encode_value(item) for item in value]]
+    raise TypeError('unable to record a {}'.format(type(value).__name__))
+
+
+def decode_value(encoded):
+    """
+    Returns:
+        the dbus-python value ``encode_value()`` encoded
+    """
+    code = encoded[0]
+    if code == 'ay':
+        return dbus.ByteArray(bytes.fromhex(encoded[1]))
+    if code == '{':
+        return dbus.Dictionary(
+            ((decode_value(k), decode_value(v)) for k, v in encoded[2]),
+            signature = encoded[1]
+        )
+    if code == '(':
+        return dbus.Struct(decode_value(item) for item in encoded[1])
+    if code == 'a':
+        return dbus.Array((decode_value(item) for item in encoded[2]), signature = encoded[1])
+    return _TYPES[code](encoded[1])
+
+
+def read_trace(path):
+    """
+    Returns:
+        tuple: the header and the list of records; a recording cut short ends at its last
+        complete record
+    """
+    header = {}
+    records = []
+    with gzip.open(path, 'rt') as f:
+        try:
+            header = json.loads(f.readline())
+            for line in f:
+                records.append(json.loads(line))
+        except (EOFError, ValueError):
+            pass
+
+    if header.get('trace') != TRACE_VERSION:
+        raise ValueError('{} is not a version {} bjarkan trace'.format(path, TRACE_VERSION))
+    return header, records
+
+
+class TraceRecorder:
+    """
+    Args:
+        path (str): the trace file to write
+        client (str): bus name of the client whose calls are recorded, ``bjarkan-service`` by
+            default
+        address (str): the bus to monitor, the system bus by default
+    """
+
+    def __init__(self, path, client = BUSNAME, address = None):
+        self.path = path
+        self.client = client
+        self.address = address
+        self.counts = {'signals': 0, 'replies': 0, 'errors': 0}
+        self.calls = {}
+        self.client_name = ''
+        self.bluez_name = ''
+        self.bus = None
+        self.connection = None
+        self.output = None
+        self._receiver = None
+
+    def start(self):
+        """
+        Raises:
+            dbus.exceptions.DBusException: monitoring is not permitted
+        """
+        self.bus = dbus.bus.BusConnection(self.address or dbus.bus.BUS_SYSTEM)
+        self.client_name = self._owner(self.client)
+        self.bluez_name = self._owner(SERVICE_NAME)
+        self.output = gzip.open(self.path, 'wt')
+        self.started = time.monotonic()
+        self._write({'trace': TRACE_VERSION, 'started': time.time(), 'client': self.client})
+        self._receiver = self.bus.add_signal_receiver(
+            self._owner_changed,
+            signal_name = 'NameOwnerChanged',
+            dbus_interface = 'org.freedesktop.DBus',
+            bus_name = 'org.freedesktop.DBus',
+            path = '/org/freedesktop/DBus'
+        )
+        self._monitor()
+        logger.info('recording the BlueZ traffic of {} to {}', self.client, self.path)
+
+    def stop(self):
+        if self._receiver is not None:
+            self._receiver.remove()
+            self._receiver = None
+        for connection in (self.connection, self.bus):
+            if connection is not None:
+                connection.close()
+        self.connection = self.bus = None
+        if self.output is not None:
+            self.output.close()
+            self.output = None
+
+    def _owner(self, name):
+        try:
+            return str(self.bus.get_name_owner(name))
+        except dbus.exceptions.DBusException:
+            return ''
+
+    def _owner_changed(self, name, old, new):
+        if name == self.client:
+            self.client_name = str(new)
+            # serials of calls made by the previous owner will never be answered
+            self.calls.clear()
+        elif name == SERVICE_NAME:
+            self.bluez_name = str(new)
+        else:
+            return
+        logger.info('{} is now owned by {!r}, monitoring again', name, str(new))
+        self._monitor()
+
+    def _monitor(self):
+        """
+        Monitor the current owners of ``org.bluez`` and the client. The rules of a monitor cannot
+        be changed, so every change of owner takes a new monitoring connection.
+        """
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        if not self.bluez_name:
+            # no rules at all would monitor everything
+            logger.info('{} is not on the bus, waiting for it', SERVICE_NAME)
+            return
+
+        rules = ["type='signal',sender='{}'".format(self.bluez_name)]
+        if self.client_name:
+            rules += [
+                "type='method_call',sender='{}'".format(self.client_name),
+                "type='method_return',sender='{}',destination='{}'".format(self.bluez_name, self.client_name),
+                "type='error',sender='{}',destination='{}'".format(self.bluez_name, self.client_name),
+            ]
+        self.connection = dbus.bus.BusConnection(self.address or dbus.bus.BUS_SYSTEM)
+        self.connection.add_message_filter(self._message)
+        self.connection.call_blocking(
+            'org.freedesktop.DBus',
+            '/org/freedesktop/DBus',
+            'org.freedesktop.DBus.Monitoring',
+            'BecomeMonitor',
+            'asu',
+            (rules, 0)
+        )
+
+    def _write(self, record):
+        self.output.write(json.dumps(record, separators = (',', ':')) + '\n')
+
+    def _message(self, connection, message):
+        now = round(time.monotonic() - self.started, 6)
+        kind = message.get_type()
+        if connection is not self.connection:
+            # still queued on a monitor replaced since
+            return
+        if kind != dbus.lowlevel.MESSAGE_TYPE_METHOD_CALL and message.get_sender() != self.bluez_name:
+            # e.g. NameLost, sent to the monitor itself
+            return
+        try:
+            if kind == dbus.lowlevel.MESSAGE_TYPE_SIGNAL:
+                self.counts['signals'] += 1
+                self._write({
+                    't': now,
+                    'signal': message.get_member(),
+                    'path': message.get_path(),
+                    'interface': message.get_interface(),
+                    'signature': message.get_signature(),
+                    'args': [encode_value(arg) for arg in message.get_args_list(byte_arrays = True)],
+                })
+            elif kind == dbus.lowlevel.MESSAGE_TYPE_METHOD_CALL:
+                if message.get_destination() in (SERVICE_NAME, self.bluez_name) and not message.get_no_reply():
+                    self.calls[message.get_serial()] = (now, message)
+            else:
+                self._reply(now, message)
+        except TypeError as e:
+            logger.warning('unable to record {}: {}', message.get_member(), e)
+
+    def _reply(self, now, message):
+        call = self.calls.pop(message.get_reply_serial(), None)
+        if call is None:
+            return
+
+        called, call = call
+        record = {
+            't': called,
+            'call': call.get_member(),
+            'path': call.get_path(),
+            'interface': call.get_interface(),
+            'in': [encode_value(arg) for arg in call.get_args_list(byte_arrays = True)],
+            'latency': round(now - called, 6),
+        }
+        args = message.get_args_list(byte_arrays = True)
+        if message.get_type() == dbus.lowlevel.MESSAGE_TYPE_ERROR:
+            self.counts['errors'] += 1
+            record['error'] = message.get_error_name()
+            record['message'] = str(args[0]) if args else ''
+        else:
+            self.counts['replies'] += 1
+            record['signature'] = message.get_signature()
+            record['args'] = [encode_value(arg) for arg in args]
+        self._write(record)
+
+
+class TraceReplayer:
+    """
+    Args:
+        bus (dbus.bus.BusConnection): the bus to serve ``org.bluez`` on, never the real system
+            bus
+        records (list): the records of the trace, see ``read_trace()``
+        speed (float): how much faster than recorded to replay, ``1`` for the original speed
+        done (callable): called once the last signal has been emitted
+
+    Raises:
+        ValueError: ``speed`` is not positive
+    """
+
+    def __init__(self, bus, records, speed = 1.0, done = None):
+        if not speed > 0:
+            raise ValueError('replay speed must be positive: {!r}'.format(speed))
+        self.bus = bus
+        self.speed = speed
+        self.done = done
+        self.signals = [record for record in records if 'signal' in record]
+        self.replies = {}
+        for record in records:
+            if 'call' in record:
+                self.replies.setdefault(self._key(record, record['in']), []).append(record)
+                self.replies.setdefault(self._key(record), []).append(record)
+        self.times = {key: [record['t'] for record in replies] for key, replies in self.replies.items()}
+        self.counts = {'signals': 0, 'replies': 0, 'unmatched': 0}
+        self.started = None
+        self._next = 0
+        self._timeout = None
+
+    @staticmethod
+    def _key(record, args = None):
+        key = (record['path'], record['interface'], record['call'])
+        return key if args is None else key + (json.dumps(args),)
+
+    def start(self):
+        """
+        Take the ``org.bluez`` name and answer calls; the trace only starts playing with
+        ``play()``, until then calls are answered as at its start.
+
+        Raises:
+            dbus.exceptions.NameExistsException: ``org.bluez`` is already taken on this bus
+        """
+        # never queue behind a real BlueZ: fail rather than silently serve nothing
+        self.bus_name = dbus.service.BusName(SERVICE_NAME, bus = self.bus, do_not_queue = True)
+        self.bus.add_message_filter(self._message)
+
+    def play(self):
+        if self.started is None:
+            self.started = time.monotonic()
+            self._schedule()
+
+    def stop(self):
+        if self._timeout is not None:
+            GLib.source_remove(self._timeout)
+            self._timeout = None
+        self.bus.remove_message_filter(self._message)
+
+    def elapsed(self):
+        """
+        Returns:
+            float: the current point of the trace, in recorded seconds
+        """
+        if self.started is None:
+            return 0.0
+        return (time.monotonic() - self.started) * self.speed
+
+    def _schedule(self):
+        if self._next >= len(self.signals):
+            self._timeout = None
+            if self.done is not None:
+                self.done()
+            return False
+
+        delay = (self.signals[self._next]['t'] - self.elapsed()) / self.speed
+        self._timeout = GLib.timeout_add(max(0, int(delay * 1000)), self._emit)
+        return False
+
+    def _emit(self):
+        # emit everything that is due, timers firing late must not slow the replay down
+        while self._next < len(self.signals) and self.signals[self._next]['t'] <= self.elapsed():
+            record = self.signals[self._next]
+            self._next += 1
+            message = dbus.lowlevel.SignalMessage(record['path'], record['interface'], record['signal'])
+            message.append(*[decode_value(arg) for arg in record['args']], signature = record['signature'])
+            self.bus.send_message(message)
+            self.counts['signals'] += 1
+            stats.mark('replayed_signals', record['signal'])
+        return self._schedule()
+
+    def find_reply(self, path, interface, member, args):
+        """
+        Returns:
+            dict: the recorded reply to the call, the latest one recorded before the current
+            point of the trace (or the first one); calls with other arguments are only used when
+            there is no recording of these
+        """
+        record = {'path': path, 'interface': interface, 'call': member}
+        for key in (self._key(record, [encode_value(arg) for arg in args]), self._key(record)):
+            if key in self.replies:
+                index = bisect.bisect_right(self.times[key], self.elapsed())
+                return self.replies[key][max(index - 1, 0)]
+        return None
+
+    def _message(self, connection, message):
+        if message.get_type() != dbus.lowlevel.MESSAGE_TYPE_METHOD_CALL:
+            return dbus.lowlevel.HANDLER_RESULT_NOT_YET_HANDLED
+
+        try:
+            args = message.get_args_list(byte_arrays = True)
+            record = self.find_reply(message.get_path(), message.get_interface(), message.get_member(), args)
+        except TypeError:
+            record = None
+        if record is None:
+            self.counts['unmatched'] += 1
+            logger.warning('no recorded reply to {}.{} on {}', message.get_interface(), message.get_member(), message.get_path())
+            self.bus.send_message(dbus.lowlevel.ErrorMessage(
+                message,
+                'org.freedesktop.DBus.Error.UnknownMethod',
+                'no recorded reply to {}'.format(message.get_member())
+            ))
+            return dbus.lowlevel.HANDLER_RESULT_HANDLED
+
+        if 'error' in record:
+            reply = dbus.lowlevel.ErrorMessage(message, record['error'], record['message'])
+        else:
+            reply = dbus.lowlevel.MethodReturnMessage(message)
+            reply.append(*[decode_value(arg) for arg in record['args']], signature = record['signature'])
+        self.counts['replies'] += 1
+
+        def send():
+            self.bus.send_message(reply)
+            return False
+
+        GLib.timeout_add(int(record['latency'] / self.speed * 1000), send)
+        return dbus.lowlevel.HANDLER_RESULT_HANDLED
@@ -0,0 +1,86 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+"""
+Waiting for a device property to reach a value.
+
+Waiters are fed from the ``PropertiesChanged`` signals the service already receives, so a wait
+costs nothing while it is pending and completes as soon as BlueZ announces the change.
+"""
+
+from gi.repository import GLib
+
+from .device_manager import to_python
+from .stats import stats
+
+
+class StateWaiters:
+    """
+    Pending waits, by device address.
+    """
+
+    def __init__(self):
+        self.waiters = {}
+
+    def add(self, address, name, value, done, timeout_ms = 0):
+        """
+        Call ``done(code)`` once property ``name`` of the device ``address`` equals ``value``:
+        with ``""`` when it does, ``"Timeout"`` when ``timeout_ms`` milliseconds pass first.
+
+        Returns:
+            dict: the waiter, to pass to ``check()``
+        """
+        waiter = {'address': address.upper(), 'name': name, 'value': to_python(value), 'done': done, 'timeout': None}
+        self.waiters.setdefault(waiter['address'], []).append(waiter)
+        if timeout_ms:
+            waiter['timeout'] = GLib.timeout_add(timeout_ms, self._expired, waiter)
+        stats.set_gauge('state_waiters', '', len(self))
+
+        return waiter
+
+    def check(self, waiter, properties):
+        """
+        Complete ``waiter`` if the device ``properties`` already match.
+
+        Returns:
+            bool: whether the waiter is (now) complete
+        """
+        if not self._pending(waiter):
+            return True
+        if waiter['name'] in properties and to_python(properties[waiter['name']]) == waiter['value']:
+            self._complete(waiter, '')
+            return True
+        return False
+
+    def cancel(self, waiter, code):
+        if self._pending(waiter):
+            self._complete(waiter, code)
+
+    def changed(self, address, properties):
+        """
+        Feed a ``PropertiesChanged`` of the device ``address``.
+        """
+        for waiter in list(self.waiters.get(address, ())):
+            self.check(waiter, properties)
+
+    def _expired(self, waiter):
+        waiter['timeout'] = None
+        self._complete(waiter, 'Timeout')
+        return False
+
+    def _pending(self, waiter):
+        # by identity: two waiters for the same value compare equal
+        return any(pending is waiter for pending in self.waiters.get(waiter['address'], ()))
+
+    def _complete(self, waiter, code):
+        pending = self.waiters[waiter['address']]
+        pending[:] = [other for other in pending if other is not waiter]
+        if not pending:
+            del self.waiters[waiter['address']]
+        if waiter['timeout'] is not None:
+            GLib.source_remove(waiter['timeout'])
+            waiter['timeout'] = None
+        stats.set_gauge('state_waiters', '', len(self))
+        waiter['done'](code)
+
+    def __len__(self):
+        return sum(len(pending) for pending in self.waiters.values())
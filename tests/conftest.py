@@ -0,0 +1,201 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+"""
+Stand-ins for the bus, the BlueZ proxies and GLib, so that the asynchronous paths can be driven
+step by step: every D-Bus call is recorded and answered by the test.
+"""
+
+import dbus
+import pytest
+
+from bjarkan import ADAPTER_INTERFACE, DEVICE_INTERFACE
+from bjarkan.device_manager import DeviceManager
+
+
+class BluezError(dbus.exceptions.DBusException):
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.name = name
+
+    def get_dbus_name(self):
+        return self.name
+
+
+class Call:
+
+    def __init__(self, path, method, args, kwargs):
+        self.path = path
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+
+    def reply(self, *args):
+        self.kwargs['reply_handler'](*args)
+
+    def fail(self, name):
+        self.kwargs['error_handler'](BluezError(name))
+
+
+class FakeProxy:
+
+    def __init__(self, bus, path):
+        self.bus = bus
+        self.object_path = path
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+
+        def call(*args, **kwargs):
+            failure = self.bus.raising.get((self.object_path, method))
+            if failure is not None:
+                raise failure
+            self.bus.calls.append(Call(self.object_path, method, args, kwargs))
+
+        return call
+
+
+class Watch:
+
+    def __init__(self, name, callback):
+        self.name = name
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Receiver:
+
+    def __init__(self, bus, entry):
+        self.bus = bus
+        self.entry = entry
+
+    def remove(self):
+        self.bus.receivers.remove(self.entry)
+
+
+class FakeBus:
+
+    def __init__(self):
+        self.calls = []
+        self.raising = {}
+        self.receivers = []
+        self.watches = []
+
+    def get_object(self, name, path):
+        return FakeProxy(self, path)
+
+    def add_signal_receiver(self, handler, **kwargs):
+        self.receivers.append((handler, kwargs))
+        return Receiver(self, self.receivers[-1])
+
+    def watch_name_owner(self, name, callback):
+        watch = Watch(name, callback)
+        self.watches.append(watch)
+        return watch
+
+    def pop(self, method):
+        """
+        Returns:
+            Call: the oldest recorded call of ``method``
+        """
+        for index, call in enumerate(self.calls):
+            if call.method == method:
+                return self.calls.pop(index)
+        raise AssertionError('{} was not called'.format(method))
+
+    def signal(self, member, *args):
+        for handler, kwargs in self.receivers:
+            if kwargs.get('signal_name') == member:
+                handler(*args)
+
+
+class FakeGLib:
+
+    def __init__(self):
+        self.sources = {}
+        self.next_id = 1
+
+    def timeout_add(self, interval, callback, *args):
+        source = self.next_id
+        self.next_id += 1
+        self.sources[source] = (callback, args)
+        return source
+
+    timeout_add_seconds = timeout_add
+
+    def idle_add(self, callback, *args):
+        return self.timeout_add(0, callback, *args)
+
+    def source_remove(self, source):
+        del self.sources[source]
+
+    def fire(self, source = None):
+        """
+        Run one pending source, the oldest by default; it stays scheduled if it returns true.
+        """
+        source = min(self.sources) if source is None else source
+        callback, args = self.sources.pop(source)
+        if callback(*args):
+            self.sources[source] = (callback, args)
+
+    def run(self):
+        while self.sources:
+            self.fire()
+
+
+def device(address, adapter = 'hci0', **properties):
+    """
+    Returns:
+        tuple: object path and interfaces of a ``GetManagedObjects`` entry for a device
+    """
+    properties.setdefault('Paired', False)
+    properties.setdefault('Trusted', False)
+    properties.setdefault('Connected', False)
+    properties['Address'] = address
+    path = '/org/bluez/{}/dev_{}'.format(adapter, address.replace(':', '_'))
+    return path, {DEVICE_INTERFACE: properties}
+
+
+def objects(*devices, adapters = ('hci0',)):
+    tree = {
+        '/org/bluez/' + name: {ADAPTER_INTERFACE: {'Address': '00:00:00:00:00:0{}'.format(index)}}
+        for index, name in enumerate(adapters)
+    }
+    tree.update(devices)
+    return tree
+
+
+@pytest.fixture
+def bus():
+    return FakeBus()
+
+
+@pytest.fixture
+def glib(monkeypatch):
+    glib = FakeGLib()
+    for module in ('operations', 'waiters', 'discovery', 'nearest', 'advertisements'):
+        monkeypatch.setattr('bjarkan.{}.GLib'.format(module), glib, raising = False)
+    return glib
+
+
+@pytest.fixture
+def manager(bus, monkeypatch):
+    """
+    A ``DeviceManager`` whose proxies are ``FakeProxy`` objects recording calls on ``bus``.
+    """
+    monkeypatch.setattr('bjarkan.device_manager.dbus.Interface', lambda proxy, interface: proxy, raising = False)
+    device_manager = DeviceManager(bus)
+    device_manager.get_interface = lambda path, interface: FakeProxy(bus, str(path))
+    device_manager.tree = {}
+
+    def get_managed_objects(reply_handler = None, error_handler = None):
+        if reply_handler is not None:
+            return bus.calls.append(Call('/', 'GetManagedObjects', (), {'reply_handler': reply_handler, 'error_handler': error_handler}))
+        return device_manager.tree
+
+    device_manager.get_managed_objects = get_managed_objects
+    return device_manager
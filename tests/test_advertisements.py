@@ -0,0 +1,74 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+import json
+
+from bjarkan import DEVICE_INTERFACE
+from bjarkan.advertisements import AdvertisementFeed, AdvertisementFilter, record_json
+
+from .conftest import device
+
+
+ADDRESS = 'AA:AA:AA:AA:AA:01'
+PATH = device(ADDRESS)[0]
+BATTERY = '0000180f-0000-1000-8000-00805f9b34fb'
+
+
+def feed(bus, record_filter = None):
+    batches = []
+    advertisements = AdvertisementFeed(bus, batches.append, record_filter)
+    advertisements.start()
+    return advertisements, batches
+
+
+def changed(bus, properties):
+    for handler, kwargs in list(bus.receivers):
+        if kwargs['signal_name'] == 'PropertiesChanged':
+            handler(DEVICE_INTERFACE, properties, [], path = PATH)
+
+
+def test_new_payloads_are_delivered_in_batches(bus, glib):
+    advertisements, batches = feed(bus)
+    changed(bus, {'ManufacturerData': {76: b'\x01\x02'}})
+    bus.signal('InterfacesAdded', PATH, {DEVICE_INTERFACE: {'ServiceData': {BATTERY: b'\x64'}}})
+    assert batches == []
+
+    glib.fire()
+    assert [(record['company'], record['uuid'], record['data']) for record in batches[0]] == [(76, '', b'\x01\x02'), (None, BATTERY, b'\x64')]
+    assert {record['address'] for record in batches[0]} == {ADDRESS}
+
+
+def test_repeated_payloads_are_dropped_until_the_device_goes(bus, glib):
+    advertisements, batches = feed(bus)
+    changed(bus, {'ManufacturerData': {76: b'\x01'}})
+    changed(bus, {'ManufacturerData': {76: b'\x01'}})
+    changed(bus, {'RSSI': -40})
+    advertisements.flush()
+    assert len(batches[0]) == 1
+
+    bus.signal('InterfacesRemoved', PATH, [DEVICE_INTERFACE])
+    changed(bus, {'ManufacturerData': {76: b'\x01'}})
+    advertisements.flush()
+    assert len(batches) == 2
+
+
+def test_the_filter_keeps_matching_payloads(bus, glib):
+    advertisements, batches = feed(bus, AdvertisementFilter(companies = ['0x004c']))
+    changed(bus, {'ManufacturerData': {76: b'\x01', 117: b'\x02'}, 'ServiceData': {BATTERY: b'\x64'}})
+    advertisements.flush()
+
+    assert [record['company'] for record in batches[0]] == [76]
+    assert glib.sources == {}
+
+
+def test_stopping_flushes_and_unsubscribes(bus, glib):
+    advertisements, batches = feed(bus)
+    changed(bus, {'ManufacturerData': {76: b'\x01'}})
+    advertisements.stop()
+
+    assert len(batches) == 1
+    assert bus.receivers == [] and glib.sources == {}
+
+
+def test_record_json_hex_encodes_the_payload():
+    record = {'address': ADDRESS, 'company': 76, 'uuid': '', 'data': b'\x01\xff', 'time': 1.5}
+    assert json.loads(record_json(record))['data'] == '01ff'
@@ -0,0 +1,58 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+import pytest
+
+from bjarkan.agent import AgentPolicy, _passkey
+
+
+KEYBOARD = {'Address': 'AA:BB:CC:DD:EE:FF', 'Icon': 'input-keyboard', 'Class': 0x0540}
+HEADSET = {'Address': '11:22:33:44:55:66', 'Icon': 'audio-card', 'Class': 0x0404}
+
+
+def test_default_accepts_pairing_requests_but_rejects_unsolicited_ones():
+    policy = AgentPolicy()
+
+    assert policy.decide(KEYBOARD, 'RequestConfirmation') == 'accept'
+    assert policy.decide(KEYBOARD, 'RequestPinCode') == 'accept'
+    assert policy.decide(KEYBOARD, 'RequestAuthorization') == 'reject'
+    assert policy.decide(KEYBOARD, 'AuthorizeService') == 'reject'
+
+
+def test_explicit_accept_authorizes_everything():
+    policy = AgentPolicy(mode = 'accept')
+
+    assert policy.decide(KEYBOARD, 'AuthorizeService') == 'accept'
+    assert policy.decide({}, 'RequestAuthorization') == 'accept'
+
+
+def test_allowlist_matches_address_icon_and_class():
+    assert AgentPolicy(addresses = ['aa:bb:cc:dd:ee:ff']).decide(KEYBOARD, 'AuthorizeService') == 'accept'
+    assert AgentPolicy(icons = ['input-keyboard']).decide(KEYBOARD) == 'accept'
+    assert AgentPolicy(classes = ['audio']).decide(HEADSET) == 'accept'
+
+
+def test_allowlist_falls_back_for_other_devices():
+    assert AgentPolicy(classes = ['audio']).decide(KEYBOARD) == 'ui'
+    assert AgentPolicy(classes = ['audio'], fallback = 'reject').decide(KEYBOARD) == 'reject'
+
+
+def test_ui_mode_defers_everything():
+    assert AgentPolicy(addresses = [KEYBOARD['Address']], mode = 'ui').decide(KEYBOARD) == 'ui'
+
+
+@pytest.mark.parametrize('arguments', [
+    {'mode': 'sometimes'},
+    {'fallback': 'accept'},
+    {'classes': ['spaceship']},
+])
+def test_invalid_configuration_is_rejected(arguments):
+    with pytest.raises(ValueError):
+        AgentPolicy(**arguments)
+
+
+def test_passkey_validation():
+    assert _passkey('000123') == 123
+    assert _passkey('999999') == 999999
+    for value in ('12ab', '1000000', '-1'):
+        with pytest.raises(ValueError):
+            _passkey(value)
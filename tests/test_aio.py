@@ -0,0 +1,130 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+import asyncio
+
+import pytest
+
+from bjarkan import DEVICE_INTERFACE, DeviceNotFound
+from bjarkan import aio
+
+from .conftest import device, objects
+
+
+ADDRESS = 'AA:AA:AA:AA:AA:01'
+
+
+class InlineGLib:
+    """
+    Runs the work meant for the GLib thread right away, on the asyncio loop.
+    """
+
+    submit = aio._GLibThread.submit
+    guarded = staticmethod(aio._GLibThread.guarded)
+
+    def call(self, func, *args):
+        func(*args)
+
+
+@pytest.fixture
+def run(manager, monkeypatch):
+    """
+    Run a coroutine taking an ``AsyncDeviceManager`` that talks to the fake bus.
+    """
+    monkeypatch.setattr(aio, '_shared_glib_thread', InlineGLib)
+    monkeypatch.setattr(aio.GLib, 'idle_add', lambda func, *args: func(*args), raising = False)
+
+    def run(coroutine):
+        async def main():
+            async_manager = aio.AsyncDeviceManager()
+            async_manager._device_manager = manager
+            return await coroutine(async_manager)
+
+        return asyncio.run(asyncio.wait_for(main(), 1))
+
+    return run
+
+
+def changed(bus, address, **properties):
+    path = device(address)[0]
+    for handler, kwargs in list(bus.receivers):
+        if kwargs['signal_name'] == 'PropertiesChanged':
+            handler(DEVICE_INTERFACE, properties, [], path = path)
+
+
+def test_complete_ignores_a_settled_future():
+    async def main():
+        future = asyncio.get_running_loop().create_future()
+        aio._complete(future, 'first', None)
+        aio._complete(future, None, RuntimeError('late'))
+        return future.result()
+
+    assert asyncio.run(main()) == 'first'
+
+
+def test_operations_resolve_with_the_results(run, bus, glib):
+    async def main(manager):
+        task = asyncio.ensure_future(manager.connect(ADDRESS))
+        await asyncio.sleep(0)
+        bus.pop('GetManagedObjects').reply(objects(device(ADDRESS)))
+        bus.pop('Connect').fail('org.bluez.Error.Failed')
+        return await task
+
+    assert run(main) == {'result': 'Error', 'code': 'org.bluez.Error.Failed', 'step': 'connect'}
+
+
+def test_a_failed_lookup_raises(run, bus, glib):
+    async def main(manager):
+        task = asyncio.ensure_future(manager.disconnect(ADDRESS))
+        await asyncio.sleep(0)
+        bus.pop('GetManagedObjects').reply(objects())
+        return await task
+
+    with pytest.raises(DeviceNotFound):
+        run(main)
+
+
+def test_events_are_delivered_until_closed(run, bus):
+    async def main(manager):
+        received = []
+        events = manager.events()
+
+        async def consume():
+            async for event in events:
+                received.append(event)
+
+        task = asyncio.ensure_future(consume())
+        await asyncio.sleep(0)
+        changed(bus, ADDRESS, Connected = True)
+        await asyncio.sleep(0)
+        events.close()
+        await task
+        return received
+
+    received = run(main)
+    assert [(event['event'], event['address'], event['properties']) for event in received] == [('changed', ADDRESS, {'Connected': True})]
+    assert bus.receivers == []
+
+
+def test_close_wakes_every_waiting_consumer(run, bus):
+    async def main(manager):
+        events = manager.events()
+
+        async def consume():
+            return [event async for event in events]
+
+        tasks = [asyncio.ensure_future(consume()) for _ in range(2)]
+        await asyncio.sleep(0)
+        events.close()
+        return await asyncio.gather(*tasks)
+
+    assert run(main) == [[], []]
+
+
+def test_closing_before_iterating_never_subscribes(run, bus):
+    async def main(manager):
+        async with manager.events() as events:
+            pass
+        return [event async for event in events]
+
+    assert run(main) == []
+    assert bus.receivers == []
@@ -0,0 +1,59 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+from .conftest import device, objects
+
+
+FIRST, SECOND, THIRD = 'AA:AA:AA:AA:AA:01', 'AA:AA:AA:AA:AA:02', 'AA:AA:AA:AA:AA:03'
+
+
+def test_results_are_in_request_order(manager, bus, glib):
+    manager.tree = objects(device(FIRST), device(SECOND))
+    results = []
+    manager.batch('connect', [FIRST, SECOND], results.append)
+
+    bus.pop('Connect').fail('org.bluez.Error.Failed')
+    bus.pop('Connect').reply()
+
+    assert results == [[(FIRST, 'Error', 'org.bluez.Error.Failed'), (SECOND, 'Success', '')]]
+    assert not manager.busy
+
+
+def test_limit_bounds_the_calls_in_flight(manager, bus, glib):
+    manager.tree = objects(device(FIRST), device(SECOND), device(THIRD))
+    results = []
+    manager.batch('disconnect', [FIRST, SECOND, THIRD], results.append, limit = 2)
+
+    assert [call.method for call in bus.calls] == ['Disconnect', 'Disconnect']
+    bus.pop('Disconnect').reply()
+    assert len(bus.calls) == 2
+    bus.pop('Disconnect').reply()
+    bus.pop('Disconnect').reply()
+    assert [code for address, result, code in results[0]] == ['', '', '']
+
+
+def test_unknown_and_failing_devices_do_not_stall_the_batch(manager, bus, glib):
+    manager.tree = objects(device(FIRST), device(SECOND))
+    bus.raising[(device(SECOND)[0], 'Connect')] = RuntimeError('proxy gone')
+    results = []
+    manager.batch('connect', [FIRST, SECOND, THIRD], results.append)
+
+    bus.pop('Connect').reply()
+
+    assert results == [[
+        (FIRST, 'Success', ''),
+        (SECOND, 'Error', 'RuntimeError'),
+        (THIRD, 'Error', 'DeviceNotFound'),
+    ]]
+    assert not bus.calls
+
+
+def test_unpair_forgets_the_proxies(manager, bus, glib):
+    manager.tree = objects(device(FIRST))
+    results = []
+    manager.batch('unpair', [FIRST], results.append)
+
+    call = bus.pop('RemoveDevice')
+    assert call.path == '/org/bluez/hci0'
+    assert call.args == (device(FIRST)[0],)
+    call.reply()
+    assert results == [[(FIRST, 'Success', '')]]
@@ -0,0 +1,93 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+from bjarkan.discovery import DiscoverySessions
+
+from .conftest import objects
+
+
+def sessions(manager, bus, **kwargs):
+    manager.tree = objects()
+    return DiscoverySessions(bus, manager, **kwargs)
+
+
+def answer(bus, method):
+    """
+    Answer the adapter lookup, if one is pending, and the call of ``method``.
+    """
+    if any(call.method == 'GetManagedObjects' for call in bus.calls):
+        bus.pop('GetManagedObjects').reply(objects())
+    call = bus.pop(method)
+    assert call.path == '/org/bluez/hci0'
+    call.reply()
+
+
+def test_discovery_runs_while_any_session_is_held(manager, bus, glib):
+    discovery = sessions(manager, bus)
+    discovery.acquire(':1.1')
+    discovery.acquire(':1.2')
+    answer(bus, 'StartDiscovery')
+    assert discovery.discovering
+
+    discovery.release(':1.1')
+    assert not bus.calls
+    discovery.release(':1.2')
+    answer(bus, 'StopDiscovery')
+    assert not discovery.discovering
+
+
+def test_the_adapter_is_looked_up_once(manager, bus, glib):
+    discovery = sessions(manager, bus)
+    discovery.acquire(':1.1')
+    answer(bus, 'StartDiscovery')
+    discovery.hold()
+    answer(bus, 'StopDiscovery')
+    discovery.unhold()
+    answer(bus, 'StartDiscovery')
+
+    assert not bus.calls
+
+
+def test_state_only_changes_when_bluez_confirms(manager, bus, glib):
+    discovery = sessions(manager, bus)
+    discovery.acquire(':1.1')
+    bus.pop('GetManagedObjects').reply(objects())
+    bus.pop('StartDiscovery').fail('org.bluez.Error.NotReady')
+
+    assert not discovery.discovering
+    assert discovery.wanted
+
+
+def test_changes_while_a_call_is_in_flight_are_applied_after_it(manager, bus, glib):
+    discovery = sessions(manager, bus)
+    discovery.acquire(':1.1')
+    bus.pop('GetManagedObjects').reply(objects())
+    start = bus.pop('StartDiscovery')
+    discovery.hold()
+    assert not bus.calls
+
+    start.reply()
+    answer(bus, 'StopDiscovery')
+    assert not discovery.discovering
+
+
+def test_duty_cycle_pauses_scanning(manager, bus, glib):
+    discovery = sessions(manager, bus, scan = 5, pause = 2)
+    discovery.acquire(':1.1')
+    answer(bus, 'StartDiscovery')
+
+    glib.fire()
+    answer(bus, 'StopDiscovery')
+    glib.fire()
+    answer(bus, 'StartDiscovery')
+    assert discovery.discovering
+
+
+def test_sessions_of_clients_leaving_the_bus_are_closed(manager, bus, glib):
+    discovery = sessions(manager, bus)
+    discovery.acquire(':1.1')
+    answer(bus, 'StartDiscovery')
+
+    bus.watches[0].callback('')
+    answer(bus, 'StopDiscovery')
+    assert discovery.sessions == {}
+    assert bus.watches[0].cancelled
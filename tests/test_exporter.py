@@ -0,0 +1,47 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+from bjarkan import exporter
+from bjarkan.stats import Stats
+
+
+def _stats():
+    stats = Stats()
+    stats.inc('method_calls', 'Connect', 3)
+    stats.set_gauge('connected_devices', '', 2)
+    stats.observe('method_latency_seconds', 'Connect', 0.02)
+    return stats
+
+
+def test_text_format_declares_counters_by_sample_name():
+    text = exporter.render(_stats())
+
+    assert '# HELP bjarkan_method_calls_total D-Bus method calls handled\n' in text
+    assert '# TYPE bjarkan_method_calls_total counter\n' in text
+    assert 'bjarkan_method_calls_total{method="Connect"} 3\n' in text
+    assert 'bjarkan_connected_devices 2\n' in text
+    assert 'bjarkan_method_latency_seconds_bucket{method="Connect",le="0.025"} 1\n' in text
+    assert '# EOF' not in text
+
+
+def test_openmetrics_declares_counter_families():
+    text = exporter.render(_stats(), openmetrics = True)
+
+    assert '# TYPE bjarkan_method_calls counter\n' in text
+    assert 'bjarkan_method_calls_total{method="Connect"} 3\n' in text
+    assert text.endswith('# EOF\n')
+
+
+def test_labels_are_escaped():
+    stats = Stats()
+    stats.inc('bluez_errors', 'a"b\\c')
+
+    assert 'bjarkan_bluez_errors_total{error="a\\"b\\\\c"} 1\n' in exporter.render(stats)
+
+
+def test_invalid_interval_falls_back_to_default(monkeypatch):
+    for value in ('soon', '0', '-5'):
+        monkeypatch.setenv('BJARKAN_METRICS_INTERVAL', value)
+        assert exporter._interval() == exporter.DEFAULT_INTERVAL
+
+    monkeypatch.setenv('BJARKAN_METRICS_INTERVAL', '30')
+    assert exporter._interval() == 30
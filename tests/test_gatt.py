@@ -0,0 +1,93 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+from bjarkan.device_manager import GATT_CHARACTERISTIC_INTERFACE
+
+from .conftest import device, objects
+
+
+ADDRESS, OTHER = 'AA:AA:AA:AA:AA:01', 'AA:AA:AA:AA:AA:02'
+PATH = device(ADDRESS)[0]
+BATTERY_LEVEL = '00002a19-0000-1000-8000-00805f9b34fb'
+DEVICE_NAME = '00002a00-0000-1000-8000-00805f9b34fb'
+
+
+def characteristic(uuid, index):
+    return '{}/service0001/char{:04x}'.format(PATH, index), {GATT_CHARACTERISTIC_INTERFACE: {'UUID': uuid}}
+
+
+def tree(*characteristics, resolved = True):
+    return objects(device(ADDRESS, ServicesResolved = resolved), device(OTHER), *characteristics)
+
+
+def read(manager, requests):
+    results = []
+    manager.read_characteristics(requests, results.append)
+    return results
+
+
+def test_the_mapping_is_cached_once_services_are_resolved(manager, bus):
+    level = characteristic(BATTERY_LEVEL, 1)
+    assert manager.gatt_characteristics(PATH, tree(level, resolved = False)) == {BATTERY_LEVEL: level[0]}
+    assert manager.gatt_paths == {}
+
+    manager.gatt_characteristics(PATH, tree(level))
+    assert manager.gatt_characteristics(PATH, {}) == {BATTERY_LEVEL: level[0]}
+
+
+def test_gatt_changes_invalidate_the_mapping(manager, bus):
+    level = characteristic(BATTERY_LEVEL, 1)
+    manager.gatt_characteristics(PATH, tree(level))
+    bus.signal('InterfacesAdded', device(OTHER)[0] + '/service0001', {})
+    assert PATH in manager.gatt_paths
+
+    bus.signal('InterfacesRemoved', level[0], [GATT_CHARACTERISTIC_INTERFACE])
+    assert manager.gatt_paths == {}
+
+
+def test_reads_resolve_short_uuids_and_keep_request_order(manager, bus):
+    manager.tree = tree(characteristic(BATTERY_LEVEL, 1), characteristic(DEVICE_NAME, 2))
+    results = read(manager, [(ADDRESS, '2a00'), (ADDRESS.lower(), '2a19')])
+
+    bus.pop('ReadValue').reply(b'name')
+    assert results == []
+    bus.pop('ReadValue').fail('org.bluez.Error.NotPermitted')
+
+    assert results == [[
+        (ADDRESS, DEVICE_NAME, 'Success', '', b'name'),
+        (ADDRESS, BATTERY_LEVEL, 'Error', 'org.bluez.Error.NotPermitted', b''),
+    ]]
+
+
+def test_unknown_devices_and_characteristics_are_reported(manager, bus):
+    manager.tree = tree(characteristic(BATTERY_LEVEL, 1))
+    results = read(manager, [('AA:AA:AA:AA:AA:09', '2a19'), (OTHER, '2a19')])
+
+    assert results == [[
+        ('AA:AA:AA:AA:AA:09', BATTERY_LEVEL, 'Error', 'DeviceNotFound', b''),
+        (OTHER, BATTERY_LEVEL, 'Error', 'AttributeNotFound', b''),
+    ]]
+    assert bus.calls == []
+
+
+def test_a_stale_mapping_is_refetched_once(manager, bus):
+    level, name = characteristic(BATTERY_LEVEL, 1), characteristic(DEVICE_NAME, 2)
+    manager.gatt_characteristics(PATH, tree(level))
+    manager.tree = tree(level, name)
+    results = read(manager, [(ADDRESS, '2a00')])
+
+    call = bus.pop('ReadValue')
+    assert call.path == name[0]
+    call.reply(b'name')
+    assert results[0][0][2] == 'Success'
+    assert manager.gatt_paths[PATH] == {BATTERY_LEVEL: level[0], DEVICE_NAME: name[0]}
+
+
+def test_reads_are_bounded_by_the_limit(manager, bus):
+    manager.tree = tree(characteristic(BATTERY_LEVEL, 1), characteristic(DEVICE_NAME, 2))
+    results = []
+    manager.read_characteristics([(ADDRESS, '2a19'), (ADDRESS, '2a00')], results.append, limit = 1)
+
+    assert len(bus.calls) == 1
+    bus.pop('ReadValue').reply(b'\x64')
+    bus.pop('ReadValue').reply(b'name')
+    assert [value for address, uuid, result, code, value in results[0]] == [b'\x64', b'name']
@@ -0,0 +1,87 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+import logging
+
+import pytest
+
+from bjarkan.logger import BoundedQueueHandler, RateLimiter, StyleAdapter
+
+
+def _record(msg):
+    return logging.LogRecord('test', logging.INFO, __file__, 1, msg, (), None)
+
+
+@pytest.mark.parametrize('maxsize', [0, -1])
+def test_queue_must_be_bounded(maxsize):
+    with pytest.raises(ValueError):
+        BoundedQueueHandler(maxsize)
+
+
+def test_unknown_queue_policy():
+    with pytest.raises(ValueError):
+        BoundedQueueHandler(10, 'drop-some')
+
+
+def test_drop_newest_keeps_the_queued_records():
+    handler = BoundedQueueHandler(2, 'drop-newest')
+    for msg in ('a', 'b', 'c'):
+        handler.enqueue(_record(msg))
+
+    assert [handler.queue.get_nowait().msg for _ in range(2)] == ['a', 'b']
+    assert (handler.enqueued, handler.dropped) == (2, 1)
+
+
+def test_drop_oldest_makes_room():
+    handler = BoundedQueueHandler(2, 'drop-oldest')
+    for msg in ('a', 'b', 'c'):
+        handler.enqueue(_record(msg))
+
+    assert [handler.queue.get_nowait().msg for _ in range(2)] == ['b', 'c']
+    assert (handler.enqueued, handler.dropped) == (3, 1)
+
+
+def test_enable_queue_rejects_unbounded_queue():
+    adapter = StyleAdapter(logging.getLogger('bjarkan.tests.queue'))
+    with pytest.raises(ValueError):
+        adapter.enableQueue(0)
+
+    assert adapter.getQueueStats() == {'enabled': False}
+
+
+def test_rate_limiter_bursts_up_to_rate(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('bjarkan.logger.time.monotonic', lambda: now[0])
+    limiter = RateLimiter(rate = 3)
+
+    assert [limiter.admit('key') for _ in range(4)] == [0, 0, 0, None]
+    now[0] += 1
+    assert limiter.admit('key') == 1
+    assert limiter.suppressed == 1
+
+
+@pytest.mark.parametrize('rate', [0.5, 0.1])
+def test_rate_limiter_below_one_per_second(monkeypatch, rate):
+    now = [100.0]
+    monkeypatch.setattr('bjarkan.logger.time.monotonic', lambda: now[0])
+    limiter = RateLimiter(rate = rate)
+
+    assert limiter.admit('key') == 0
+    assert limiter.admit('key') is None
+    now[0] += 1 / rate
+    assert limiter.admit('key') == 1
+    assert limiter.admit('key') is None
+
+
+def test_rate_limiter_keys_are_independent():
+    limiter = RateLimiter(rate = 1)
+
+    assert limiter.admit('a') == 0
+    assert limiter.admit('b') == 0
+    assert limiter.admit('a') is None
+
+
+def test_rate_limiter_validates_its_settings():
+    with pytest.raises(ValueError):
+        RateLimiter(rate = -1)
+    with pytest.raises(ValueError):
+        RateLimiter(sample = 0)
@@ -0,0 +1,95 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+from bjarkan import DEVICE_INTERFACE
+from bjarkan.nearest import NearestDevice
+
+from .conftest import device, objects
+
+
+NEAR, FAR, PAIRED = 'AA:AA:AA:AA:AA:01', 'AA:AA:AA:AA:AA:02', 'AA:AA:AA:AA:AA:03'
+
+
+def rssi(bus, address, value):
+    for handler, kwargs in list(bus.receivers):
+        if kwargs['signal_name'] == 'PropertiesChanged':
+            handler(DEVICE_INTERFACE, {'RSSI': value}, [], path = device(address)[0])
+
+
+def started(manager, bus, **kwargs):
+    found = []
+    finder = NearestDevice(manager, **kwargs)
+    finder.start(found.append)
+    bus.pop('GetManagedObjects').reply(objects(device(NEAR), device(FAR), device(PAIRED, Paired = True)))
+    bus.pop('StartDiscovery').reply()
+    return finder, found
+
+
+def test_the_strongest_average_wins_when_time_is_up(manager, bus, glib):
+    finder, found = started(manager, bus)
+    for value in (-70, -50, -60):
+        rssi(bus, NEAR, value)
+    rssi(bus, FAR, -65)
+    rssi(bus, PAIRED, -30)
+
+    glib.fire()
+    assert found == [NEAR]
+    assert [call.method for call in bus.calls] == ['StopDiscovery']
+    assert bus.receivers == []
+
+
+def test_a_clear_leader_stops_discovery_early(manager, bus, glib):
+    finder, found = started(manager, bus, min_duration = 0, min_samples = 2, lead = 10)
+    rssi(bus, FAR, -80)
+    rssi(bus, NEAR, -50)
+    assert found == []
+    rssi(bus, NEAR, -52)
+
+    assert found == [NEAR]
+    assert glib.sources == {}
+    bus.pop('StopDiscovery')
+
+
+def test_nothing_qualifies(manager, bus, glib):
+    finder, found = started(manager, bus, min_rssi = -60)
+    rssi(bus, FAR, -90)
+
+    glib.fire()
+    assert found == [None]
+
+
+def test_a_failed_snapshot_reports_the_error(manager, bus, glib):
+    found, errors = [], []
+    NearestDevice(manager).start(found.append, errors.append)
+    bus.pop('GetManagedObjects').fail('org.freedesktop.DBus.Error.ServiceUnknown')
+
+    assert found == []
+    assert errors[0].get_dbus_name() == 'org.freedesktop.DBus.Error.ServiceUnknown'
+    assert bus.calls == [] and bus.receivers == [] and glib.sources == {}
+
+
+def test_a_failed_start_does_not_stop_discovery(manager, bus, glib):
+    found = []
+    NearestDevice(manager).start(found.append)
+    bus.pop('GetManagedObjects').reply(objects(device(NEAR)))
+    bus.pop('StartDiscovery').fail('org.bluez.Error.NotReady')
+
+    assert found == [None]
+    assert bus.calls == [] and glib.sources == {}
+
+
+def test_a_given_snapshot_and_discovery_are_used(manager, bus, glib):
+    calls = []
+    finder = NearestDevice(
+        manager,
+        start_discovery = lambda: calls.append('start'),
+        stop_discovery = lambda: calls.append('stop'),
+        snapshot = lambda reply, error: reply(objects(device(NEAR)))
+    )
+    found = []
+    finder.start(found.append)
+    rssi(bus, NEAR, -40)
+    glib.fire()
+
+    assert found == [NEAR]
+    assert calls == ['start', 'stop']
+    assert bus.calls == []
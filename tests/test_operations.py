@@ -0,0 +1,145 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+import pytest
+
+from bjarkan.operations import DeviceOperation
+
+from .conftest import device, objects
+
+
+ADDRESS = 'AA:AA:AA:AA:AA:01'
+PATH = device(ADDRESS)[0]
+
+
+def start(manager, operation, results, **kwargs):
+    pending = DeviceOperation(manager, operation, ADDRESS, results.append, agent = False, **kwargs)
+    pending.start()
+    return pending
+
+
+def test_pair_trusts_and_connects(manager, bus, glib):
+    manager.tree = objects(device(ADDRESS))
+    results = []
+    start(manager, 'pair', results)
+
+    bus.pop('Pair').reply()
+    trust = bus.pop('Set')
+    assert trust.args[1:] == ('Trusted', True)
+    trust.reply()
+    assert manager.in_flight(ADDRESS)
+    bus.pop('Connect').reply()
+
+    assert results == [{'result': 'Success', 'code': ''}]
+    assert not manager.in_flight(ADDRESS)
+
+
+def test_paired_and_trusted_devices_are_only_connected(manager, bus, glib):
+    manager.tree = objects(device(ADDRESS, Paired = True, Trusted = True))
+    results = []
+    start(manager, 'pair', results)
+
+    assert [call.method for call in bus.calls] == ['Connect']
+
+
+def test_failed_trust_is_not_a_connection_failure(manager, bus, glib):
+    manager.tree = objects(device(ADDRESS, Paired = True))
+    results = []
+    start(manager, 'pair', results)
+
+    bus.pop('Set').fail('')
+
+    assert results == [{'result': 'Error', 'code': 'TrustFailure', 'step': 'trust'}]
+
+
+def test_pairing_errors_are_mapped(manager, bus, glib):
+    manager.tree = objects(device(ADDRESS))
+    results = []
+    start(manager, 'pair', results)
+
+    bus.pop('Pair').fail('org.bluez.Error.AuthenticationRejected')
+
+    assert results == [{'result': 'Error', 'code': 'AuthenticationError', 'step': 'pair'}]
+    assert not bus.calls
+
+
+def test_pairing_without_reply_is_cancelled(manager, bus, glib):
+    manager.tree = objects(device(ADDRESS))
+    results = []
+    start(manager, 'pair', results)
+
+    bus.pop('Pair').fail('org.freedesktop.DBus.Error.NoReply')
+
+    assert results[0]['code'] == 'Timeout'
+    assert bus.pop('CancelPairing').path == PATH
+
+
+def test_deadline_aborts_the_step_in_flight(manager, bus, glib):
+    manager.tree = objects(device(ADDRESS))
+    results = []
+    start(manager, 'connect', results, timeout = 2)
+
+    connect = bus.pop('Connect')
+    assert connect.kwargs['timeout'] > 2
+    glib.fire()
+
+    assert results == [{'result': 'Error', 'code': 'Timeout', 'step': 'connect'}]
+    assert bus.pop('Disconnect').path == PATH
+    connect.reply()
+    assert len(results) == 1
+    assert not manager.in_flight(ADDRESS)
+
+
+def test_cancel_completes_once_and_removes_the_deadline(manager, bus, glib):
+    manager.tree = objects(device(ADDRESS))
+    results = []
+    pending = start(manager, 'pair', results, timeout = 10)
+
+    assert pending.cancel()
+    assert not pending.cancel()
+    assert results == [{'result': 'Error', 'code': 'Canceled', 'step': 'pair'}]
+    assert not glib.sources
+    assert bus.pop('CancelPairing')
+
+
+def test_failure_to_issue_the_first_step_leaves_nothing_behind(manager, bus, glib):
+    manager.tree = objects(device(ADDRESS))
+    bus.raising[(PATH, 'Connect')] = RuntimeError('proxy gone')
+    results = []
+
+    with pytest.raises(RuntimeError):
+        start(manager, 'connect', results, timeout = 5)
+
+    assert not glib.sources
+    assert not manager.in_flight(ADDRESS)
+    assert results == []
+
+
+def test_failure_to_issue_a_later_step_is_reported(manager, bus, glib):
+    manager.tree = objects(device(ADDRESS, Paired = True, Trusted = True))
+    results = []
+    start(manager, 'pair', results, uuids = ['110b', '110e'])
+
+    bus.raising[(PATH, 'ConnectProfile')] = RuntimeError('proxy gone')
+    bus.pop('ConnectProfile').reply()
+
+    assert results == [{'result': 'Error', 'code': 'RuntimeError', 'step': 'connect'}]
+    assert not manager.in_flight(ADDRESS)
+
+
+def test_connected_devices_are_not_connected_again(manager, bus, glib):
+    manager.tree = objects(device(ADDRESS, Paired = True, Trusted = True, Connected = True))
+    results = []
+    start(manager, 'pair', results)
+
+    assert results == [{'result': 'Success', 'code': ''}]
+    assert not bus.calls
+    assert not manager.in_flight(ADDRESS)
+
+
+def test_profiles_are_connected_even_when_connected(manager, bus, glib):
+    manager.tree = objects(device(ADDRESS, Paired = True, Trusted = True, Connected = True))
+    results = []
+    start(manager, 'pair', results, uuids = ['0000110b-0000-1000-8000-00805f9b34fb'])
+
+    bus.pop('ConnectProfile').reply()
+    assert results == [{'result': 'Success', 'code': ''}]
@@ -0,0 +1,49 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+import pytest
+
+from bjarkan.provision import read_manifest, read_state
+
+
+def manifest(tmp_path, text):
+    path = tmp_path / 'manifest.csv'
+    path.write_text(text)
+    return str(path)
+
+
+def test_rows_without_header(tmp_path):
+    path = manifest(tmp_path, 'aa:bb:cc:dd:ee:ff,hci1\n\n# spare\n11:22:33:44:55:66\n')
+
+    assert read_manifest(path) == [('AA:BB:CC:DD:EE:FF', 'hci1'), ('11:22:33:44:55:66', None)]
+
+
+def test_header_names_the_columns(tmp_path):
+    path = manifest(tmp_path, 'adapter,address\nhci0,aa:bb:cc:dd:ee:ff\n,11:22:33:44:55:66\n')
+
+    assert read_manifest(path) == [('AA:BB:CC:DD:EE:FF', 'hci0'), ('11:22:33:44:55:66', None)]
+
+
+def test_short_row_reports_its_line(tmp_path):
+    path = manifest(tmp_path, 'adapter,address\nhci0,aa:bb:cc:dd:ee:ff\n\nhci1\n')
+
+    with pytest.raises(ValueError, match = r'manifest\.csv:4: no device address'):
+        read_manifest(path)
+
+
+def test_header_without_address_column(tmp_path):
+    path = manifest(tmp_path, 'adapter,serial\nhci0,1234\n')
+
+    with pytest.raises(ValueError, match = r':1: no address column'):
+        read_manifest(path)
+
+
+def test_state_skips_lines_cut_short(tmp_path):
+    path = tmp_path / 'state'
+    path.write_text(
+        '{"address": "AA:BB:CC:DD:EE:FF", "result": "Success"}\n'
+        '{"address": "11:22:33:44:55:66", "result": "Error"}\n'
+        '{"address": "22:33'
+    )
+
+    assert read_state(str(path)) == {'AA:BB:CC:DD:EE:FF'}
+    assert read_state(str(tmp_path / 'missing')) == set()
@@ -0,0 +1,48 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+from bjarkan.singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_result():
+    inflight = SingleFlight()
+    started = []
+    replies = []
+    inflight.join(('Connect', 'AA'), replies.append, None, lambda resolve, reject: started.append(resolve))
+    inflight.join(('Connect', 'AA'), replies.append, None, lambda resolve, reject: started.append(resolve))
+
+    assert len(started) == 1
+    assert len(inflight) == 1
+    started[0]('done')
+    assert replies == ['done', 'done']
+    assert len(inflight) == 0
+
+
+def test_different_keys_are_not_coalesced():
+    inflight = SingleFlight()
+    started = []
+    inflight.join(('Connect', 'AA'), None, None, lambda resolve, reject: started.append('AA'))
+    inflight.join(('Connect', 'BB'), None, None, lambda resolve, reject: started.append('BB'))
+
+    assert started == ['AA', 'BB']
+
+
+def test_a_failing_start_rejects_every_waiter():
+    inflight = SingleFlight()
+    errors = []
+
+    def start(resolve, reject):
+        raise RuntimeError('no adapter')
+
+    inflight.join(('Connect', 'AA'), None, errors.append, start)
+
+    assert [str(e) for e in errors] == ['no adapter']
+    assert len(inflight) == 0
+
+
+def test_a_finished_call_is_started_again():
+    inflight = SingleFlight()
+    started = []
+    inflight.join(('Connect', 'AA'), lambda value: None, None, lambda resolve, reject: (started.append(1), resolve()))
+    inflight.join(('Connect', 'AA'), lambda value: None, None, lambda resolve, reject: (started.append(2), resolve()))
+
+    assert started == [1, 2]
@@ -0,0 +1,107 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+import pytest
+
+from bjarkan.stats import Histogram, Stats, Timeline
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram(buckets = (0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 5.0):
+        histogram.observe(value)
+
+    assert histogram.cumulative() == [(0.1, 1), (1.0, 3), ('+Inf', 4)]
+    assert histogram.count == 4
+    assert histogram.sum == pytest.approx(6.05)
+
+
+def test_counters_and_gauges_are_grouped_by_label():
+    stats = Stats()
+    stats.inc('method_calls', 'Connect')
+    stats.inc('method_calls', 'Connect')
+    stats.inc('bluez_signals')
+    stats.gauge('inflight', 'Pair', 1)
+    stats.gauge('inflight', 'Pair', -1)
+
+    snapshot = stats.snapshot()
+    assert snapshot['counters'] == {'method_calls': {'Connect': 2}, 'bluez_signals': 1}
+    assert snapshot['gauges'] == {'inflight': {'Pair': 0}}
+
+
+def test_operation_attributes_bluez_calls_and_counts_errors():
+    stats = Stats()
+    with stats.operation('Connect'):
+        stats.bluez_call('GetManagedObjects')
+    stats.bluez_call('GetManagedObjects')
+    with pytest.raises(RuntimeError):
+        with stats.operation('Pair'):
+            raise RuntimeError()
+
+    assert stats.counters[('bluez_calls', 'Connect/GetManagedObjects')] == 1
+    assert stats.counters[('bluez_calls', 'internal/GetManagedObjects')] == 1
+    assert stats.counters[('method_errors', 'Pair')] == 1
+    assert stats.histograms[('method_latency_seconds', 'Connect')].count == 1
+
+
+def test_timeline_phases_are_recorded():
+    stats = Stats()
+    timeline = Timeline('Pair')
+    timeline.mark('lookup')
+    timeline.mark('pair')
+    stats.record_timeline(timeline)
+
+    assert set(timeline.as_dict()) == {'lookup', 'pair', 'total'}
+    assert stats.histograms[('phase_latency_seconds', 'Pair/total')].count == 1
+
+
+def test_asynchronous_operation_is_timed_when_it_replies():
+    stats = Stats()
+    replies = []
+    with stats.operation('Connect', replies.append, None) as (reply, error):
+        pass
+
+    assert ('method_latency_seconds', 'Connect') not in stats.histograms
+    reply('done')
+    reply('again')
+    assert replies == ['done', 'again']
+    assert stats.histograms[('method_latency_seconds', 'Connect')].count == 1
+    assert ('method_errors', 'Connect') not in stats.counters
+
+
+def test_asynchronous_operation_counts_error_callbacks():
+    stats = Stats()
+    errors = []
+    with stats.operation('Pair', lambda *args: None, errors.append) as (reply, error):
+        pass
+    error(RuntimeError())
+
+    assert len(errors) == 1
+    assert stats.counters[('method_errors', 'Pair')] == 1
+    assert stats.histograms[('method_latency_seconds', 'Pair')].count == 1
+
+
+def test_unlabelled_and_labelled_values_of_one_metric_are_kept():
+    stats = Stats()
+    stats.inc('bluez_errors', '')
+    stats.inc('bluez_errors', 'org.bluez.Error.Failed')
+    stats.inc('bluez_errors', '')
+
+    assert stats.snapshot()['counters'] == {'bluez_errors': {'': 2, 'org.bluez.Error.Failed': 1}}
+
+
+def test_reading_a_rate_does_not_change_it(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('bjarkan.stats.time.monotonic', lambda: now[0])
+    stats = Stats()
+    for _ in range(30):
+        stats.mark('replayed_signals')
+    now[0] += 10
+
+    first = stats.snapshot()['rates']['replayed_signals']
+    second = stats.snapshot()['rates']['replayed_signals']
+    assert first == second
+    assert first['per_second_recent'] == 3.0
+
+    now[0] += 120
+    stats.mark('replayed_signals')
+    assert stats.snapshot()['rates']['replayed_signals']['per_second_recent'] == round(1 / 60, 3)
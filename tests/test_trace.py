@@ -0,0 +1,60 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+import gzip
+import json
+
+import dbus
+import pytest
+
+from bjarkan.trace import TRACE_VERSION, TraceReplayer, decode_value, encode_value, read_trace
+
+
+def test_values_round_trip_with_their_types():
+    value = dbus.Dictionary({
+        dbus.String('Address'): dbus.String('AA:BB:CC:DD:EE:FF'),
+        dbus.String('RSSI'): dbus.Int16(-60),
+        dbus.String('Paired'): dbus.Boolean(True),
+        dbus.String('Class'): dbus.UInt32(0x240404),
+        dbus.String('Adapter'): dbus.ObjectPath('/org/bluez/hci0'),
+        dbus.String('UUIDs'): dbus.Array([dbus.String('0000110b-0000-1000-8000-00805f9b34fb')], signature = 's'),
+        dbus.String('ManufacturerData'): dbus.Dictionary({dbus.UInt16(76): dbus.ByteArray(b'\x02\x15')}, signature = 'qv'),
+    }, signature = 'sv')
+
+    encoded = json.loads(json.dumps(encode_value(value)))
+    decoded = decode_value(encoded)
+
+    assert decoded == value
+    assert decoded.signature == 'sv'
+    for key in value:
+        assert type(decoded[key]) is type(value[key])
+    assert bytes(decoded['ManufacturerData'][76]) == b'\x02\x15'
+
+
+def test_structs_and_doubles():
+    value = dbus.Struct((dbus.Byte(1), dbus.Double(0.5)))
+
+    decoded = decode_value(encode_value(value))
+    assert tuple(decoded) == (1, 0.5)
+    assert type(decoded[1]) is dbus.Double
+
+
+def test_unknown_types_are_refused():
+    with pytest.raises(TypeError):
+        encode_value(object())
+
+
+def test_trace_cut_short_ends_at_its_last_record(tmp_path):
+    path = str(tmp_path / 'trace.gz')
+    with gzip.open(path, 'wt') as f:
+        f.write(json.dumps({'trace': TRACE_VERSION}) + '\n')
+        f.write(json.dumps({'t': 0.5, 'signal': 'PropertiesChanged'}) + '\n')
+        f.write('{"t": 0.7, "sig')
+
+    header, records = read_trace(path)
+    assert header['trace'] == TRACE_VERSION
+    assert records == [{'t': 0.5, 'signal': 'PropertiesChanged'}]
+
+
+def test_replay_speed_must_be_positive():
+    with pytest.raises(ValueError):
+        TraceReplayer(None, [], speed = 0)
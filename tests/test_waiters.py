@@ -0,0 +1,52 @@
+# Copyright 2016 GetWellNetwork, Inc., BSD copyright and disclaimer apply
+
+from bjarkan.waiters import StateWaiters
+
+
+ADDRESS = 'AA:AA:AA:AA:AA:01'
+
+
+def test_a_waiter_completes_on_the_change(glib):
+    waiters, codes = StateWaiters(), []
+    waiters.add(ADDRESS.lower(), 'Connected', True, codes.append, timeout_ms = 1000)
+
+    waiters.changed(ADDRESS, {'Connected': False})
+    assert codes == []
+    waiters.changed(ADDRESS, {'Connected': True})
+
+    assert codes == ['']
+    assert len(waiters) == 0
+    assert glib.sources == {}
+
+
+def test_a_waiter_already_satisfied_completes_on_check(glib):
+    waiters, codes = StateWaiters(), []
+    waiter = waiters.add(ADDRESS, 'Paired', True, codes.append)
+
+    assert waiters.check(waiter, {'Paired': True})
+    assert codes == ['']
+    assert waiters.check(waiter, {'Paired': False})
+
+
+def test_a_waiter_times_out(glib):
+    waiters, codes = StateWaiters(), []
+    waiters.add(ADDRESS, 'Connected', True, codes.append, timeout_ms = 1000)
+
+    glib.fire()
+    waiters.changed(ADDRESS, {'Connected': True})
+
+    assert codes == ['Timeout']
+    assert waiters.waiters == {}
+
+
+def test_a_cancelled_waiter_completes_once(glib):
+    waiters, codes = StateWaiters(), []
+    waiter = waiters.add(ADDRESS, 'Connected', True, codes.append, timeout_ms = 1000)
+    other = waiters.add(ADDRESS, 'Connected', True, codes.append)
+
+    waiters.cancel(waiter, 'Canceled')
+    waiters.cancel(waiter, 'Canceled')
+
+    assert codes == ['Canceled']
+    assert glib.sources == {}
+    assert waiters.waiters == {ADDRESS: [other]}